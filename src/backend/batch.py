@@ -0,0 +1,315 @@
+"""
+Headless batch processing of a directory of recordings.
+
+Each recording is tracked with the prompts of its prompt file, a JSON list of PromptPoint objects
+(as sent to /process-frame), and its masks and histograms are written to the output directory.
+Recordings are spread over a pool of worker processes, each of which loads SAM2 once.
+
+Prompt files are looked up as <prompts dir>/<recording name without extension>.json; with --prompts
+pointing to a single file, its prompts are applied to every recording.
+
+The results of a recording are written to <output>/<recording name>/ in the layout of an entry of the
+mask cache (see mask_cache.py): columnar .npy arrays of the frame indices, the bit-packed masks and the
+histograms of all frames, which mask_cache.CacheEntry reads back memory-mapped. Next to them:
+
+    bin_edges.npy  float64[N, num_bins + 1]  bin edges of the histograms
+    source.json    recording, prompts, histogram options and the key of the results
+    results.parquet / results.h5  with --export, the results as one columnar file (see export.py)
+
+A recording whose results were produced from the same content, prompts, model and histogram options
+is skipped, unless --force is given.
+
+Usage:
+    python src/backend/batch.py data/nightly --output data/nightly-results --workers 4
+    python src/backend/batch.py data/nightly --prompts prompts.json --histogram-bins 512 --monochrome
+    python src/backend/batch.py data/nightly --export parquet
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import aclosing
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+
+import radiometric
+import server
+from export import EXPORT_FORMATS, check_export_format, export_results
+from frame_store import FrameStore
+from mask_cache import CacheEntry, MaskCache, cache_key, hash_file
+from sessions import PromptPoint, Session
+
+logger = logging.getLogger(__name__)
+
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv")
+SOURCE_FILE = "source.json"
+PROMPT_FIELDS = ("x", "y", "label", "obj_id", "frame_idx")
+
+
+def load_prompts(prompts_path: Path) -> List[PromptPoint]:
+    """
+    Read a prompt file: a JSON list of PromptPoint objects, or an object with such a list under "prompts".
+
+    Raises:
+        ValueError: If the file does not hold valid prompts.
+    """
+    with open(prompts_path) as f:
+        data = json.load(f)
+    if isinstance(data, dict):
+        data = data.get("prompts")
+    if not isinstance(data, list) or not data:
+        raise ValueError(f"{prompts_path} does not hold a list of prompts")
+    prompts = []
+    for prompt in data:
+        missing = [field for field in PROMPT_FIELDS if field not in prompt]
+        if missing:
+            raise ValueError(f"Prompt {prompt} of {prompts_path} lacks {', '.join(missing)}")
+        prompts.append({
+            "x": float(prompt["x"]),
+            "y": float(prompt["y"]),
+            "label": int(prompt["label"]),
+            "obj_id": int(prompt["obj_id"]),
+            "frame_idx": int(prompt["frame_idx"]),
+        })
+    return prompts
+
+
+def find_recordings(input_dir: Path, prompts: Path | None) -> Tuple[List[Tuple[Path, Path]], List[Path]]:
+    """
+    Recordings of a directory with their prompt file.
+
+    Returns:
+        The (recording, prompt file) pairs, and the recordings without a prompt file.
+    """
+    recordings = []
+    unprompted = []
+    for path in sorted(input_dir.iterdir()):
+        if not path.is_file() or path.suffix.lower() not in VIDEO_EXTENSIONS + radiometric.RADIOMETRIC_EXTENSIONS:
+            continue
+        if prompts is not None and prompts.is_file():
+            prompts_path = prompts
+        else:
+            prompts_path = (prompts or input_dir) / f"{path.stem}.json"
+        if prompts_path.is_file():
+            recordings.append((path, prompts_path))
+        else:
+            unprompted.append(path)
+    return recordings, unprompted
+
+
+def read_source(entry_dir: Path) -> Dict[str, Any] | None:
+    try:
+        with open(entry_dir / SOURCE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def recording_hash(video_path: Path, previous: Dict[str, Any] | None) -> str:
+    """Content hash of a recording, reusing the one of its previous results if the file did not change since."""
+    stat = video_path.stat()
+    if previous is not None and previous.get("size") == stat.st_size and previous.get("mtime_ns") == stat.st_mtime_ns:
+        return previous["video_hash"]
+    return hash_file(video_path)
+
+
+def results_key(
+    video_path: Path,
+    video_hash: str,
+    prompts: List[PromptPoint],
+    histogram_request: Dict[str, Any],
+    raw_layout: Dict[str, Any] | None,
+    fps: float,
+) -> str:
+    """
+    Key of the results of a recording. Unresolved histogram options are used: their defaults only depend on the recording.
+
+    The key of a radiometric stack covers the layout and frame rate it is read with, so that results
+    decoded with a wrong layout are not kept as up to date once it is corrected.
+    """
+    if radiometric.is_radiometric(video_path):
+        video_hash = radiometric.layout_hash(video_hash, video_path, raw_layout, fps)
+    return cache_key(video_hash, prompts, server.get_model_id(), histogram_request)
+
+
+def init_worker(log_level: int) -> None:
+    """Load SAM2 once per worker process."""
+    logging.getLogger().setLevel(log_level)
+    server.DEBUG = log_level <= logging.DEBUG
+    if not asyncio.run(server.init_sam2()):
+        raise RuntimeError("SAM2 model initialization failed")
+    # inference states are built on the main thread of the worker
+    server.enter_autocast()
+
+
+def process_recording(
+    video_path: Path,
+    prompts_path: Path,
+    output_dir: Path,
+    histogram_request: Dict[str, Any],
+    raw_layout: Dict[str, Any] | None,
+    fps: float,
+    video_hash: str,
+    key: str,
+    export_format: str | None = None,
+) -> Dict[str, Any]:
+    """
+    Track a recording with its prompts and write its results to `output_dir`. Runs in a worker process.
+
+    The recording is decoded into a temporary frame store under <output>/.frames, removed once done.
+
+    Returns:
+        Summary of the run: recording, number of frames and duration.
+    """
+    start_time = time.perf_counter()
+    prompts = load_prompts(prompts_path)
+    results = MaskCache(output_dir, sys.maxsize)
+    entry_dir = output_dir / video_path.name
+    store_dir = output_dir / ".frames" / video_path.name
+    image_size = server.sam2_predictor.image_size
+    if radiometric.is_radiometric(video_path):
+        store = FrameStore.create_from_stack(store_dir, str(video_path), image_size, video_hash, raw_layout, fps)
+    else:
+        store = FrameStore.create(store_dir, str(video_path), image_size, video_hash)
+    try:
+        session = Session(video_path.name, str(video_path), store.video_info())
+        session.video_hash = video_hash
+        session.frame_store = store
+        session.prompts = prompts
+        histogram_options = server.get_histogram_options(session, histogram_request)
+        inference_state = server.init_state_from_store(store)
+        server.apply_prompts(inference_state, prompts)
+        obj_ids = server.get_object_ids(inference_state)
+
+        # the results are committed as a new entry next to the previous ones, which they replace once complete
+        new_dir = output_dir / f"{video_path.name}.new"
+        shutil.rmtree(new_dir, ignore_errors=True)
+
+        async def run():
+            writer = results.writer(new_dir.name, obj_ids, store.num_frames)
+            async with aclosing(server.process_video_frames(session, inference_state, histogram_options, writer)) as frames:
+                async for _ in frames:
+                    pass
+
+        asyncio.run(run())
+        if not (new_dir / "meta.json").is_file():
+            raise RuntimeError(f"Tracking stopped before the last frame of {video_path.name}")
+        bin_edges = server.get_bin_edges(session, histogram_options)
+        np.save(new_dir / "bin_edges.npy", bin_edges)
+        if export_format is not None:
+            entry = CacheEntry(new_dir)
+            export_results(
+                new_dir / f"results{EXPORT_FORMATS[export_format][0]}", export_format, entry.iter_frames(), entry.obj_ids,
+                entry.histograms.shape[1:] if entry.histograms is not None else None, bin_edges,
+                metadata={"recording": str(video_path), "video_hash": video_hash, "histogram_options": histogram_options},
+            )
+        stat = video_path.stat()
+        with open(new_dir / SOURCE_FILE, "w") as f:
+            json.dump({
+                "recording": str(video_path),
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "video_hash": video_hash,
+                "prompts_file": str(prompts_path),
+                "prompts": prompts,
+                "model": server.get_model_id(),
+                "histogram_request": histogram_request,
+                "histogram_options": histogram_options,
+                "key": key,
+            }, f)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(new_dir, entry_dir)
+    finally:
+        store.release()
+        FrameStore.remove(store_dir)
+    return {"recording": video_path.name, "frames": store.num_frames, "seconds": time.perf_counter() - start_time}
+
+
+def main(argv: List[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Track the objects of a directory of recordings with saved prompts.")
+    parser.add_argument("input_dir", type=Path, help="Directory of recordings (videos or radiometric stacks).")
+    parser.add_argument("--prompts", type=Path, help="Directory of prompt files (default: the input directory), or a single prompt file for all recordings.")
+    parser.add_argument("--output", type=Path, help="Directory of the results (default: <input_dir>/results).")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes, each with its own copy of SAM2.")
+    parser.add_argument("--histogram-bins", type=int, help="Number of histogram bins (default: 256).")
+    parser.add_argument("--histogram-range", type=float, nargs=2, metavar=("LOW", "HIGH"), help="Range of the histograms, in native units for radiometric stacks.")
+    parser.add_argument("--monochrome", action="store_true", help="Histogram grayscale conversions of color recordings.")
+    parser.add_argument("--raw-width", type=int, help="Frame width of headerless .raw stacks.")
+    parser.add_argument("--raw-height", type=int, help="Frame height of headerless .raw stacks.")
+    parser.add_argument("--raw-dtype", default="uint16", help="Data type of headerless .raw stacks.")
+    parser.add_argument("--fps", type=float, default=30.0, help="Frame rate of radiometric stacks.")
+    parser.add_argument("--export", choices=tuple(EXPORT_FORMATS), help="Also write the results of each recording as one Parquet or HDF5 file.")
+    parser.add_argument("--force", action="store_true", help="Process recordings whose results are up to date.")
+    parser.add_argument("--log-level", default="INFO", help="Logging level of the workers.")
+    args = parser.parse_args(argv)
+
+    logging.getLogger().setLevel(args.log_level.upper())
+    if args.export is not None:
+        try:
+            check_export_format(args.export)
+        except ValueError as e:
+            parser.error(str(e))
+    output_dir = args.output or args.input_dir / "results"
+    output_dir.mkdir(parents=True, exist_ok=True)
+    MaskCache(output_dir, sys.maxsize).remove_incomplete()
+    shutil.rmtree(output_dir / ".frames", ignore_errors=True)
+
+    histogram_request: Dict[str, Any] = {"convert_to_monochrome": args.monochrome}
+    if args.histogram_bins is not None:
+        histogram_request["histogram_bins"] = args.histogram_bins
+    if args.histogram_range is not None:
+        histogram_request["histogram_range"] = args.histogram_range
+    raw_layout = None
+    if args.raw_width is not None and args.raw_height is not None:
+        raw_layout = {"width": args.raw_width, "height": args.raw_height, "dtype": args.raw_dtype}
+
+    recordings, unprompted = find_recordings(args.input_dir, args.prompts)
+    for path in unprompted:
+        logger.warning(f"Skipping {path.name}: no prompt file")
+
+    pending = []
+    for video_path, prompts_path in recordings:
+        try:
+            previous = read_source(output_dir / video_path.name)
+            video_hash = recording_hash(video_path, previous)
+            key = results_key(video_path, video_hash, load_prompts(prompts_path), histogram_request, raw_layout, args.fps)
+        except Exception as e:
+            logger.error(f"Skipping {video_path.name}: {e}")
+            continue
+        exported = args.export is None or (output_dir / video_path.name / f"results{EXPORT_FORMATS[args.export][0]}").is_file()
+        if not args.force and previous is not None and previous.get("key") == key and exported:
+            logger.info(f"{video_path.name} is up to date")
+            continue
+        pending.append((video_path, prompts_path, video_hash, key))
+    logger.info(f"Processing {len(pending)} of {len(recordings)} recordings with {args.workers} workers")
+
+    failed = 0
+    if pending:
+        # CUDA cannot be used in forked processes
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(args.workers, mp_context=context, initializer=init_worker, initargs=(logging.getLogger().level,)) as pool:
+            futures = {
+                pool.submit(process_recording, video_path, prompts_path, output_dir, histogram_request, raw_layout, args.fps, video_hash, key, args.export): video_path
+                for video_path, prompts_path, video_hash, key in pending
+            }
+            for future in as_completed(futures):
+                try:
+                    summary = future.result()
+                    logger.info(f"Processed {summary['frames']} frames of {summary['recording']} in {summary['seconds']:.1f} s")
+                except Exception as e:
+                    failed += 1
+                    logger.error(f"Failed to process {futures[future].name}: {e}")
+    logger.info(f"Done: {len(pending) - failed} processed, {len(recordings) - len(pending)} up to date, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+import contextlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Cache of the image features of frames, shared by all sessions.
+#
+# SAM2 computes the features of a frame with its image encoder (the Hiera backbone), the dominant cost of
+# a click on CPU, and keeps them in inference_state["cached_features"] for the most recent frame only.
+# The inference states built by the server replace that dictionary with a CachedFeatures view of an
+# EmbeddingCache, which keeps the features of many frames of all recordings, least recently used first out,
+# within a byte budget. Going back to a frame that was prompted or prefetched then skips the encoder.
+#
+# The position encodings of the features depend only on their shape, so they are stored once for all frames.
+
+
+def tensor_bytes(tensors) -> int:
+    """Bytes held by tensors, counting tensors that share storage once."""
+    seen = set()
+    total = 0
+    for tensor in tensors:
+        key = (tensor.data_ptr(), tensor.nelement())
+        if key not in seen:
+            seen.add(key)
+            total += tensor.element_size() * tensor.nelement()
+    return total
+
+
+class EmbeddingCache:
+    """
+    LRU cache of the backbone outputs of frames, keyed by (video key, frame index), capped at `max_bytes`.
+
+    Thread-safe: features are looked up and added from the inference worker threads.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Tuple[Hashable, int], Tuple[Dict[str, Any], int]] = OrderedDict()
+        self.position_encodings: Dict[Tuple, List[Any]] = {}
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, video_key: Hashable, frame_idx: int) -> Dict[str, Any] | None:
+        with self.lock:
+            entry = self.entries.get((video_key, frame_idx))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end((video_key, frame_idx))
+            self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key: Tuple[Hashable, int]) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def put(self, video_key: Hashable, frame_idx: int, backbone_out: Dict[str, Any]) -> None:
+        """Add the backbone output of a frame, evicting the least recently used frames beyond the budget."""
+        if self.max_bytes <= 0:
+            return
+        pos_enc = backbone_out["vision_pos_enc"]
+        shape_key = tuple((tuple(t.shape), str(t.dtype), str(t.device)) for t in pos_enc)
+        with self.lock:
+            shared_pos_enc = self.position_encodings.setdefault(shape_key, list(pos_enc))
+            backbone_out = {**backbone_out, "vision_pos_enc": shared_pos_enc}
+            size = tensor_bytes([*backbone_out["backbone_fpn"], backbone_out["vision_features"]])
+            key = (video_key, frame_idx)
+            if key in self.entries:
+                self.used_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (backbone_out, size)
+            self.used_bytes += size
+            while self.used_bytes > self.max_bytes and len(self.entries) > 1:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.used_bytes -= evicted_size
+
+    def remove_video(self, video_key: Hashable) -> None:
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == video_key]:
+                self.used_bytes -= self.entries.pop(key)[1]
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "frames": len(self.entries),
+                "used_bytes": self.used_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class CachedFeatures:
+    """
+    Stand-in for inference_state["cached_features"], backed by an EmbeddingCache.
+
+    SAM2 looks features up with `get(frame_idx, (None, None))` and, on a miss, assigns a new one-frame
+    dictionary to inference_state["cached_features"]; InferenceState routes that assignment to `store`.
+    Like SAM2, the most recent frame is always kept, even when admission to the shared cache is suspended
+    (see suspend_admission), so that bulk propagation does not flush the frames the user interacts with.
+    """
+
+    def __init__(self, cache: EmbeddingCache, video_key: Hashable, images, device, frame_indices: List[int] | None = None):
+        """
+        Args:
+            cache: The shared cache.
+            video_key: Key of the recording in the cache, e.g. its content hash.
+            images: inference_state["images"], to rebuild the input image of a cached frame.
+            device: Device of the inference state.
+            frame_indices: Frames of the recording the frame indices of the state refer to, if not all of them.
+        """
+        self.cache = cache
+        self.video_key = video_key
+        self.images = images
+        self.device = device
+        self.frame_indices = frame_indices
+        self.recent: Dict[int, Tuple[Any, Dict[str, Any]]] = {}
+        self.admit = True
+
+    def _video_frame(self, frame_idx: int) -> int:
+        return self.frame_indices[frame_idx] if self.frame_indices is not None else frame_idx
+
+    def get(self, frame_idx: int, default=None):
+        if frame_idx in self.recent:
+            return self.recent[frame_idx]
+        backbone_out = self.cache.get(self.video_key, self._video_frame(frame_idx))
+        if backbone_out is None:
+            return default
+        # the input image is cheap to rebuild from the frame store, unlike the features
+        image = self.images[frame_idx].to(self.device).float().unsqueeze(0)
+        self.recent = {frame_idx: (image, backbone_out)}
+        return image, backbone_out
+
+    def store(self, features: Dict[int, Tuple[Any, Dict[str, Any]]]) -> None:
+        self.recent = dict(features)
+        if self.admit:
+            for frame_idx, (_, backbone_out) in features.items():
+                self.cache.put(self.video_key, self._video_frame(frame_idx), backbone_out)
+
+    def prefetch(self, frame_idx: int, backbone_out: Dict[str, Any]) -> None:
+        """Add features computed ahead of use to the shared cache, leaving the most recent frame as is."""
+        self.cache.put(self.video_key, self._video_frame(frame_idx), backbone_out)
+
+    def __contains__(self, frame_idx: int) -> bool:
+        return frame_idx in self.recent or (self.video_key, self._video_frame(frame_idx)) in self.cache
+
+    def clear(self) -> None:
+        self.recent = {}
+
+
+class InferenceState(dict):
+    """SAM2 inference state whose "cached_features" entry stays a CachedFeatures view when SAM2 replaces it."""
+
+    def __setitem__(self, key, value):
+        current = self.get(key)
+        if key == "cached_features" and isinstance(current, CachedFeatures) and not isinstance(value, CachedFeatures):
+            current.store(value)
+            return
+        super().__setitem__(key, value)
+
+
+@contextlib.contextmanager
+def suspend_admission(inference_state):
+    """Keep the frames visited in the context (e.g. by a propagation through the whole video) out of the shared cache."""
+    features = inference_state.get("cached_features")
+    if not isinstance(features, CachedFeatures):
+        yield
+        return
+    previous, features.admit = features.admit, False
+    try:
+        yield
+    finally:
+        features.admit = previous
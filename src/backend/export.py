@@ -0,0 +1,310 @@
+import json
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+from insights import DEFAULT_PERCENTILES, compute_temporal_stats
+
+# Export of the results of a processed video (masks, histograms and per-object statistics) to columnar
+# files that other tools read directly, instead of the nested JSON lists of /process-video.
+#
+# Results are consumed frame by frame and written EXPORT_CHUNK_FRAMES frames at a time, so memory stays
+# bounded whatever the length of the recording, and each chunk can be read back on its own:
+#
+#   parquet  one row per frame and object, one row group per chunk of frames, zstd-compressed:
+#              frame_idx, obj_id, pixel_count, <stat>_c<channel> (mean, min, max and percentiles of each
+#              channel), histogram (the [N, bins] histograms of the object, flattened) and mask (the
+#              mask of the object, bit-packed in little-endian bit order). The layout (mask and histogram
+#              shapes, bin edges, object ids) is in the "thermal_studio" key of the schema metadata.
+#              Parquet files are written sequentially, so they are streamed row group by row group.
+#              A frame range is read with a filter on frame_idx, which skips the other row groups.
+#   hdf5     datasets frame_idx [F], obj_ids [C], masks [F, C, H, W] (uint8, gzip, one chunk per frame and
+#              object), pixel_count [F, C], histograms [F, N, C, bins] and stats/<stat> [F, N, C], chunked
+#              along the frames, and bin_edges [N, bins + 1]. The layout is in the "thermal_studio"
+#              attribute of the file. HDF5 files are written to disk chunk by chunk, then sent.
+
+EXPORT_FORMATS = {
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+    "hdf5": (".h5", "application/x-hdf5"),
+}
+EXPORT_CHUNK_FRAMES = 256
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # optional, only needed for Parquet exports
+    pa = None
+    pq = None
+
+try:
+    import h5py
+except ImportError:  # optional, only needed for HDF5 exports
+    h5py = None
+
+
+def check_export_format(export_format: str) -> None:
+    """
+    Raises:
+        ValueError: If the format is unknown, or the package writing it is not installed.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(EXPORT_FORMATS)}")
+    if export_format == "parquet" and pa is None:
+        raise ValueError("Exporting to Parquet requires the pyarrow package")
+    if export_format == "hdf5" and h5py is None:
+        raise ValueError("Exporting to HDF5 requires the h5py package")
+
+
+def chunk_frames(
+    frames: Iterable[Tuple[int, np.ndarray, np.ndarray | None]],
+    histogram_shape: Tuple[int, int, int] | None,
+    chunk_size: int = EXPORT_CHUNK_FRAMES,
+) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray | None]]:
+    """
+    Group the results of a sequence of frames into arrays of up to `chunk_size` frames.
+
+    Args:
+        frames: (frame_idx, masks of shape (C, H, W), histograms of shape [N, C, bins] or None) of each frame.
+        histogram_shape: Shape [N, C, bins] of the histograms, or None if the results have none. Frames
+            without histograms get empty ones.
+    Yields:
+        Tuples of (frame indices of shape [K], masks of shape [K, C, H, W], histograms of shape [K, N, C, bins] or None).
+    """
+    frame_indices = []
+    masks = []
+    histograms = []
+    for frame_idx, frame_masks, frame_histograms in frames:
+        frame_indices.append(frame_idx)
+        masks.append(frame_masks)
+        if histogram_shape is not None:
+            histograms.append(frame_histograms if frame_histograms is not None else np.zeros(histogram_shape, dtype=np.int32))
+        if len(frame_indices) == chunk_size:
+            yield np.array(frame_indices, dtype=np.int32), np.stack(masks), np.stack(histograms) if histograms else None
+            frame_indices, masks, histograms = [], [], []
+    if frame_indices:
+        yield np.array(frame_indices, dtype=np.int32), np.stack(masks), np.stack(histograms) if histograms else None
+
+
+def export_metadata(
+    obj_ids: List[int],
+    mask_shape: Tuple[int, int],
+    histogram_shape: Tuple[int, int, int] | None,
+    bin_edges: np.ndarray | None,
+    percentiles,
+    extra: Dict[str, Any] | None = None,
+) -> Dict[str, Any]:
+    """Layout of an export, for readers of the file."""
+    return {
+        "obj_ids": list(obj_ids),
+        "mask_shape": list(mask_shape),
+        "mask_packing": "bits, little-endian bit order, row-major",
+        "histogram_shape": [histogram_shape[0], histogram_shape[2]] if histogram_shape is not None else None,
+        "bin_edges": np.asarray(bin_edges).tolist() if bin_edges is not None else None,
+        "percentiles": list(percentiles),
+        "chunk_frames": EXPORT_CHUNK_FRAMES,
+        **(extra or {}),
+    }
+
+
+def pixel_counts(masks: np.ndarray) -> np.ndarray:
+    """Number of pixels of each object, of shape [K, C], of masks of shape [K, C, H, W]."""
+    return np.count_nonzero(masks.reshape(*masks.shape[:2], -1), axis=-1).astype(np.int64)
+
+
+def chunk_table(
+    frame_indices: np.ndarray,
+    masks: np.ndarray,
+    histograms: np.ndarray | None,
+    obj_ids: List[int],
+    bin_edges: np.ndarray | None,
+    percentiles,
+) -> "pa.Table":
+    """Rows of a chunk of frames, one per frame and object (see the parquet layout above)."""
+    num_frames, num_objects = masks.shape[:2]
+    columns = {
+        "frame_idx": pa.array(np.repeat(frame_indices, num_objects)),
+        "obj_id": pa.array(np.tile(np.asarray(obj_ids, dtype=np.int32), num_frames)),
+        "pixel_count": pa.array(pixel_counts(masks).reshape(-1)),
+    }
+    if histograms is not None:
+        stats = compute_temporal_stats(histograms, bin_edges, percentiles)
+        for name, values in stats.items():
+            if name == "count":
+                continue
+            for channel in range(values.shape[1]):
+                columns[f"{name}_c{channel}"] = pa.array(values[:, channel].reshape(-1))
+        # [K, N, C, bins] -> one [N, bins] histogram per row
+        per_object = np.ascontiguousarray(histograms.transpose(0, 2, 1, 3)).reshape(num_frames * num_objects, -1)
+        columns["histogram"] = pa.FixedSizeListArray.from_arrays(pa.array(per_object.reshape(-1)), per_object.shape[1])
+    packed = np.packbits(masks.reshape(num_frames * num_objects, -1) > 0, axis=-1, bitorder="little")
+    columns["mask"] = pa.FixedSizeBinaryArray.from_buffers(
+        pa.binary(packed.shape[1]), len(packed), [None, pa.py_buffer(np.ascontiguousarray(packed).tobytes())]
+    )
+    return pa.table(columns)
+
+
+class _StreamSink:
+    """Write-only file object collecting what a writer wrote since it was last drained."""
+
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def iter_parquet(
+    frames: Iterable[Tuple[int, np.ndarray, np.ndarray | None]],
+    obj_ids: List[int],
+    histogram_shape: Tuple[int, int, int] | None,
+    bin_edges: np.ndarray | None,
+    percentiles=DEFAULT_PERCENTILES,
+    metadata: Dict[str, Any] | None = None,
+) -> Iterator[bytes]:
+    """
+    Export the results of a video to Parquet, yielding the bytes of the file as each row group is written.
+
+    Args:
+        frames: (frame_idx, masks of shape (C, H, W), histograms of shape [N, C, bins] or None) of each frame.
+        obj_ids: Object ids, one for each channel of the masks.
+        histogram_shape: Shape [N, C, bins] of the histograms, or None if the results have none.
+        bin_edges: Bin edges of shape [N, bins + 1] of the histograms.
+        percentiles: Percentiles reported for each object and channel.
+        metadata: Additional entries of the layout metadata, e.g. the recording.
+    """
+    check_export_format("parquet")
+    sink = _StreamSink()
+    writer = None
+    try:
+        for frame_indices, masks, histograms in chunk_frames(frames, histogram_shape):
+            table = chunk_table(frame_indices, masks, histograms, obj_ids, bin_edges, percentiles)
+            if writer is None:
+                layout = export_metadata(obj_ids, masks.shape[2:], histogram_shape, bin_edges, percentiles, metadata)
+                schema = table.schema.with_metadata({"thermal_studio": json.dumps(layout)})
+                writer = pq.ParquetWriter(sink, schema, compression="zstd")
+            writer.write_table(table.replace_schema_metadata(writer.schema.metadata), row_group_size=len(table))
+            yield sink.drain()
+    finally:
+        if writer is not None:
+            writer.close()
+    yield sink.drain()
+
+
+def create_hdf5_datasets(f, mask_shape, histogram_shape, percentiles) -> Dict[str, Any]:
+    """Datasets of the per-frame results, empty and extensible along their first axis (the frames)."""
+    num_objects = mask_shape[0]
+    # histograms of a frame take N * C * bins * 4 bytes, e.g. 15 KiB for 3 channels of 5 objects: chunks of 64 frames stay around 1 MiB
+    histogram_chunk_frames = 64
+
+    def create(name, frame_shape, dtype, chunks, **kwargs):
+        return f.create_dataset(name, shape=(0, *frame_shape), maxshape=(None, *frame_shape), dtype=dtype, chunks=(chunks, *frame_shape), **kwargs)
+
+    datasets = {
+        "frame_idx": create("frame_idx", (), np.int32, EXPORT_CHUNK_FRAMES),
+        # one chunk per frame and object, so that a frame range of an object is read without the others
+        "masks": f.create_dataset(
+            "masks", shape=(0, *mask_shape), maxshape=(None, *mask_shape), dtype=np.uint8,
+            chunks=(1, 1, *mask_shape[1:]), compression="gzip",
+        ),
+        "pixel_count": create("pixel_count", (num_objects,), np.int64, EXPORT_CHUNK_FRAMES, compression="gzip"),
+    }
+    if histogram_shape is not None:
+        datasets["histograms"] = create("histograms", histogram_shape, np.int32, histogram_chunk_frames, compression="gzip")
+        stats_shape = histogram_shape[:2]
+        for name in ["mean", "min", "max"] + [f"p{percentile:g}" for percentile in percentiles]:
+            datasets[f"stats/{name}"] = create(f"stats/{name}", stats_shape, np.float64, EXPORT_CHUNK_FRAMES, compression="gzip")
+    return datasets
+
+
+def write_hdf5(
+    path: Path,
+    frames: Iterable[Tuple[int, np.ndarray, np.ndarray | None]],
+    obj_ids: List[int],
+    histogram_shape: Tuple[int, int, int] | None,
+    bin_edges: np.ndarray | None,
+    percentiles=DEFAULT_PERCENTILES,
+    metadata: Dict[str, Any] | None = None,
+) -> int:
+    """
+    Export the results of a video to an HDF5 file, EXPORT_CHUNK_FRAMES frames at a time (see export_results for the arguments).
+
+    Returns:
+        The number of frames written.
+    """
+    check_export_format("hdf5")
+    num_written = 0
+    with h5py.File(path, "w") as f:
+        f.create_dataset("obj_ids", data=np.asarray(obj_ids, dtype=np.int32))
+        if bin_edges is not None:
+            f.create_dataset("bin_edges", data=np.asarray(bin_edges, dtype=np.float64))
+        datasets = None
+        for frame_indices, masks, histograms in chunk_frames(frames, histogram_shape):
+            if datasets is None:
+                f.attrs["thermal_studio"] = json.dumps(export_metadata(obj_ids, masks.shape[2:], histogram_shape, bin_edges, percentiles, metadata))
+                datasets = create_hdf5_datasets(f, masks.shape[1:], histograms.shape[1:] if histograms is not None else None, percentiles)
+            count = len(frame_indices)
+            rows = {"frame_idx": frame_indices, "masks": (masks > 0).astype(np.uint8), "pixel_count": pixel_counts(masks)}
+            if histograms is not None:
+                rows["histograms"] = histograms
+                stats = compute_temporal_stats(histograms, bin_edges, percentiles)
+                rows.update({f"stats/{name}": values for name, values in stats.items() if name != "count"})
+            for name, values in rows.items():
+                datasets[name].resize(num_written + count, axis=0)
+                datasets[name][num_written:num_written + count] = values
+            num_written += count
+    return num_written
+
+
+def export_results(
+    path: Path,
+    export_format: str,
+    frames: Iterable[Tuple[int, np.ndarray, np.ndarray | None]],
+    obj_ids: List[int],
+    histogram_shape: Tuple[int, int, int] | None,
+    bin_edges: np.ndarray | None,
+    percentiles=DEFAULT_PERCENTILES,
+    metadata: Dict[str, Any] | None = None,
+) -> None:
+    """
+    Export the results of a video to a Parquet or HDF5 file, a chunk of frames at a time.
+
+    Args:
+        path: The file to write.
+        export_format: "parquet" or "hdf5".
+        frames: (frame_idx, masks of shape (C, H, W), histograms of shape [N, C, bins] or None) of each
+            frame, e.g. CacheEntry.iter_frames() of the mask cache.
+        obj_ids: Object ids, one for each channel of the masks.
+        histogram_shape: Shape [N, C, bins] of the histograms, or None if the results have none.
+        bin_edges: Bin edges of shape [N, bins + 1] of the histograms.
+        percentiles: Percentiles reported for each object and channel.
+        metadata: Additional entries of the layout metadata, e.g. the recording.
+    Raises:
+        ValueError: If the format is unknown, or the package writing it is not installed.
+    """
+    check_export_format(export_format)
+    if export_format == "hdf5":
+        write_hdf5(path, frames, obj_ids, histogram_shape, bin_edges, percentiles, metadata)
+        return
+    with open(path, "wb") as f:
+        for data in iter_parquet(frames, obj_ids, histogram_shape, bin_edges, percentiles, metadata):
+            f.write(data)
@@ -0,0 +1,201 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+import cv2
+import numpy as np
+
+from frame_store import THUMBNAIL_HEIGHT, FrameStore, make_thumbnail
+
+# Encoded images of single frames and thumbnail strips, served by /frames/{video}/...
+#
+# Frames are read from the frame store of a recording, which is decoded once at upload and gives every
+# frame in constant time, so a frame costs a memory copy and its encoding wherever the user jumps. The
+# encoded images are kept in an LRU cache bounded in bytes, since the results view requests the same
+# frames again as the user scrubs back and forth. An image only depends on the content of the recording
+# and the options it was encoded with, which make its ETag: responses can be cached by the browser for
+# good and revalidated without a body.
+
+IMAGE_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg"),
+    "png": (".png", "image/png"),
+}
+DEFAULT_FORMAT = "jpeg"
+DEFAULT_QUALITY = 85
+MAX_STRIP_FRAMES = 256
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def get_image_options(query) -> Dict[str, Any]:
+    """
+    Image options of a request from its query parameters: format (jpeg or png), quality (of JPEG images) and height.
+
+    Raises:
+        ValueError: If an option is invalid.
+    """
+    image_format = query.get("format", DEFAULT_FORMAT).lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"format must be one of {', '.join(IMAGE_FORMATS)}")
+    quality = int(query.get("quality", DEFAULT_QUALITY))
+    if not 1 <= quality <= 100:
+        raise ValueError("quality must be between 1 and 100")
+    height = int(query["height"]) if query.get("height") else None
+    if height is not None and height < 1:
+        raise ValueError("height must be positive")
+    return {"format": image_format, "quality": quality, "height": height}
+
+
+def get_strip_range(query, num_frames: int) -> Tuple[int, int, int]:
+    """
+    Frames of a thumbnail strip from the query parameters of a request: start, count and step.
+
+    Raises:
+        ValueError: If the range is invalid or outside of the recording.
+    """
+    start = int(query.get("start", 0))
+    step = int(query.get("step", 1))
+    count = int(query.get("count", min(num_frames, MAX_STRIP_FRAMES)))
+    if step < 1:
+        raise ValueError("step must be positive")
+    if not 0 <= start < num_frames:
+        raise ValueError(f"start must be a frame of the recording, between 0 and {num_frames - 1}")
+    count = min(count, (num_frames - 1 - start) // step + 1)
+    if not 1 <= count <= MAX_STRIP_FRAMES:
+        raise ValueError(f"count must be between 1 and {MAX_STRIP_FRAMES}")
+    return start, count, step
+
+
+def resize_to_height(image: np.ndarray, height: int | None) -> np.ndarray:
+    """Downscale an image to a height, keeping its aspect ratio. Images are never upscaled."""
+    if height is None or height >= image.shape[0]:
+        return image
+    width = max(1, round(image.shape[1] * height / image.shape[0]))
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+
+def encode_image(image: np.ndarray, image_options: Dict[str, Any]) -> bytes:
+    extension, _ = IMAGE_FORMATS[image_options["format"]]
+    params = [cv2.IMWRITE_JPEG_QUALITY, image_options["quality"]] if image_options["format"] == "jpeg" else []
+    ok, buffer = cv2.imencode(extension, image, params)
+    if not ok:
+        raise RuntimeError(f"Could not encode a {image_options['format']} image")
+    return buffer.tobytes()
+
+
+def encode_frame_image(frames, frame_idx: int, image_options: Dict[str, Any]) -> bytes:
+    """
+    Encode a frame of a recording, downscaled to the requested height.
+
+    Args:
+        frames: The FrameStore of the recording, or a FrameReader of recordings without one.
+    """
+    frame = frames.read(frame_idx)
+    if frame is None:
+        raise IndexError(f"The recording has no frame {frame_idx}")
+    # thumbnails of the store are as good as the frame itself at their height, and smaller to resize
+    if isinstance(frames, FrameStore) and image_options["height"] is not None and image_options["height"] <= THUMBNAIL_HEIGHT:
+        frame = frames.thumbnail(frame_idx)
+    return encode_image(resize_to_height(frame, image_options["height"]), image_options)
+
+
+def encode_thumbnail_strip(frames, start: int, count: int, step: int, image_options: Dict[str, Any]) -> bytes:
+    """
+    Encode the thumbnails of frames start, start + step, ... side by side, left to right, as one image.
+
+    Thumbnails are THUMBNAIL_HEIGHT pixels high, or less with a smaller requested height.
+    """
+    thumbnails = []
+    for frame_idx in range(start, start + count * step, step):
+        if isinstance(frames, FrameStore):
+            thumbnail = frames.thumbnail(frame_idx)
+        else:
+            frame = frames.read(frame_idx)
+            if frame is None:
+                raise IndexError(f"The recording has no frame {frame_idx}")
+            thumbnail = make_thumbnail(frame)
+        thumbnails.append(resize_to_height(thumbnail, image_options["height"]))
+    return encode_image(np.hstack(thumbnails), image_options)
+
+
+def make_etag(video_key: str, *parts: Any) -> str:
+    """Strong ETag of an image of a recording, from the content hash of the recording (or its id) and the request that made it."""
+    digest = hashlib.sha256("/".join(str(part) for part in (video_key,) + parts).encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+
+def parse_range(range_header: str | None, size: int) -> Tuple[int, int] | None:
+    """
+    First and last byte of a single-range Range header.
+
+    Returns:
+        The range, or None for requests of the whole body: without a Range header, or with one that is
+        not a single byte range, which servers may ignore.
+    Raises:
+        ValueError: If the range is not satisfiable.
+    """
+    match = RANGE_PATTERN.match(range_header.strip()) if range_header else None
+    if match is None or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first == "":
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    first = int(first)
+    last = min(int(last), size - 1) if last else size - 1
+    if first >= size or last < first:
+        raise ValueError(f"Range {range_header} is outside of {size} bytes")
+    return first, last
+
+
+class ImageCache:
+    """LRU cache of encoded images, keyed by ETag, bounded by the total size of the images."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.images: OrderedDict[str, bytes] = OrderedDict()
+        self.used_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> bytes | None:
+        with self.lock:
+            image = self.images.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self.images.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key: str, image: bytes) -> None:
+        if len(image) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.images.pop(key, None)
+            if previous is not None:
+                self.used_bytes -= len(previous)
+            self.images[key] = image
+            self.used_bytes += len(image)
+            while self.used_bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.used_bytes -= len(evicted)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"images": len(self.images), "used_bytes": self.used_bytes, "hits": self.hits, "misses": self.misses}
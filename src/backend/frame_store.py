@@ -0,0 +1,455 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+import cv2
+import numpy as np
+
+import radiometric
+
+logger = logging.getLogger(__name__)
+
+# Decode-once frame store of a recording.
+#
+# A recording is decoded a single time, when it is uploaded, into a directory of raw uint8 arrays:
+#
+#   meta.json        num_frames, height, width, fps, image_size, video_hash (SHA-256 of the recording),
+#                    thumbnail_size ([width, height] of the thumbnails)
+#   frames.raw       uint8[num_frames, height, width, 3]          frames as decoded by cv2 (BGR), for analytics and SAM2
+#   thumbnails.raw   uint8[num_frames, th, tw, 3]                 BGR thumbnails THUMBNAIL_HEIGHT pixels high, for
+#                                                                 thumbnail strips of any range of the recording
+#
+# The arrays are memory-mapped read-only by their consumers, so frames are shared through the page
+# cache rather than decoded and held in memory by every consumer. meta.json is written last: a store
+# without it is incomplete.
+#
+# The store of a radiometric stack (see radiometric.py) holds the normalized 8-bit view of the stack in
+# both arrays, and meta.json describes the stack under "radiometric": its path and layout, the range of
+# its values and the display range of the 8-bit view. The stack itself is memory-mapped in place, for
+# analytics in the native domain.
+#
+# SAM2 reads its input frames through a FrameWindow (read_sam_frame): a bounded window of converted frames
+# around the frame being prompted or propagated, read ahead in the direction of propagation. Frames are
+# resized to the input size of SAM2 (image_size) as they are read, rather than stored at that size, which
+# would take 3 MiB per frame at the default input size. They are read with pread rather than through the
+# memory map, so that a propagation through a long recording does not leave the pages of all its frames
+# mapped in the process.
+#
+# Stores take 3 bytes per pixel of each frame, plus its thumbnail (about 0.9 MiB per frame at 640x480,
+# 6 MiB at 1920x1080), so their total size is capped
+# (enforce_stores_size_limit): the least recently used stores beyond it are evicted. An evicted store keeps its
+# metadata, as evicted.json, so that its recording can still be described and decoded again on next use.
+
+# Height of the thumbnails of the frames
+THUMBNAIL_HEIGHT = 64
+
+# Metadata of a store whose frames were evicted
+EVICTED_META = "evicted.json"
+
+# Frames resized to the input size of SAM2, which stores kept before frames were resized as they are read
+LEGACY_SAM_FRAMES = "sam_frames.raw"
+
+# Read-ahead of the frame windows of all stores runs on a single background thread
+read_ahead_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="frame-read-ahead")
+
+
+def thumbnail_size(width: int, height: int) -> Tuple[int, int]:
+    """(width, height) of the thumbnails of frames of a given size."""
+    return max(1, round(width * THUMBNAIL_HEIGHT / max(height, 1))), THUMBNAIL_HEIGHT
+
+
+def make_thumbnail(frame: np.ndarray) -> np.ndarray:
+    return cv2.resize(frame, thumbnail_size(frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_AREA)
+
+
+class FrameStore:
+    """Read-only view of the frame store of a recording. Frames are returned zero-copy, as views of the memory maps."""
+
+    def __init__(self, store_dir: Path):
+        with open(store_dir / "meta.json") as f:
+            self.meta: Dict[str, Any] = json.load(f)
+        self.store_dir = store_dir
+        self.file_path = str(store_dir)  # for log messages, like FrameReader.file_path
+        self.num_frames: int = self.meta["num_frames"]
+        self.height: int = self.meta["height"]
+        self.width: int = self.meta["width"]
+        self.image_size: int = self.meta["image_size"]
+        self.video_hash: str | None = self.meta.get("video_hash")
+        self.frames = self._map("frames.raw", (self.height, self.width))
+        self.radiometric_meta: Dict[str, Any] | None = self.meta.get("radiometric")
+        self.radiometric = None
+        if self.radiometric_meta is not None:
+            self.radiometric = radiometric.open_stack(self.radiometric_meta["path"], self.radiometric_meta["source"])
+        self.frame_bytes = self.height * self.width * 3
+        # stores created before thumbnails were added have none; they are then made from the frames
+        self.thumbnail_size: Tuple[int, int] | None = tuple(self.meta["thumbnail_size"]) if "thumbnail_size" in self.meta else None
+        self.thumbnails = self._map("thumbnails.raw", self.thumbnail_size[::-1]) if self.thumbnail_size is not None else None
+        self.frames_file = open(store_dir / "frames.raw", "rb", buffering=0) if self.num_frames else None
+        (store_dir / LEGACY_SAM_FRAMES).unlink(missing_ok=True)
+
+    def _map(self, name: str, frame_shape) -> np.ndarray:
+        shape = (self.num_frames, *frame_shape, 3)
+        if self.num_frames == 0:
+            return np.zeros(shape, dtype=np.uint8)
+        return np.memmap(self.store_dir / name, dtype=np.uint8, mode="r", shape=shape)
+
+    def is_opened(self) -> bool:
+        return self.frames is not None
+
+    def read(self, frame_idx: int) -> np.ndarray | None:
+        """Read a frame as decoded by cv2 (same interface as insights.FrameReader), or None if there is no such frame."""
+        if not 0 <= frame_idx < self.num_frames:
+            return None
+        return self.frames[frame_idx]
+
+    def thumbnail(self, frame_idx: int) -> np.ndarray:
+        """BGR thumbnail of a frame, THUMBNAIL_HEIGHT pixels high."""
+        if self.thumbnails is not None:
+            return self.thumbnails[frame_idx]
+        return make_thumbnail(self.frames[frame_idx])
+
+    def read_sam_frame(self, frame_idx: int) -> np.ndarray:
+        """Read a frame resized for SAM2, of shape (image_size, image_size, 3), RGB, as a copy rather than a view of the memory map."""
+        data = os.pread(self.frames_file.fileno(), self.frame_bytes, frame_idx * self.frame_bytes)
+        frame = np.frombuffer(data, dtype=np.uint8).reshape(self.height, self.width, 3)
+        return cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB), (self.image_size, self.image_size))
+
+    def read_radiometric(self, frame_idx: int) -> np.ndarray | None:
+        """Read a frame of the radiometric stack, in its native data type, or None if there is no such frame."""
+        if self.radiometric is None or not 0 <= frame_idx < self.num_frames:
+            return None
+        return self.radiometric[frame_idx]
+
+    def histogram_range(self) -> Tuple[float, float] | None:
+        """Half-open range of the values of the radiometric stack, or None for 8-bit recordings."""
+        if self.radiometric_meta is None:
+            return None
+        return tuple(self.radiometric_meta["histogram_range"])
+
+    def release(self) -> None:
+        """
+        Close the file read by read_sam_frame and drop the memory maps, which are unmapped once the frames
+        returned from them are no longer used. A store is shared, e.g. by the sessions of re-uploads: it is
+        released once none of them uses it (see sessions.SessionRegistry.release_frame_store).
+        """
+        if self.frames_file is not None:
+            self.frames_file.close()
+            self.frames_file = None
+        self.frames = self.thumbnails = self.radiometric = None
+
+    def video_info(self) -> Dict[str, Any]:
+        return meta_video_info(self.meta)
+
+    def touch(self) -> None:
+        """Mark the store as recently used, for enforce_stores_size_limit."""
+        try:
+            os.utime(self.store_dir / "meta.json")
+        except FileNotFoundError:  # evicted while open; its memory maps stay valid
+            pass
+
+    @classmethod
+    def recreate(cls, store_dir: Path, video_path: str, image_size: int, meta: Dict[str, Any]) -> "FrameStore":
+        """Decode a recording again into the store it had before it was evicted, with the metadata it had (see evicted_meta)."""
+        if meta.get("radiometric") is not None:
+            return cls.create_from_stack(
+                store_dir, video_path, image_size, meta["video_hash"], meta["radiometric"]["source"], meta["fps"]
+            )
+        return cls.create(store_dir, video_path, image_size, meta["video_hash"])
+
+    @classmethod
+    def open(cls, store_dir: Path) -> "FrameStore | None":
+        """Open a complete store, or return None if there is none."""
+        if not (store_dir / "meta.json").is_file():
+            return None
+        return cls(store_dir)
+
+    @classmethod
+    def create(cls, store_dir: Path, video_path: str, image_size: int, video_hash: str | None = None) -> "FrameStore":
+        """
+        Decode a recording, streaming each frame into a new store.
+
+        Args:
+            store_dir: Directory of the store; replaced if it exists.
+            video_path: Path of the recording.
+            image_size: Side of the square frames SAM2 consumes.
+            video_hash: Content hash of the recording, kept in the metadata to recognize re-uploads.
+        Returns:
+            The created store.
+        Raises:
+            ValueError: If the recording cannot be opened.
+        """
+        cap = cv2.VideoCapture(str(video_path))
+        if not cap.isOpened():
+            raise ValueError(f"Could not open video file {video_path}")
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        tmp_dir = store_dir.with_name(f"{store_dir.name}.tmp-{uuid.uuid4().hex}")
+        tmp_dir.mkdir(parents=True)
+        num_frames = 0
+        height = width = 0
+        try:
+            with open(tmp_dir / "frames.raw", "wb") as frames_file, open(tmp_dir / "thumbnails.raw", "wb") as thumbnails_file:
+                while True:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    if frame.ndim == 2:
+                        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+                    if num_frames == 0:
+                        height, width = frame.shape[:2]
+                    frames_file.write(np.ascontiguousarray(frame).data)
+                    thumbnails_file.write(make_thumbnail(frame).data)
+                    num_frames += 1
+            with open(tmp_dir / "meta.json", "w") as f:
+                json.dump({
+                    "num_frames": num_frames,
+                    "height": height,
+                    "width": width,
+                    "fps": fps,
+                    "image_size": image_size,
+                    "video_hash": video_hash,
+                    "thumbnail_size": thumbnail_size(width, height),
+                }, f)
+            cls.remove(store_dir)
+            os.rename(tmp_dir, store_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        finally:
+            cap.release()
+        logger.info(f"Decoded {num_frames} frames of {width}x{height} into {store_dir}")
+        return cls(store_dir)
+
+    @classmethod
+    def create_from_stack(
+        cls,
+        store_dir: Path,
+        stack_path: str,
+        image_size: int,
+        video_hash: str | None = None,
+        source: Dict[str, Any] | None = None,
+        fps: float = 0.0,
+    ) -> "FrameStore":
+        """
+        Create the store of a radiometric stack: its normalized 8-bit view, for SAM2 and display.
+
+        Args:
+            store_dir: Directory of the store; replaced if it exists.
+            stack_path: Path of the stack, memory-mapped in place by the store.
+            image_size: Side of the square frames SAM2 consumes.
+            video_hash: Hash of the stack and its layout (see radiometric.layout_hash), kept in the metadata to recognize re-uploads.
+            source: Layout of headerless .raw stacks (see radiometric.open_stack).
+            fps: Frame rate of the stack, which the file formats do not record.
+        Returns:
+            The created store.
+        Raises:
+            ValueError: If the stack cannot be read.
+        """
+        stack = radiometric.open_stack(stack_path, source)
+        num_frames, height, width = stack.shape
+        view_range = radiometric.display_range(stack)
+        tmp_dir = store_dir.with_name(f"{store_dir.name}.tmp-{uuid.uuid4().hex}")
+        tmp_dir.mkdir(parents=True)
+        value_min, value_max = np.inf, -np.inf
+        try:
+            with open(tmp_dir / "frames.raw", "wb") as frames_file, open(tmp_dir / "thumbnails.raw", "wb") as thumbnails_file:
+                for frame in stack:
+                    value_min = min(value_min, float(frame.min()))
+                    value_max = max(value_max, float(frame.max()))
+                    view = cv2.cvtColor(radiometric.to_uint8(frame, view_range), cv2.COLOR_GRAY2BGR)
+                    frames_file.write(view.data)
+                    thumbnails_file.write(make_thumbnail(view).data)
+            with open(tmp_dir / "meta.json", "w") as f:
+                json.dump({
+                    "num_frames": num_frames,
+                    "height": height,
+                    "width": width,
+                    "fps": fps,
+                    "image_size": image_size,
+                    "video_hash": video_hash,
+                    "thumbnail_size": thumbnail_size(width, height),
+                    "radiometric": {
+                        "path": str(stack_path),
+                        "source": source or {},
+                        "dtype": str(stack.dtype),
+                        "value_min": value_min,
+                        "value_max": value_max,
+                        "histogram_range": radiometric.histogram_range(value_min, value_max, stack.dtype),
+                        "display_range": view_range,
+                    },
+                }, f)
+            cls.remove(store_dir)
+            os.rename(tmp_dir, store_dir)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        logger.info(f"Prepared {num_frames} radiometric frames of {width}x{height} ({stack.dtype}) into {store_dir}")
+        return cls(store_dir)
+
+    @staticmethod
+    def remove(store_dir: Path) -> None:
+        """Remove a store, or only the link of a store shared with another upload (see `link`)."""
+        if store_dir.is_symlink():
+            store_dir.unlink()
+        else:
+            shutil.rmtree(store_dir, ignore_errors=True)
+
+    def link(self, store_dir: Path) -> None:
+        """Make this store available under another directory of the same parent, e.g. for a re-upload of its recording."""
+        FrameStore.remove(store_dir)
+        os.symlink(self.store_dir.resolve().name, store_dir, target_is_directory=True)
+
+
+class FrameWindow:
+    """
+    Bounded window of converted frames (e.g. normalized input tensors of SAM2), with read-ahead.
+
+    Frames are converted on demand by `read` and at most `size` of them are kept, least recently used
+    first out. After an access, the next `read_ahead` frames are converted in the background: ahead of
+    the accessed frame when frames are accessed in sequence (in either direction, like a propagation),
+    and on both sides of it after a jump (like a prompt on another frame). Memory is therefore bounded by
+    the window, whatever the length of the recording.
+    """
+
+    def __init__(self, read: Callable[[int], Any], num_frames: int, size: int, read_ahead: int):
+        """
+        Args:
+            read: Reads and converts a frame, from any thread.
+            num_frames: Number of frames.
+            size: Maximum number of frames kept.
+            read_ahead: Number of frames read ahead of an access; capped below `size`.
+        """
+        self.read = read
+        self.num_frames = num_frames
+        self.size = max(size, 1)
+        self.read_ahead = max(min(read_ahead, self.size - 1), 0)
+        self.frames: OrderedDict[int, Any] = OrderedDict()
+        self.scheduled: set = set()
+        self.last_frame_idx: int | None = None
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.num_frames
+
+    def __getitem__(self, frame_idx: int) -> Any:
+        with self.lock:
+            frame = self.frames.get(frame_idx)
+            if frame is not None:
+                self.frames.move_to_end(frame_idx)
+            self._schedule_read_ahead(frame_idx)
+        if frame is None:
+            frame = self.read(frame_idx)
+            self._add(frame_idx, frame)
+        return frame
+
+    def _add(self, frame_idx: int, frame: Any) -> None:
+        with self.lock:
+            self.frames[frame_idx] = frame
+            self.frames.move_to_end(frame_idx)
+            while len(self.frames) > self.size:
+                self.frames.popitem(last=False)
+
+    def _schedule_read_ahead(self, frame_idx: int) -> None:
+        """Queue the conversion of the frames likely to be accessed next. Called with the lock held."""
+        step = frame_idx - self.last_frame_idx if self.last_frame_idx is not None else 0
+        self.last_frame_idx = frame_idx
+        if step in (1, -1):
+            candidates = [frame_idx + step * distance for distance in range(1, self.read_ahead + 1)]
+        else:
+            candidates = [frame_idx + sign * distance for distance in range(1, self.read_ahead // 2 + 1) for sign in (1, -1)]
+        candidates = [
+            idx for idx in candidates
+            if 0 <= idx < self.num_frames and idx not in self.frames and idx not in self.scheduled
+        ]
+        if candidates:
+            self.scheduled.update(candidates)
+            read_ahead_executor.submit(self._read_ahead, candidates)
+
+    def _read_ahead(self, frame_indices) -> None:
+        for frame_idx in frame_indices:
+            try:
+                with self.lock:
+                    # the window moved on, e.g. the user jumped to another frame
+                    if self.last_frame_idx is not None and abs(frame_idx - self.last_frame_idx) > self.read_ahead:
+                        continue
+                    if frame_idx in self.frames:
+                        continue
+                self._add(frame_idx, self.read(frame_idx))
+            except Exception as e:
+                logger.warning(f"Could not read frame {frame_idx} ahead: {e}")
+            finally:
+                with self.lock:
+                    self.scheduled.discard(frame_idx)
+
+
+def meta_video_info(meta: Dict[str, Any]) -> Dict[str, Any]:
+    """Properties of a recording (frames, fps, width, height, and the range of the values of stacks) from the metadata of its store."""
+    video_info = {"frames": meta["num_frames"], "fps": meta["fps"], "width": meta["width"], "height": meta["height"]}
+    if meta.get("radiometric") is not None:
+        video_info["radiometric"] = {
+            key: meta["radiometric"][key] for key in ("dtype", "value_min", "value_max", "histogram_range")
+        }
+    return video_info
+
+
+def evicted_meta(store_dir: Path) -> Dict[str, Any] | None:
+    """Metadata of an evicted store, or None if the store was not evicted."""
+    try:
+        with open(store_dir / EVICTED_META) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def read_store_meta(store_dir: Path) -> Dict[str, Any] | None:
+    """Metadata of a complete or evicted store, without opening it, or None if there is no such store."""
+    try:
+        with open(store_dir / "meta.json") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return evicted_meta(store_dir)
+
+
+def evict(store_dir: Path) -> None:
+    """Remove the frames of a store, keeping its metadata as evicted.json. The store is incomplete from the first step on."""
+    os.replace(store_dir / "meta.json", store_dir / EVICTED_META)
+    for path in store_dir.iterdir():
+        if path.name != EVICTED_META:
+            path.unlink(missing_ok=True)
+
+
+def enforce_stores_size_limit(frames_dir: Path, max_bytes: int, in_use: Set[str]) -> List[str]:
+    """
+    Evict the least recently used stores under `frames_dir` until they fit in `max_bytes`.
+
+    Args:
+        in_use: Names of stores that must not be evicted.
+    Returns:
+        The names of the evicted stores.
+    """
+    stores = []
+    for store_dir in frames_dir.iterdir():
+        meta_path = store_dir / "meta.json"
+        # links of re-uploads are counted and evicted with the store they link to
+        if ".tmp-" in store_dir.name or store_dir.is_symlink() or not meta_path.is_file():
+            continue
+        size = sum(f.stat().st_size for f in store_dir.iterdir() if f.is_file())
+        stores.append((meta_path.stat().st_mtime, store_dir, size))
+    total = sum(size for _, _, size in stores)
+    evicted = []
+    for _, store_dir, size in sorted(stores, key=lambda store: store[0]):
+        if total <= max_bytes:
+            break
+        if store_dir.name in in_use:
+            continue
+        logger.info(f"Evicting frame store {store_dir.name} ({size / 2**20:.1f} MiB)")
+        evict(store_dir)
+        evicted.append(store_dir.name)
+        total -= size
+    return evicted
@@ -0,0 +1,101 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Iterator
+
+from metrics import record_stage
+
+logger = logging.getLogger(__name__)
+
+
+class InferenceQueueFull(Exception):
+    """Raised when a job is submitted while the inference queue is at its depth limit."""
+
+
+class InferencePool:
+    """
+    Bounded pool of worker threads that run the SAM2 model off the event loop.
+
+    At most `max_workers` model calls run at once; admitted jobs beyond that wait in the queue.
+    A job is admitted with `admit()`, which fails with InferenceQueueFull when `max_queued` jobs
+    are already waiting, so that the server can reject excess work instead of piling it up.
+    Within an admitted job, blocking model calls are submitted with `run()` and model generators
+    are stepped with `iterate()`. The model is shared by all workers; concurrent work on the same
+    inference state must be prevented by the caller (see Session.lock). Calls run in the context of
+    their caller, so that stages they time are attributed to its request (see metrics.py).
+    """
+
+    def __init__(self, max_workers: int, max_queued: int, initializer: Callable[[], Any] | None = None):
+        """
+        Args:
+            max_workers: Number of worker threads, i.e. of jobs running at once.
+            max_queued: Number of admitted jobs allowed to wait for a worker.
+            initializer: Called in each worker thread when it starts, e.g. to enter thread-local
+                torch contexts such as autocast.
+        """
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="inference", initializer=initializer)
+        self.pending = 0  # admitted jobs, running or waiting
+
+    @property
+    def queued(self) -> int:
+        return max(0, self.pending - self.max_workers)
+
+    @property
+    def full(self) -> bool:
+        return self.pending >= self.max_workers + self.max_queued
+
+    @contextlib.asynccontextmanager
+    async def admit(self):
+        """Admit a job into the queue for the duration of the context, or raise InferenceQueueFull."""
+        if self.full:
+            raise InferenceQueueFull(f"Inference queue is full ({self.pending} jobs pending)")
+        self.pending += 1
+        try:
+            yield
+        finally:
+            self.pending -= 1
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run a blocking call on a worker thread and wait for its result."""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        submitted_at = time.perf_counter()
+
+        def call():
+            record_stage("inference_queue", time.perf_counter() - submitted_at)
+            return fn(*args, **kwargs)
+
+        return await loop.run_in_executor(self.executor, context.run, call)
+
+    async def iterate(self, iterator: Iterator[Any]) -> AsyncIterator[Any]:
+        """
+        Step a blocking iterator (e.g. SAM2's propagate_in_video) on the worker threads.
+
+        Each item is computed on a worker while the event loop keeps serving other requests.
+        If the consumer stops early, the iterator is closed once its current step finished.
+        """
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        exhausted = object()
+        step = None
+        try:
+            while True:
+                step = loop.run_in_executor(self.executor, context.run, next, iterator, exhausted)
+                item = await asyncio.shield(step)
+                if item is exhausted:
+                    return
+                yield item
+        finally:
+            if step is not None and not step.done():
+                # a generator cannot be closed while a worker is executing it
+                await asyncio.wait([step])
+            if hasattr(iterator, "close"):
+                await loop.run_in_executor(self.executor, iterator.close)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,4 +1,5 @@
-from typing import Dict, Any
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+import functools
 import cv2
 import numpy as np
 import logging
@@ -34,69 +35,417 @@ def compute_histograms(masks_dict: Dict[int, np.ndarray], file_path: str = None,
     logger.debug(f"Computing histograms for {len(masks_dict)} frames")
     logger.debug(f"File path: {file_path}")
     
-    # Open the video file
-    cap = cv2.VideoCapture(file_path)
-    if not cap.isOpened():
-        logger.error(f"Failed to open video file: {file_path}")
-        return {"histograms": {}, "bin_edges": None}
-    
-    bin_edges = np.arange(257)
     # Initialize the result dictionary
     result = {
         "histograms": {},
-        "bin_edges": bin_edges.reshape(1, 257).repeat(3, axis=0)
+        "bin_edges": histogram_bin_edges()
     }
-    
-    # Process each frame
-    frame_idx = 0
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        if len(frame.shape) == 2:
-            frame = frame[:, :, np.newaxis]
-        
-        if convert_to_monochrome:
-            frame = _convert_to_monochrome(frame)
-        # frame.shape = (H, W, 1)
-        
-        # Check if this frame has a corresponding mask
-        if frame_idx in masks_dict:
-            # Get the mask for this frame
-            mask = masks_dict[frame_idx]
-
-            # Get the number of objects in the mask
-            num_objects = mask.shape[0]
-            
-            # Initialize histograms for this frame
-            frame_histograms = np.zeros((frame.shape[2], num_objects, 256), dtype=np.int32)
-            
-            # For each channel in the mask (each object)
-            for obj_idx in range(mask.shape[0]):
-                # Get the binary mask for this object
-                obj_mask = mask[obj_idx]
-                
-                # Apply the mask to the frame (resulting in unraveled values)
-                object_pixels = frame[obj_mask>0]
-                # object_pixels.shape = (num_pixels_in_the_object, 3)
-
-                # Calculate histograms for each color channel
-                for channel in range(object_pixels.shape[1]):  # BGR channels
-                    hist, _ = np.histogram(object_pixels[:, channel], bins=bin_edges)
-                    frame_histograms[channel, obj_idx] = hist
-            
+
+    with FrameReader(file_path) as frames:
+        if not frames.is_opened():
+            logger.error(f"Failed to open video file: {file_path}")
+            return {"histograms": {}, "bin_edges": None}
+
+        # Only frames that have a corresponding mask are retrieved, in increasing order
+        for frame_idx in sorted(masks_dict):
+            frame = frames.read(frame_idx)
+            if frame is None:
+                break
             # Store the histograms for this frame
-            result["histograms"][frame_idx] = frame_histograms
-        
-        frame_idx += 1
-    
-    # Release the video capture
-    cap.release()
+            result["histograms"][frame_idx] = compute_frame_histograms(frame, masks_dict[frame_idx], convert_to_monochrome)
     
     logger.debug(f"Computed histograms for {len(result['histograms'])} frames")
     return result
 
+class FrameReader:
+    """
+    Reader of the frames of a recording, shared by all consumers of a processing run.
+
+    Requesting frames in increasing order decodes each frame once: frames that are skipped over are
+    only grabbed, not retrieved. Requesting an earlier frame, or one far ahead, seeks the capture.
+    """
+
+    # Grab forward up to this many frames instead of seeking
+    MAX_GRAB_DISTANCE = 64
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.cap = cv2.VideoCapture(file_path)
+        self.next_frame_idx = 0
+
+    def __enter__(self) -> "FrameReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+    def is_opened(self) -> bool:
+        return self.cap.isOpened()
+
+    def read(self, frame_idx: int) -> np.ndarray | None:
+        """
+        Read a frame of the recording.
+
+        Args:
+            frame_idx: The index of the frame to read.
+        Returns:
+            The frame as decoded by cv2, or None if the recording has no such frame.
+        """
+        if frame_idx < self.next_frame_idx or frame_idx - self.next_frame_idx > self.MAX_GRAB_DISTANCE:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+            self.next_frame_idx = frame_idx
+
+        while self.next_frame_idx < frame_idx:
+            if not self.cap.grab():
+                return None
+            self.next_frame_idx += 1
+
+        ret, frame = self.cap.read()
+        if not ret:
+            return None
+        self.next_frame_idx += 1
+        return frame
+
+    def release(self) -> None:
+        self.cap.release()
+
+# Default binning: one bin per 8-bit intensity
+DEFAULT_BINS = 256
+DEFAULT_VALUE_RANGE = (0, 256)
+
+def histogram_bin_edges(bins: int = DEFAULT_BINS, value_range=DEFAULT_VALUE_RANGE, num_channels: int = 3) -> np.ndarray:
+    """Bin edges common to all histograms, an array of shape [num_channels, bins + 1] (by default [3, 257])."""
+    if (bins, tuple(value_range)) == (DEFAULT_BINS, DEFAULT_VALUE_RANGE):
+        edges = np.arange(257)
+    else:
+        edges = np.linspace(value_range[0], value_range[1], bins + 1)
+    return edges.reshape(1, -1).repeat(num_channels, axis=0)
+
+def compute_frame_histograms(
+    frame: np.ndarray,
+    mask: np.ndarray,
+    convert_to_monochrome: bool = False,
+    bins: int = DEFAULT_BINS,
+    value_range=DEFAULT_VALUE_RANGE,
+) -> np.ndarray:
+    """
+    Compute histograms of all objects in a single frame.
+
+    Args:
+        frame: The frame as decoded by cv2, of shape [H, W, 3], [H, W, 1] or [H, W], or a single-channel
+            radiometric frame of type uint16 or float32.
+        mask: Masks of all objects in the frame, of shape (C, H, W), of type uint8 with values 0 and 1.
+        convert_to_monochrome: Whether to convert the frame to monochrome.
+        bins: Number of bins.
+        value_range: Half-open [low, high) range of values covered by the bins; values outside it are not counted.
+    Returns:
+        Histograms of shape [N, C, bins], where N is the number of channels of the (converted) frame.
+    """
+    if len(frame.shape) == 2:
+        frame = frame[:, :, np.newaxis]
+    
+    if convert_to_monochrome:
+        frame = _convert_to_monochrome(frame)
+    # frame.shape = (H, W, 1)
+
+    return compute_batch_histograms(frame[np.newaxis], mask[np.newaxis], bins, value_range)[0]
+
+# Objects are histogrammed in groups, so that the membership of a pixel in the objects of a group fits in one byte
+OBJECTS_PER_GROUP = 8
+
+def compute_batch_histograms(
+    frames: np.ndarray,
+    masks: np.ndarray,
+    bins: int = DEFAULT_BINS,
+    value_range=DEFAULT_VALUE_RANGE,
+) -> np.ndarray:
+    """
+    Compute histograms of all objects and all channels of a batch of frames.
+
+    The masks of (up to OBJECTS_PER_GROUP) objects are packed into a per-pixel code, with bit c set when
+    the pixel belongs to object c. A single masked cv2.calcHist call per frame and channel then counts
+    (code, intensity) pairs, and the histogram of an object is the sum over the codes that have its bit set.
+    Each frame is therefore scanned once per channel rather than once per object and channel, and a pixel
+    covered by several (overlapping) object masks is counted once for each of those objects.
+    The cost depends on the frame size and the number of bins, not on the range of values: 16-bit
+    radiometric frames are binned directly, without a 65536-entry histogram.
+
+    Args:
+        frames: Batch of frames of shape [B, H, W, N], of type uint8, uint16 or float32.
+        masks: Masks of all objects in each frame, of shape (B, C, H, W), with values 0 and 1.
+        bins: Number of bins.
+        value_range: Half-open [low, high) range of values covered by the bins.
+    Returns:
+        Histograms of shape [B, N, C, bins].
+    """
+    batch_size, height, width, num_channels = frames.shape
+    num_objects = masks.shape[1]
+    result = np.zeros((batch_size, num_channels, num_objects, bins), dtype=np.int32)
+    # 8-bit frames with one bin per intensity are histogrammed directly; other frames are binned first
+    direct = frames.dtype == np.uint8 and bins == DEFAULT_BINS and tuple(value_range) == DEFAULT_VALUE_RANGE
+
+    for group_start in range(0, num_objects, OBJECTS_PER_GROUP):
+        group_masks = masks[:, group_start:group_start + OBJECTS_PER_GROUP]
+        group_size = group_masks.shape[1]
+        num_codes = 1 << group_size
+        # membership[code, c] is 1 if object c of the group is set in the code
+        membership = ((np.arange(num_codes)[:, np.newaxis] >> np.arange(group_size)) & 1).astype(np.float32)
+
+        for batch_idx in range(batch_size):
+            codes = np.zeros((height, width), dtype=np.uint8)
+            for obj_idx in range(group_size):
+                codes |= (group_masks[batch_idx, obj_idx] > 0).view(np.uint8) << obj_idx
+            # only the bounding box of the objects is histogrammed
+            rows = np.flatnonzero(codes.any(axis=1))
+            if len(rows) == 0:
+                continue
+            cols = np.flatnonzero(codes.any(axis=0))
+            window = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+            codes = np.ascontiguousarray(codes[window])
+            frame = frames[batch_idx][window]
+
+            for channel in range(num_channels):
+                if direct:
+                    # counts of (code, intensity) pairs, over pixels that belong to at least one object
+                    counts = cv2.calcHist([codes, np.ascontiguousarray(frame)], [0, 1 + channel], codes, [num_codes, 256], [0, num_codes, 0, 256])
+                else:
+                    # values out of the range get bin index `bins`, counted in an extra bin that is dropped;
+                    # pixels of no object have code 0, which is in no object's membership
+                    bin_indices = _bin_values(frame[..., channel], bins, value_range)
+                    pairs = codes.astype(np.intp) * (bins + 1) + bin_indices
+                    counts = np.bincount(pairs.ravel(), minlength=num_codes * (bins + 1)).reshape(num_codes, bins + 1)[:, :bins]
+                result[batch_idx, channel, group_start:group_start + group_size] = np.rint(membership.T @ counts)
+
+    return result
+
+@functools.lru_cache(maxsize=16)
+def _bin_lookup_table(dtype: str, bins: int, low: int, high: int) -> np.ndarray:
+    """
+    Bin index of every value of an 8 or 16-bit integer type, `bins` for values out of the range.
+
+    The table starts at the minimum of the type: entry i is the bin of the value info.min + i.
+    """
+    info = np.iinfo(dtype)
+    values = np.arange(info.min, info.max + 1, dtype=np.int64)
+    indices = (values - low) * bins // (high - low)
+    return np.where((indices >= 0) & (indices < bins), indices, bins).astype(np.uint16)
+
+def _bin_values(values: np.ndarray, bins: int, value_range) -> np.ndarray:
+    """
+    Bin indices of values, for `bins` uniform bins over the half-open range [low, high).
+
+    8 and 16-bit integer values are binned through a lookup table, with exact integer arithmetic, so that
+    values on bin edges fall in the bin they open. Values out of the range get the index `bins`.
+
+    Returns:
+        The bin indices, of type uint16.
+    """
+    if bins >= 65536:
+        raise ValueError(f"At most 65535 bins are supported, got {bins}")
+    low, high = value_range
+    if values.dtype in (np.uint8, np.uint16, np.int8, np.int16) and float(low).is_integer() and float(high).is_integer():
+        table = _bin_lookup_table(values.dtype.str, bins, int(low), int(high))
+        if values.dtype.kind == "i":
+            # offset of signed values from the minimum of their type: flipping the sign bit of their unsigned view
+            unsigned = values.view(values.dtype.str.replace("i", "u"))
+            return table[unsigned ^ unsigned.dtype.type(1 << (8 * values.dtype.itemsize - 1))]
+        return table[values]
+    indices = np.floor((values.astype(np.float64) - low) * bins / (high - low))
+    return np.where((indices >= 0) & (indices < bins), indices, bins).astype(np.uint16)
+
+# Percentiles of the values of each object reported by default in its temporal statistics
+DEFAULT_PERCENTILES = (5, 50, 95)
+
+def bin_values(bin_edges: np.ndarray) -> np.ndarray:
+    """
+    Value represented by each bin, for statistics computed from histograms.
+
+    Bins one unit wide (e.g. one bin per 8-bit intensity, or per raw count of a radiometric stack) represent
+    the integer value they start at, so that statistics of such histograms are exact. Wider bins are
+    represented by their center.
+
+    Args:
+        bin_edges: Bin edges of shape [N, bins + 1].
+    Returns:
+        Values of shape [N, bins].
+    """
+    bin_edges = np.asarray(bin_edges, dtype=np.float64)
+    widths = np.diff(bin_edges, axis=-1)
+    unit_bins = np.all(np.isclose(widths, 1.0), axis=-1, keepdims=True) & np.all(bin_edges == np.round(bin_edges), axis=-1, keepdims=True)
+    return np.where(unit_bins, bin_edges[..., :-1], bin_edges[..., :-1] + widths / 2)
+
+def compute_temporal_stats(
+    histograms: np.ndarray,
+    bin_edges: np.ndarray,
+    percentiles=DEFAULT_PERCENTILES,
+) -> Dict[str, np.ndarray]:
+    """
+    Compute per-object statistics of a sequence of frames from their histograms.
+
+    All frames, channels and objects are processed at once: the mean is a dot product with the values of
+    the bins, and the minimum, maximum and percentiles are searched in the cumulative sums of the histograms
+    (a percentile is the value of the first bin where the cumulative count reaches its rank).
+
+    Args:
+        histograms: Histograms of shape [F, N, C, bins], for F frames (see compute_frame_histograms).
+        bin_edges: Bin edges of shape [N, bins + 1].
+        percentiles: Percentiles to compute, between 0 and 100.
+    Returns:
+        Dictionary with keys "count" (number of pixels of each object, of shape [F, C]), "mean", "min", "max"
+        and "p<percentile>" (e.g. "p50"), each of shape [F, N, C]. Statistics of an object absent from a
+        frame are NaN.
+    """
+    histograms = np.asarray(histograms)
+    values = bin_values(bin_edges)[np.newaxis, :, np.newaxis, :]  # [1, N, 1, bins]
+    num_bins = histograms.shape[-1]
+    cumulative = np.cumsum(histograms, axis=-1, dtype=np.int64)
+    count = cumulative[..., -1]  # [F, N, C]
+    present = count > 0
+    safe_count = np.where(present, count, 1)
+
+    def value_at(bin_indices: np.ndarray) -> np.ndarray:
+        bin_indices = np.minimum(bin_indices, num_bins - 1)
+        picked = np.take_along_axis(np.broadcast_to(values, histograms.shape), bin_indices[..., np.newaxis], axis=-1)[..., 0]
+        return np.where(present, picked, np.nan)
+
+    stats = {
+        "count": count[:, 0],  # the same in every channel
+        "mean": np.where(present, (histograms * values).sum(axis=-1) / safe_count, np.nan),
+        # first bin with a pixel, and first bin where the cumulative count reaches the total
+        "min": value_at((cumulative == 0).sum(axis=-1)),
+        "max": value_at((cumulative < count[..., np.newaxis]).sum(axis=-1)),
+    }
+    for percentile in percentiles:
+        if not 0 <= percentile <= 100:
+            raise ValueError(f"Percentiles must be between 0 and 100, got {percentile}")
+        # nearest-rank percentile: the smallest value with at least `rank` pixels at or below it
+        rank = np.maximum(np.ceil(count * (percentile / 100)), 1)
+        stats[f"p{percentile:g}"] = value_at((cumulative < rank[..., np.newaxis]).sum(axis=-1))
+    return stats
+
+def downsample_min_max(values: np.ndarray, num_points: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Downsample a time series to at most `num_points` points, keeping its extremes.
+
+    The series is split into num_points // 2 buckets of consecutive frames, and the minimum and maximum of
+    each bucket are kept, in their order in time. Unlike averaging or striding, spikes that last a single
+    frame survive the decimation, so a plot of the downsampled series has the envelope of the full one.
+    NaN values (frames where the object is absent) are ignored; a bucket of NaN values keeps its first frame.
+
+    Args:
+        values: Series of shape [F].
+        num_points: Maximum number of points to keep, at least 2.
+    Returns:
+        Tuple of (indices of the kept frames, values at these frames).
+    """
+    num_frames = len(values)
+    if num_frames <= num_points:
+        return np.arange(num_frames), np.asarray(values)
+    num_buckets = max(num_points // 2, 1)
+    boundaries = np.linspace(0, num_frames, num_buckets + 1).astype(np.intp)
+    finite = np.isfinite(values)
+    low = np.where(finite, values, np.inf)
+    high = np.where(finite, values, -np.inf)
+    indices = []
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        if not finite[start:end].any():
+            indices.append(start)
+            continue
+        argmin = start + int(np.argmin(low[start:end]))
+        argmax = start + int(np.argmax(high[start:end]))
+        indices.extend(sorted({argmin, argmax}))
+    indices = np.array(indices, dtype=np.intp)
+    return indices, np.asarray(values)[indices]
+
+# Histograms are reduced to statistics this many frames at a time, so that memory stays bounded
+STATS_CHUNK_FRAMES = 512
+
+def chunk_histograms(
+    frames: Iterable[Tuple[int, np.ndarray | None]],
+    histogram_shape: Tuple[int, int, int],
+    chunk_size: int = STATS_CHUNK_FRAMES,
+) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Group the histograms of a sequence of frames into arrays of up to `chunk_size` frames.
+
+    Args:
+        frames: (frame_idx, histograms of shape [N, C, bins] or None) of each frame.
+        histogram_shape: Shape [N, C, bins] of the histograms; frames without histograms get empty ones.
+    Yields:
+        Tuples of (frame indices of shape [K], histograms of shape [K, N, C, bins]).
+    """
+    frame_indices = []
+    histograms = []
+    for frame_idx, frame_histograms in frames:
+        frame_indices.append(frame_idx)
+        histograms.append(frame_histograms if frame_histograms is not None else np.zeros(histogram_shape, dtype=np.int32))
+        if len(frame_indices) == chunk_size:
+            yield np.array(frame_indices), np.stack(histograms)
+            frame_indices, histograms = [], []
+    if frame_indices:
+        yield np.array(frame_indices), np.stack(histograms)
+
+def compute_timelines(
+    histogram_chunks: Iterable[Tuple[np.ndarray, np.ndarray]],
+    bin_edges: np.ndarray,
+    percentiles=DEFAULT_PERCENTILES,
+) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    """
+    Compute the temporal statistics of a recording, chunk by chunk (see compute_temporal_stats).
+
+    Args:
+        histogram_chunks: (frame indices, histograms) of consecutive chunks of frames, e.g. from chunk_histograms.
+        bin_edges: Bin edges of shape [N, bins + 1].
+        percentiles: Percentiles to compute.
+    Returns:
+        Tuple of (frame indices of shape [F], statistics of all frames).
+    """
+    frame_indices = []
+    chunk_stats = []
+    for chunk_frame_indices, histograms in histogram_chunks:
+        frame_indices.append(chunk_frame_indices)
+        chunk_stats.append(compute_temporal_stats(histograms, bin_edges, percentiles))
+    if not chunk_stats:
+        return np.zeros(0, dtype=np.intp), {}
+    return np.concatenate(frame_indices), {key: np.concatenate([stats[key] for stats in chunk_stats]) for key in chunk_stats[0]}
+
+def downsample_timelines(
+    frame_indices: np.ndarray,
+    stats: Dict[str, np.ndarray],
+    obj_ids: List[int],
+    num_points: int,
+) -> List[Dict[str, Any]]:
+    """
+    Downsample the temporal statistics of each object to at most `num_points` points per series (see downsample_min_max).
+
+    Args:
+        frame_indices: Frame indices of shape [F].
+        stats: Statistics of all frames, as returned by compute_temporal_stats.
+        obj_ids: Object ids, one for each object of the statistics.
+        num_points: Maximum number of points of each series.
+    Returns:
+        One dictionary per object, JSON-serializable, with its "obj_id" and, for each statistic, its series:
+        {"frame_idx": [...], "values": [...]} for "count", and a list of such series (one per channel) for
+        the others. Values of frames where the object is absent are None.
+    """
+    def series(values: np.ndarray) -> Dict[str, list]:
+        indices, kept = downsample_min_max(values.astype(np.float64), num_points)
+        return {
+            "frame_idx": frame_indices[indices].tolist(),
+            "values": [None if np.isnan(value) else value for value in kept.tolist()],
+        }
+
+    timelines = []
+    for obj_idx, obj_id in enumerate(obj_ids):
+        timeline: Dict[str, Any] = {"obj_id": obj_id}
+        for key, values in stats.items():
+            if key == "count":
+                timeline[key] = series(values[:, obj_idx])
+            else:
+                timeline[key] = [series(values[:, channel, obj_idx]) for channel in range(values.shape[1])]
+        timelines.append(timeline)
+    return timelines
+
 def _convert_to_monochrome(frame: np.ndarray) -> np.ndarray:
     """
     Convert a frame to monochrome.
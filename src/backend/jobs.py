@@ -0,0 +1,273 @@
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from sessions import PromptPoint
+
+logger = logging.getLogger(__name__)
+
+# Frames produced by a job are written to disk in chunks of this many frames
+CHECKPOINT_INTERVAL = 32
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+CANCELLED = "cancelled"
+FAILED = "failed"
+INTERRUPTED = "interrupted"  # the server stopped while the job was running
+
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+RESUMABLE_STATUSES = (CANCELLED, FAILED, INTERRUPTED)
+
+
+class Job:
+    """
+    Processing of a whole recording in the background, with checkpoints on disk.
+
+    A job snapshots the prompts of its session when it is created. The masks and histograms it
+    produces are buffered and written to its directory every CHECKPOINT_INTERVAL frames, as
+    chunk_<first frame>.npz files, next to a job.json manifest. Frames are propagated in order,
+    so a cancelled, failed or interrupted job resumes from the frame after the last one saved.
+    """
+
+    def __init__(
+        self,
+        job_id: str,
+        job_dir: Path,
+        session_id: str,
+        prompts: List[PromptPoint],
+        histogram_options: Dict[str, Any],
+        num_frames: int,
+    ):
+        self.job_id = job_id
+        self.job_dir = job_dir
+        self.session_id = session_id
+        self.prompts = prompts
+        self.histogram_options = histogram_options  # monochrome flag and binning, see server.get_histogram_options
+        self.num_frames = num_frames
+        self.status = QUEUED
+        self.error: str | None = None
+        self.obj_ids: List[int] | None = None  # order of the mask channels, fixed by the first run
+        self.frames_done = 0
+        self.next_frame_idx = 0
+        self.created_at = time.time()
+        self.chunks: List[int] = []  # first frame of each checkpointed chunk
+        self.pending: List[Tuple[int, np.ndarray, np.ndarray | None]] = []  # frames not checkpointed yet
+        self.run_started_at: float | None = None
+        self.run_frames = 0  # frames produced since the job was last started or resumed
+        self.task = None  # asyncio.Task running the job
+        # Frames are recorded and checkpointed on worker threads (see server.run_job) while results are read:
+        # `lock` guards the chunks and pending frames, `checkpoint_lock` serializes checkpoints and manifest writes
+        self.lock = threading.Lock()
+        self.checkpoint_lock = threading.RLock()
+
+    @property
+    def active(self) -> bool:
+        return self.status in ACTIVE_STATUSES
+
+    def start_run(self) -> None:
+        self.status = RUNNING
+        self.error = None
+        self.run_started_at = time.monotonic()
+        self.run_frames = 0
+        self.save_manifest()
+
+    def progress(self) -> Dict[str, Any]:
+        """Progress of the job: frames done, throughput of the current run and estimated time left."""
+        fps = None
+        eta = None
+        if self.status == RUNNING and self.run_started_at is not None and self.run_frames > 0:
+            fps = self.run_frames / max(time.monotonic() - self.run_started_at, 1e-6)
+            eta = (self.num_frames - self.frames_done) / fps
+        return {
+            "job_id": self.job_id,
+            "filename": self.session_id,
+            "status": self.status,
+            "error": self.error,
+            "frames_done": self.frames_done,
+            "num_frames": self.num_frames,
+            "progress": self.frames_done / self.num_frames if self.num_frames else 1.0,
+            "fps": fps,
+            "eta_seconds": eta,
+            "obj_ids": self.obj_ids,
+            "histogram_options": self.histogram_options,
+            "created_at": self.created_at,
+        }
+
+    def record(self, frame_idx: int, masks: np.ndarray, histograms: np.ndarray | None) -> None:
+        """Add the results of a frame, checkpointing them once a chunk is full."""
+        with self.lock:
+            self.pending.append((frame_idx, masks, histograms))
+            self.frames_done += 1
+            self.run_frames += 1
+            self.next_frame_idx = frame_idx + 1
+            chunk_full = len(self.pending) >= CHECKPOINT_INTERVAL
+        if chunk_full:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        """Write the buffered frames to a chunk file, then update the manifest."""
+        with self.checkpoint_lock:
+            with self.lock:
+                written = list(self.pending)
+            if written:
+                frame_indices = np.array([frame_idx for frame_idx, _, _ in written], dtype=np.int32)
+                masks = np.stack([masks for _, masks, _ in written])
+                has_histograms = np.array([histograms is not None for _, _, histograms in written])
+                histogram_shape = next((h.shape for _, _, h in written if h is not None), (0, 0, 0))
+                histograms = np.stack([
+                    h if h is not None else np.zeros(histogram_shape, dtype=np.int32) for _, _, h in written
+                ]).astype(np.int32)
+                chunk_path = self.chunk_path(int(frame_indices[0]))
+                tmp_path = chunk_path.with_suffix(".tmp.npz")
+                np.savez(
+                    tmp_path,
+                    frame_indices=frame_indices,
+                    masks_shape=np.array(masks.shape, dtype=np.int64),
+                    masks=np.packbits(masks.reshape(-1) > 0),
+                    has_histograms=has_histograms,
+                    histograms=histograms,
+                )
+                os.replace(tmp_path, chunk_path)
+                with self.lock:
+                    self.chunks.append(int(frame_indices[0]))
+                    self.pending = self.pending[len(written):]
+            self.save_manifest()
+
+    def chunk_path(self, first_frame_idx: int) -> Path:
+        return self.job_dir / f"chunk_{first_frame_idx:06d}.npz"
+
+    def save_manifest(self) -> None:
+        with self.checkpoint_lock:
+            with self.lock:
+                manifest = {
+                    "job_id": self.job_id,
+                    "session_id": self.session_id,
+                    "prompts": self.prompts,
+                    "histogram_options": self.histogram_options,
+                    "num_frames": self.num_frames,
+                    "status": self.status,
+                    "error": self.error,
+                    "obj_ids": self.obj_ids,
+                    "created_at": self.created_at,
+                    "chunks": list(self.chunks),
+                    # only checkpointed frames survive a restart
+                    "frames_done": self.frames_done - len(self.pending),
+                    "next_frame_idx": self.pending[0][0] if self.pending else self.next_frame_idx,
+                }
+            tmp_path = self.job_dir / "job.json.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(tmp_path, self.job_dir / "job.json")
+
+    @classmethod
+    def load(cls, job_dir: Path) -> "Job":
+        with open(job_dir / "job.json") as f:
+            manifest = json.load(f)
+        job = cls(
+            manifest["job_id"], job_dir, manifest["session_id"], manifest["prompts"],
+            manifest.get("histogram_options") or {
+                # manifests written before binning was configurable
+                "convert_to_monochrome": manifest.get("convert_to_monochrome", False),
+                "bins": 256,
+                "value_range": [0, 256],
+            },
+            manifest["num_frames"],
+        )
+        job.status = manifest["status"]
+        job.error = manifest["error"]
+        job.obj_ids = manifest["obj_ids"]
+        job.created_at = manifest["created_at"]
+        job.chunks = manifest["chunks"]
+        job.frames_done = manifest["frames_done"]
+        job.next_frame_idx = manifest["next_frame_idx"]
+        if job.active:
+            job.status = INTERRUPTED
+        return job
+
+    def iter_results(self, start_frame_idx: int = 0, num_frames: int | None = None) -> Iterator[Tuple[int, np.ndarray, np.ndarray | None]]:
+        """
+        Iterate over the results produced so far, checkpointed or not, in frame order.
+
+        Yields:
+            Tuples of (frame_idx, masks of shape (C, H, W), histograms of shape [N, C, num_bins] or None).
+        """
+        end_frame_idx = start_frame_idx + num_frames if num_frames is not None else None
+
+        def in_range(frame_idx):
+            return frame_idx >= start_frame_idx and (end_frame_idx is None or frame_idx < end_frame_idx)
+
+        # a checkpoint moves frames from the pending ones to a new chunk; both are read as of the same instant
+        with self.lock:
+            chunks = list(self.chunks)
+            pending = list(self.pending)
+        for first_frame_idx in chunks:
+            if end_frame_idx is not None and first_frame_idx >= end_frame_idx:
+                break
+            with np.load(self.chunk_path(first_frame_idx)) as chunk:
+                frame_indices = chunk["frame_indices"]
+                if not any(in_range(int(frame_idx)) for frame_idx in frame_indices):
+                    continue
+                shape = tuple(chunk["masks_shape"])
+                masks = np.unpackbits(chunk["masks"], count=int(np.prod(shape))).reshape(shape)
+                has_histograms = chunk["has_histograms"]
+                histograms = chunk["histograms"]
+            for i, frame_idx in enumerate(frame_indices.tolist()):
+                if in_range(frame_idx):
+                    yield frame_idx, masks[i], histograms[i] if has_histograms[i] else None
+        for frame_idx, masks, histograms in pending:
+            if in_range(frame_idx):
+                yield frame_idx, masks, histograms
+
+
+class JobRegistry:
+    """Jobs keyed by id, each with its checkpoint directory under `jobs_dir`."""
+
+    def __init__(self, jobs_dir: Path):
+        self.jobs_dir = jobs_dir
+        self.jobs: Dict[str, Job] = {}
+
+    def load(self) -> None:
+        """
+        Load the jobs checkpointed by previous runs of the server. Jobs that were running become interrupted.
+
+        Jobs are added at once when all are loaded, so that the jobs can be loaded on a worker thread while requests are served.
+        """
+        loaded = {}
+        for job_dir in sorted(self.jobs_dir.iterdir()):
+            if not (job_dir / "job.json").is_file():
+                continue
+            try:
+                job = Job.load(job_dir)
+            except Exception as e:
+                logger.warning(f"Could not load job from {job_dir}: {e}")
+                continue
+            loaded[job.job_id] = job
+        self.jobs.update(loaded)
+        if loaded:
+            logger.info(f"Loaded {len(loaded)} jobs from {self.jobs_dir}")
+
+    def create(self, session_id: str, prompts: List[PromptPoint], histogram_options: Dict[str, Any], num_frames: int) -> Job:
+        job_id = uuid.uuid4().hex
+        job_dir = self.jobs_dir / job_id
+        job_dir.mkdir(parents=True)
+        job = Job(job_id, job_dir, session_id, list(prompts), histogram_options, num_frames)
+        job.save_manifest()
+        self.jobs[job_id] = job
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self.jobs.get(job_id)
+
+    def remove(self, job_id: str) -> None:
+        job = self.jobs.pop(job_id, None)
+        if job is not None:
+            shutil.rmtree(job.job_dir, ignore_errors=True)
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from sessions import PromptPoint
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed cache of processed videos.
+#
+# An entry holds the masks and histograms of every frame of a recording processed with a given prompt
+# set, model checkpoint and histogram options (monochrome flag, binning); its key is a hash of these. Each entry is a directory:
+#
+#   <key>/meta.json          obj_ids, mask_shape (C, H, W), num_frames, keyframes (of previews, see preview.py)
+#   <key>/frame_indices.npy  int32[F]
+#   <key>/masks.npy          uint8[F, ceil(C * H * W / 8)]  masks bit-packed like serialization.encode_masks_bitpack
+#   <key>/histograms.npy     int32[F, N, C, num_bins]        absent if no frame could be read
+#   <key>/has_histograms.npy bool[F]
+#
+# The arrays are written and read as memory maps, so serving an entry does not load it whole.
+# The modification time of meta.json is the last access time used for LRU eviction.
+
+HASH_CHUNK_SIZE = 2**20
+
+
+def hash_file(file_path: str | Path) -> str:
+    """SHA-256 of the content of a file."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(
+    video_hash: str,
+    prompts: List[PromptPoint],
+    model_id: str,
+    histogram_options: Dict[str, Any],
+    preview_options: Dict[str, Any] | None = None,
+) -> str:
+    """Key of the results of processing a recording with the given prompts, model and histogram options (monochrome flag, binning), as a full run or a preview."""
+    # the order of the prompts is kept: it determines the order of the objects in the masks
+    key = {
+        "video": video_hash,
+        "prompts": [[p["frame_idx"], p["obj_id"], p["x"], p["y"], p["label"]] for p in prompts],
+        "model": model_id,
+        "histograms": histogram_options,
+    }
+    if preview_options is not None:
+        key["preview"] = preview_options
+    canonical = json.dumps(key, sort_keys=True)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class CacheEntry:
+    """A processed video read from the cache, with its arrays memory-mapped."""
+
+    def __init__(self, entry_dir: Path):
+        with open(entry_dir / "meta.json") as f:
+            meta = json.load(f)
+        self.obj_ids: List[int] = meta["obj_ids"]
+        self.mask_shape: Tuple[int, int, int] = tuple(meta["mask_shape"])
+        self.num_frames: int = meta["num_frames"]
+        self.keyframes: List[int] | None = meta.get("keyframes")  # frames SAM2 ran on, for previews
+        self.frame_indices = np.load(entry_dir / "frame_indices.npy")
+        self.masks = np.load(entry_dir / "masks.npy", mmap_mode="r")
+        self.has_histograms = np.load(entry_dir / "has_histograms.npy")
+        histograms_path = entry_dir / "histograms.npy"
+        self.histograms = np.load(histograms_path, mmap_mode="r") if histograms_path.exists() else None
+
+    def iter_frames(self) -> Iterator[Tuple[int, np.ndarray, np.ndarray | None]]:
+        """Yield (frame_idx, masks of shape (C, H, W), histograms of shape [N, C, num_bins] or None) of each frame."""
+        count = int(np.prod(self.mask_shape))
+        for i, frame_idx in enumerate(self.frame_indices.tolist()):
+            masks = np.unpackbits(self.masks[i], count=count, bitorder="little").reshape(self.mask_shape)
+            histograms = np.array(self.histograms[i]) if self.histograms is not None and self.has_histograms[i] else None
+            yield frame_idx, masks, histograms
+
+    def iter_histogram_chunks(self, chunk_size: int) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        """Yield (frame indices, histograms of shape [K, N, C, num_bins]) of up to `chunk_size` frames at a time, without reading the masks."""
+        if self.histograms is None:
+            return
+        for start in range(0, len(self.frame_indices), chunk_size):
+            end = start + chunk_size
+            # frames that could not be read have empty histograms
+            histograms = np.where(self.has_histograms[start:end, np.newaxis, np.newaxis, np.newaxis], self.histograms[start:end], 0)
+            yield self.frame_indices[start:end], histograms
+
+
+class CacheWriter:
+    """
+    Writes the results of one processing run frame by frame, into a temporary directory.
+
+    The entry becomes visible to readers only on commit, once every frame was written;
+    an incomplete run is discarded with abort.
+    """
+
+    def __init__(self, cache: "MaskCache", key: str, obj_ids: List[int], num_frames: int, keyframes: List[int] | None = None):
+        self.cache = cache
+        self.key = key
+        self.obj_ids = list(obj_ids)
+        self.num_frames = num_frames
+        self.keyframes = keyframes
+        self.tmp_dir = cache.root / f"{key}.tmp-{uuid.uuid4().hex}"
+        self.tmp_dir.mkdir(parents=True)
+        self.frame_indices = np.zeros(num_frames, dtype=np.int32)
+        self.has_histograms = np.zeros(num_frames, dtype=bool)
+        self.masks = None
+        self.histograms = None
+        self.mask_shape = None
+        self.count = 0
+        self.closed = False
+
+    def append(self, frame_idx: int, masks: np.ndarray, histograms: np.ndarray | None) -> None:
+        if self.closed or self.count >= self.num_frames:
+            return
+        if self.masks is None:
+            self.mask_shape = masks.shape
+            packed_length = (int(np.prod(masks.shape)) + 7) // 8
+            self.masks = np.lib.format.open_memmap(
+                self.tmp_dir / "masks.npy", mode="w+", dtype=np.uint8, shape=(self.num_frames, packed_length)
+            )
+        if histograms is not None and self.histograms is None:
+            self.histograms = np.lib.format.open_memmap(
+                self.tmp_dir / "histograms.npy", mode="w+", dtype=np.int32, shape=(self.num_frames, *histograms.shape)
+            )
+        self.frame_indices[self.count] = frame_idx
+        self.masks[self.count] = np.packbits(masks.reshape(-1) > 0, bitorder="little")
+        if histograms is not None:
+            self.histograms[self.count] = histograms
+            self.has_histograms[self.count] = True
+        self.count += 1
+
+    def commit(self) -> bool:
+        """Publish the entry if all frames were written. Returns whether it was published."""
+        if self.closed:
+            return False
+        if self.count < self.num_frames or self.masks is None:
+            logger.info(f"Not caching incomplete results ({self.count} of {self.num_frames} frames)")
+            self.abort()
+            return False
+        self.closed = True
+        self.masks.flush()
+        if self.histograms is not None:
+            self.histograms.flush()
+        self.masks = self.histograms = None
+        np.save(self.tmp_dir / "frame_indices.npy", self.frame_indices)
+        np.save(self.tmp_dir / "has_histograms.npy", self.has_histograms)
+        with open(self.tmp_dir / "meta.json", "w") as f:
+            json.dump({
+                "obj_ids": self.obj_ids,
+                "mask_shape": list(self.mask_shape),
+                "num_frames": self.num_frames,
+                "keyframes": self.keyframes,
+                "created_at": time.time(),
+            }, f)
+        entry_dir = self.cache.root / self.key
+        try:
+            os.rename(self.tmp_dir, entry_dir)
+        except OSError:
+            # another run cached the same results first
+            shutil.rmtree(self.tmp_dir, ignore_errors=True)
+            return False
+        logger.info(f"Cached {self.num_frames} frames under {entry_dir.name}")
+        self.cache.enforce_size_limit()
+        return True
+
+    def abort(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.masks = self.histograms = None
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+
+class MaskCache:
+    """Persistent cache of processed videos under `root`, capped at `max_bytes` with LRU eviction."""
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def remove_incomplete(self, started_before: float | None = None) -> None:
+        """
+        Remove the temporary directories of runs interrupted by a restart.
+
+        Args:
+            started_before: Only remove the directories last modified before this time (e.g. the start of
+                the server), so that runs writing to the cache meanwhile are kept. All of them by default.
+        """
+        for tmp_dir in self.root.glob("*.tmp-*"):
+            if started_before is None or tmp_dir.stat().st_mtime < started_before:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def get(self, key: str) -> CacheEntry | None:
+        entry_dir = self.root / key
+        if not (entry_dir / "meta.json").is_file():
+            return None
+        try:
+            entry = CacheEntry(entry_dir)
+        except Exception as e:
+            logger.warning(f"Discarding unreadable cache entry {key}: {e}")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return None
+        os.utime(entry_dir / "meta.json")  # mark as recently used
+        return entry
+
+    def writer(self, key: str, obj_ids: List[int], num_frames: int, keyframes: List[int] | None = None) -> CacheWriter:
+        return CacheWriter(self, key, obj_ids, num_frames, keyframes)
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """Committed entries with their size and last access time."""
+        entries = []
+        for entry_dir in self.root.iterdir():
+            meta_path = entry_dir / "meta.json"
+            if ".tmp-" in entry_dir.name or not meta_path.is_file():
+                continue
+            size = sum(f.stat().st_size for f in entry_dir.iterdir() if f.is_file())
+            entries.append({"key": entry_dir.name, "size": size, "last_used": meta_path.stat().st_mtime})
+        return entries
+
+    def enforce_size_limit(self) -> None:
+        """Evict least recently used entries until the cache fits in its size limit."""
+        entries = sorted(self.entries(), key=lambda entry: entry["last_used"])
+        total = sum(entry["size"] for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            logger.info(f"Evicting cache entry {entry['key']} ({entry['size'] / 2**20:.1f} MiB)")
+            shutil.rmtree(self.root / entry["key"], ignore_errors=True)
+            total -= entry["size"]
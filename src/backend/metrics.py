@@ -0,0 +1,205 @@
+import bisect
+import contextlib
+import contextvars
+import os
+import resource
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# Instrumentation of the server, exposed in the Prometheus text format on /metrics.
+#
+# Processing stages (propagation, copies to the host, histograms, encoding, transfer, ...) are timed with
+# `stage`, which observes the duration in the thermal_studio_stage_seconds histogram and adds it to the
+# RequestTimings of the current request, if any, from which the Server-Timing header is made. The current
+# request is tracked in a context variable, which InferencePool carries over to its worker threads.
+#
+# Observing a sample is a bisection and two additions under a lock, cheap enough to stay enabled.
+
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+BYTES_BUCKETS = tuple(float(2**n) for n in range(10, 34, 2))  # 1 KiB to 8 GiB
+FPS_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1000.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    type_name = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """A value set by the server, or read from `function` when the metrics are collected."""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), function: Callable[[], float] | None = None):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[LabelValues, float] = {}
+        self.function = function
+
+    def set(self, value: float, **labels) -> None:
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self) -> Iterator[str]:
+        if self.function is not None:
+            yield f"{self.name} {_format_value(self.function())}"
+            return
+        with self.lock:
+            values = dict(self.values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DURATION_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: count of each bucket (not cumulative), then the +Inf bucket, and the sum
+        self.series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def samples(self) -> Iterator[str]:
+        with self.lock:
+            series = {key: (list(counts), total[0]) for key, (counts, total) in self.series.items()}
+        for key, (counts, total) in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+def rss_bytes() -> float:
+    """Resident set size of the process; its peak where the current one cannot be read."""
+    try:
+        with open("/proc/self/statm") as f:
+            return float(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))
+    except (OSError, ValueError, IndexError):
+        return float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+
+registry = Registry()
+stage_seconds = registry.register(Histogram("thermal_studio_stage_seconds", "Duration of processing stages.", ["stage"]))
+request_seconds = registry.register(Histogram("thermal_studio_request_seconds", "Duration of HTTP requests, until the response is complete.", ["route", "method", "status"]))
+response_bytes = registry.register(Histogram("thermal_studio_response_payload_bytes", "Size of mask and histogram payloads.", ["route", "format"], BYTES_BUCKETS))
+frames_total = registry.register(Counter("thermal_studio_frames_total", "Frames produced, by source (propagated, interpolated, cached).", ["source"]))
+video_fps = registry.register(Histogram("thermal_studio_video_frames_per_second", "Throughput of whole-video runs.", ["source"], FPS_BUCKETS))
+rss = registry.register(Gauge("thermal_studio_resident_memory_bytes", "Resident set size of the server.", function=rss_bytes))
+model_load_seconds = registry.register(Gauge("thermal_studio_model_load_seconds", "Time taken to load SAM2."))
+model_warmup_seconds = registry.register(Gauge("thermal_studio_model_warmup_seconds", "Time taken by the last warm-up of the image encoder, at startup or when an inference state is built."))
+
+
+class RequestTimings:
+    """Durations of the stages of one request, summed by stage, in order of first occurrence."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def header(self) -> str:
+        """Value of a Server-Timing header, in milliseconds, with the time elapsed so far as `total`."""
+        entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.stages.items()]
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(entries)
+
+
+current_timings: contextvars.ContextVar[RequestTimings | None] = contextvars.ContextVar("current_timings", default=None)
+
+
+def record_stage(name: str, seconds: float) -> None:
+    stage_seconds.observe(seconds, stage=name)
+    timings = current_timings.get()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Time the enclosed code as a stage of the current request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - start)
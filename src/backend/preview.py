@@ -0,0 +1,162 @@
+import logging
+from typing import Any, Dict, Iterable, List
+
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Fast preview of the tracking of a recording.
+#
+# SAM2 runs only on keyframes: every `stride`-th frame, the prompted frames and the last frame. With an
+# adaptive schedule, keyframes are placed where the content of the recording changes, at most `stride`
+# frames apart. The masks of the frames in between are interpolated from the masks of the keyframes
+# around them: each object is moved between its positions in the keyframes, and its shape is morphed
+# by blending their signed distance fields, rather than cross-fading the masks.
+
+DEFAULT_PREVIEW_STRIDE = 8
+MAX_PREVIEW_STRIDE = 256
+
+# Adaptive schedules: mean absolute difference (in 8-bit levels) between thumbnails of a frame and of the
+# last keyframe from which the frame becomes a keyframe, and minimum spacing, as a fraction of the stride
+ADAPTIVE_CHANGE_THRESHOLD = 6.0
+ADAPTIVE_MIN_STRIDE_FRACTION = 0.25
+# Side of the thumbnails compared by adaptive schedules
+THUMBNAIL_SIZE = 32
+
+
+def get_preview_options(params: Any) -> Dict[str, Any] | None:
+    """
+    Preview options of a /process-video request, or None for a full run.
+
+    `preview` is either true, for the default stride, or {"stride": N, "adaptive": bool}.
+
+    Raises:
+        ValueError: If the options are invalid.
+    """
+    if not params:
+        return None
+    if params is True:
+        params = {}
+    if not isinstance(params, dict):
+        raise ValueError(f"preview must be true or an object, got {params!r}")
+    stride = int(params.get("stride", DEFAULT_PREVIEW_STRIDE))
+    if not 1 <= stride <= MAX_PREVIEW_STRIDE:
+        raise ValueError(f"preview stride must be between 1 and {MAX_PREVIEW_STRIDE}, got {stride}")
+    return {"stride": stride, "adaptive": bool(params.get("adaptive", False))}
+
+
+def keyframe_schedule(
+    num_frames: int,
+    stride: int,
+    required: Iterable[int] = (),
+    thumbnails: np.ndarray | None = None,
+) -> List[int]:
+    """
+    Frames SAM2 runs on in a preview, in increasing order.
+
+    Args:
+        num_frames: The number of frames of the recording.
+        stride: Distance between keyframes; the maximum distance with an adaptive schedule.
+        required: Frames that must be keyframes, e.g. the prompted frames.
+        thumbnails: Thumbnails of all frames (see frame_thumbnails), for an adaptive schedule.
+    Returns:
+        The keyframes, always including the first and the last frame.
+    """
+    if num_frames == 0:
+        return []
+    keyframes = {0, num_frames - 1}
+    keyframes.update(frame_idx for frame_idx in required if 0 <= frame_idx < num_frames)
+    if thumbnails is None:
+        keyframes.update(range(0, num_frames, stride))
+        return sorted(keyframes)
+
+    min_stride = max(1, int(stride * ADAPTIVE_MIN_STRIDE_FRACTION))
+    last_keyframe = 0
+    for frame_idx in range(1, num_frames):
+        if frame_idx in keyframes:
+            last_keyframe = frame_idx
+            continue
+        gap = frame_idx - last_keyframe
+        change = np.abs(thumbnails[frame_idx] - thumbnails[last_keyframe]).mean()
+        if gap >= stride or (gap >= min_stride and change > ADAPTIVE_CHANGE_THRESHOLD):
+            keyframes.add(frame_idx)
+            last_keyframe = frame_idx
+    return sorted(keyframes)
+
+
+def frame_thumbnails(frames: np.ndarray) -> np.ndarray:
+    """
+    Grayscale thumbnails of shape [F, THUMBNAIL_SIZE, THUMBNAIL_SIZE], float32, of BGR frames of shape [F, H, W, 3].
+
+    The frames can be downscaled already, e.g. the thumbnails of a frame store, which are much faster to read.
+    """
+    thumbnails = np.empty((len(frames), THUMBNAIL_SIZE, THUMBNAIL_SIZE), dtype=np.float32)
+    for frame_idx, frame in enumerate(frames):
+        gray = cv2.cvtColor(np.asarray(frame), cv2.COLOR_BGR2GRAY)
+        thumbnails[frame_idx] = cv2.resize(gray, (THUMBNAIL_SIZE, THUMBNAIL_SIZE), interpolation=cv2.INTER_AREA)
+    return thumbnails
+
+
+class KeyframeMasks:
+    """
+    Masks of a keyframe, with what interpolation needs: the signed distance field of each object (positive
+    inside the object, negative outside) and its centroid.
+    """
+
+    def __init__(self, frame_idx: int, masks: np.ndarray):
+        """
+        Args:
+            frame_idx: Index of the keyframe in the recording.
+            masks: Masks of the objects, of shape (C, H, W), with values 0 and 1.
+        """
+        self.frame_idx = frame_idx
+        self.masks = masks
+        self.fields: List[np.ndarray | None] = []  # None for objects absent from the keyframe
+        self.centroids: List[np.ndarray | None] = []
+        for mask in masks:
+            mask = (mask > 0).astype(np.uint8)
+            moments = cv2.moments(mask, binaryImage=True)
+            if moments["m00"] == 0:
+                self.fields.append(None)
+                self.centroids.append(None)
+                continue
+            inside = cv2.distanceTransform(mask, cv2.DIST_L2, 3)
+            outside = cv2.distanceTransform(1 - mask, cv2.DIST_L2, 3)
+            self.fields.append(inside - outside)
+            self.centroids.append(np.array([moments["m10"], moments["m01"]]) / moments["m00"])
+
+
+def _shift(field: np.ndarray, offset: np.ndarray) -> np.ndarray:
+    """Translate a distance field by an (x, y) offset, extending it at the borders."""
+    matrix = np.array([[1, 0, offset[0]], [0, 1, offset[1]]], dtype=np.float32)
+    return cv2.warpAffine(field, matrix, (field.shape[1], field.shape[0]), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def interpolate_masks(a: KeyframeMasks, b: KeyframeMasks, frame_idx: int) -> np.ndarray:
+    """
+    Masks of a frame between two keyframes.
+
+    Each object is moved along the line between its centroids in the keyframes, and its shape is morphed
+    from one keyframe to the other by blending their distance fields, both warped to its position at the
+    frame. An object that moves by more than its size between keyframes is therefore still found in the
+    frames in between, which a plain blend of the fields would lose.
+
+    Args:
+        a, b: The keyframes before and after the frame.
+        frame_idx: Index of the frame, between the keyframes.
+    Returns:
+        Masks of shape (C, H, W), of type uint8 with values 0 and 1. An object absent from one of the
+        keyframes keeps the mask of the nearest keyframe.
+    """
+    t = (frame_idx - a.frame_idx) / (b.frame_idx - a.frame_idx)
+    masks = np.empty(a.masks.shape, dtype=np.uint8)
+    for obj_idx in range(a.masks.shape[0]):
+        if a.fields[obj_idx] is None or b.fields[obj_idx] is None:
+            masks[obj_idx] = a.masks[obj_idx] if t < 0.5 else b.masks[obj_idx]
+            continue
+        motion = b.centroids[obj_idx] - a.centroids[obj_idx]
+        field_a = _shift(a.fields[obj_idx], t * motion)
+        field_b = _shift(b.fields[obj_idx], (t - 1) * motion)
+        masks[obj_idx] = ((1 - t) * field_a + t * field_b) > 0
+    return masks
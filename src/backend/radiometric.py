@@ -0,0 +1,126 @@
+import logging
+import hashlib
+import json
+from pathlib import Path
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Raw radiometric stacks, as exported by thermal cameras: one single-channel frame per temperature
+# reading, typically 16-bit counts. They are memory-mapped as [num_frames, height, width] arrays,
+# without transcoding:
+#
+#   .npy          a 3D array (a 2D array is a single frame), memory-mapped by numpy
+#   .raw          headerless little-endian frames; width and height (and dtype, uint16 by default) must be given
+#   .tif / .tiff  multi-page TIFF, memory-mapped with the optional tifffile package when uncompressed
+
+RADIOMETRIC_EXTENSIONS = (".npy", ".raw", ".tif", ".tiff")
+SUPPORTED_DTYPES = (np.uint8, np.uint16, np.int16, np.float32)
+
+# Percentiles of the values mapped to 0 and 255 in the 8-bit view of a stack
+DISPLAY_PERCENTILES = (0.5, 99.5)
+# Number of frames sampled to estimate the display range
+DISPLAY_SAMPLE_FRAMES = 32
+
+try:
+    import tifffile
+except ImportError:  # optional, only needed for TIFF stacks
+    tifffile = None
+
+
+def is_radiometric(file_path: str | Path) -> bool:
+    return Path(file_path).suffix.lower() in RADIOMETRIC_EXTENSIONS
+
+
+def layout_hash(content_hash: str, file_path: str | Path, source: Dict[str, Any] | None, fps: float) -> str:
+    """
+    Hash of a stack as it is read: its content hash combined with its layout and frame rate.
+
+    The same bytes read with another width, height or dtype (for .raw stacks) or at another frame rate
+    are another recording, with other frames and timestamps.
+
+    Raises:
+        ValueError, TypeError: If the layout is invalid.
+    """
+    layout: Dict[str, Any] = {"fps": float(fps)}
+    if Path(file_path).suffix.lower() == ".raw":
+        source = source or {}
+        layout.update(
+            width=int(source.get("width") or 0),
+            height=int(source.get("height") or 0),
+            dtype=np.dtype(source.get("dtype", "uint16")).name,
+        )
+    return hashlib.sha256(f"{content_hash}/{json.dumps(layout, sort_keys=True)}".encode("utf-8")).hexdigest()
+
+
+def open_stack(file_path: str | Path, source: Dict[str, Any] | None = None) -> np.ndarray:
+    """
+    Memory-map a radiometric stack.
+
+    Args:
+        file_path: Path of the stack.
+        source: Layout of headerless .raw stacks: {"width": ..., "height": ..., "dtype": ...}.
+    Returns:
+        Array of shape [num_frames, height, width].
+    Raises:
+        ValueError: If the stack cannot be read or its layout is not supported.
+    """
+    file_path = Path(file_path)
+    suffix = file_path.suffix.lower()
+    source = source or {}
+    if suffix == ".npy":
+        stack = np.load(file_path, mmap_mode="r")
+    elif suffix == ".raw":
+        if not source.get("width") or not source.get("height"):
+            raise ValueError("The width and height of a .raw stack must be given")
+        dtype = np.dtype(source.get("dtype", "uint16")).newbyteorder("<")
+        frame_size = int(source["width"]) * int(source["height"]) * dtype.itemsize
+        num_frames = file_path.stat().st_size // frame_size
+        if num_frames == 0:
+            raise ValueError("The .raw stack is smaller than one frame")
+        stack = np.memmap(file_path, dtype=dtype, mode="r", shape=(num_frames, int(source["height"]), int(source["width"])))
+    elif suffix in (".tif", ".tiff"):
+        if tifffile is None:
+            raise ValueError("Reading TIFF stacks requires the tifffile package")
+        try:
+            stack = tifffile.memmap(file_path, mode="r")
+        except ValueError:
+            # compressed or non-contiguous pages cannot be memory-mapped
+            logger.warning(f"{file_path.name} cannot be memory-mapped, reading it into memory")
+            stack = tifffile.imread(file_path)
+    else:
+        raise ValueError(f"Unsupported radiometric format: {suffix}")
+
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+    if stack.ndim != 3:
+        raise ValueError(f"Expected a stack of single-channel frames, got an array of shape {stack.shape}")
+    if stack.dtype.newbyteorder("=") not in [np.dtype(t) for t in SUPPORTED_DTYPES]:
+        raise ValueError(f"Unsupported radiometric data type: {stack.dtype}")
+    return stack
+
+
+def display_range(stack: np.ndarray) -> Tuple[float, float]:
+    """Range of values spread over the 8-bit view, from percentiles of frames sampled across the stack."""
+    sample_indices = np.linspace(0, len(stack) - 1, min(len(stack), DISPLAY_SAMPLE_FRAMES)).astype(int)
+    sample = np.asarray(stack[np.unique(sample_indices)])
+    low, high = np.percentile(sample, DISPLAY_PERCENTILES)
+    if high <= low:
+        high = low + 1
+    return float(low), float(high)
+
+
+def to_uint8(frame: np.ndarray, value_range: Tuple[float, float]) -> np.ndarray:
+    """Normalized 8-bit view of a radiometric frame, with the given range spread over 0..255."""
+    low, high = value_range
+    scaled = (frame.astype(np.float32) - low) * (255.0 / (high - low))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def histogram_range(value_min: float, value_max: float, dtype: np.dtype) -> Tuple[float, float]:
+    """Default half-open histogram range covering all values of a stack."""
+    if np.issubdtype(dtype, np.integer):
+        return float(value_min), float(value_max) + 1
+    return float(value_min), float(np.nextafter(np.float32(value_max), np.float32(np.inf)))
@@ -0,0 +1,211 @@
+import json
+import struct
+import logging
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Binary mask transport.
+#
+# A binary payload is a stream header followed by any number of self-delimiting frame records.
+# All integers are little-endian.
+#
+#   header := b"TSM1" | uint32 metadata_length | metadata (utf-8 JSON object)
+#   record := uint32 body_length | body
+#   body   := uint32 frame_idx
+#             uint16 num_objects
+#             uint8  mask_encoding           (MASK_ENCODING_BITPACK or MASK_ENCODING_RLE)
+#             uint8  num_channels            (histogram channels, 0 if the record has no histograms)
+#             uint32 height
+#             uint32 width
+#             uint32 num_bins                (0 if the record has no histograms)
+#             int32[num_objects] object_ids
+#             uint32 mask_payload_length
+#             bytes[mask_payload_length] mask_payload
+#             int32[num_channels * num_objects * num_bins] histograms
+#
+# A stream that fails part way ends with an error record instead, whose body is the uint32
+# ERROR_RECORD_FRAME_IDX followed by a utf-8 JSON object {"status": "error", "message": ...}, as
+# the last line of a newline-delimited JSON stream would be.
+#
+# Bit-packed masks are the (num_objects, height, width) array flattened in C order, 8 pixels per
+# byte, least significant bit first. Run-length encoded masks store, for each object, a uint32 run
+# count followed by that many uint32 run lengths over the flattened (height, width) mask, alternating
+# between background and foreground and always starting with background (the first run may be 0).
+
+STREAM_MAGIC = b"TSM1"
+BINARY_CONTENT_TYPE = "application/octet-stream"
+
+MASK_ENCODING_BITPACK = 0
+MASK_ENCODING_RLE = 1
+MASK_ENCODINGS = {"bitpack": MASK_ENCODING_BITPACK, "rle": MASK_ENCODING_RLE}
+
+_RECORD_HEADER = struct.Struct("<IHBBIII")
+ERROR_RECORD_FRAME_IDX = 0xFFFFFFFF
+
+
+def encode_stream_header(metadata: Optional[Dict[str, Any]] = None) -> bytes:
+    """Encode the header that precedes the frame records of a binary payload.
+
+    Args:
+        metadata: JSON-serializable metadata shared by all records (e.g. histogram bin edges).
+    Returns:
+        The encoded header.
+    """
+    metadata_bytes = json.dumps(metadata or {}).encode("utf-8")
+    return STREAM_MAGIC + struct.pack("<I", len(metadata_bytes)) + metadata_bytes
+
+
+def encode_masks_bitpack(masks: np.ndarray) -> bytes:
+    """Bit-pack masks of shape (C, H, W) with values 0 and 1, 8 pixels per byte."""
+    return np.packbits(masks.reshape(-1) > 0, bitorder="little").tobytes()
+
+
+def decode_masks_bitpack(payload: bytes, shape: Tuple[int, int, int]) -> np.ndarray:
+    """Inverse of encode_masks_bitpack. Returns uint8 masks of the given (C, H, W) shape."""
+    count = shape[0] * shape[1] * shape[2]
+    bits = np.unpackbits(np.frombuffer(payload, dtype=np.uint8), count=count, bitorder="little")
+    return bits.reshape(shape)
+
+
+def encode_masks_rle(masks: np.ndarray) -> bytes:
+    """Run-length encode masks of shape (C, H, W) with values 0 and 1, object by object."""
+    chunks = []
+    for obj_mask in masks.reshape(masks.shape[0], -1):
+        obj_mask = obj_mask > 0
+        # indices at which the value changes, bracketed by the start and the end of the mask
+        change_points = np.flatnonzero(obj_mask[1:] != obj_mask[:-1]) + 1
+        boundaries = np.concatenate(([0], change_points, [obj_mask.size]))
+        runs = np.diff(boundaries)
+        if obj_mask.size and obj_mask[0]:
+            runs = np.concatenate(([0], runs))  # runs always start with background
+        chunks.append(struct.pack("<I", len(runs)))
+        chunks.append(runs.astype("<u4").tobytes())
+    return b"".join(chunks)
+
+
+def decode_masks_rle(payload: bytes, shape: Tuple[int, int, int]) -> np.ndarray:
+    """Inverse of encode_masks_rle. Returns uint8 masks of the given (C, H, W) shape."""
+    num_objects, height, width = shape
+    masks = np.zeros((num_objects, height * width), dtype=np.uint8)
+    offset = 0
+    for obj_idx in range(num_objects):
+        (num_runs,) = struct.unpack_from("<I", payload, offset)
+        offset += 4
+        runs = np.frombuffer(payload, dtype="<u4", count=num_runs, offset=offset)
+        offset += 4 * num_runs
+        # runs alternate between background (even) and foreground (odd)
+        masks[obj_idx] = np.repeat(np.arange(num_runs, dtype=np.uint8) % 2, runs)
+    return masks.reshape(shape)
+
+
+def encode_frame_record(
+    frame_idx: int,
+    obj_ids: List[int],
+    masks: np.ndarray,
+    histograms: Optional[np.ndarray] = None,
+    encoding: str = "bitpack",
+) -> bytes:
+    """Encode masks (and optionally histograms) of a single frame as a binary record.
+
+    Args:
+        frame_idx: The index of the frame.
+        obj_ids: Object ids, one for each channel of the mask.
+        masks: Masks of shape (C, H, W), of type uint8 with values 0 and 1.
+        histograms: Optional histograms of the frame of shape [N, C, num_bins].
+        encoding: Mask encoding, one of MASK_ENCODINGS.
+    Returns:
+        The encoded record, including its length prefix.
+    """
+    num_objects, height, width = masks.shape
+    if len(obj_ids) != num_objects:
+        raise ValueError(f"Got {len(obj_ids)} object ids for {num_objects} masks")
+    mask_encoding = MASK_ENCODINGS[encoding]
+    if mask_encoding == MASK_ENCODING_RLE:
+        mask_payload = encode_masks_rle(masks)
+    else:
+        mask_payload = encode_masks_bitpack(masks)
+
+    if histograms is None:
+        num_channels, num_bins, histogram_payload = 0, 0, b""
+    else:
+        num_channels, _, num_bins = histograms.shape
+        histogram_payload = np.ascontiguousarray(histograms, dtype="<i4").tobytes()
+
+    body = b"".join((
+        _RECORD_HEADER.pack(frame_idx, num_objects, mask_encoding, num_channels, height, width, num_bins),
+        np.asarray(obj_ids, dtype="<i4").tobytes(),
+        struct.pack("<I", len(mask_payload)),
+        mask_payload,
+        histogram_payload,
+    ))
+    return struct.pack("<I", len(body)) + body
+
+
+def encode_error_record(message: str) -> bytes:
+    """Encode the error record that ends a stream that failed part way.
+
+    Returns:
+        The encoded record, including its length prefix.
+    """
+    body = struct.pack("<I", ERROR_RECORD_FRAME_IDX) + json.dumps({"status": "error", "message": message}).encode("utf-8")
+    return struct.pack("<I", len(body)) + body
+
+
+def decode_frame_record(body: bytes) -> Dict[str, Any]:
+    """Decode the body of a frame record (without its length prefix).
+
+    Returns:
+        Dictionary with keys "frame_idx", "obj_ids", "masks" of shape (C, H, W)
+        and "histograms" of shape [N, C, num_bins] (None if the record has no histograms).
+        For an error record, the dictionary {"status": "error", "message": ...} instead.
+    """
+    (frame_idx,) = struct.unpack_from("<I", body, 0)
+    if frame_idx == ERROR_RECORD_FRAME_IDX:
+        return json.loads(body[4:].decode("utf-8"))
+    frame_idx, num_objects, mask_encoding, num_channels, height, width, num_bins = \
+        _RECORD_HEADER.unpack_from(body, 0)
+    offset = _RECORD_HEADER.size
+    obj_ids = np.frombuffer(body, dtype="<i4", count=num_objects, offset=offset).tolist()
+    offset += 4 * num_objects
+    (mask_payload_length,) = struct.unpack_from("<I", body, offset)
+    offset += 4
+    mask_payload = body[offset:offset + mask_payload_length]
+    offset += mask_payload_length
+
+    shape = (num_objects, height, width)
+    if mask_encoding == MASK_ENCODING_RLE:
+        masks = decode_masks_rle(mask_payload, shape)
+    else:
+        masks = decode_masks_bitpack(mask_payload, shape)
+
+    histograms = None
+    if num_channels:
+        histograms = np.frombuffer(
+            body, dtype="<i4", count=num_channels * num_objects * num_bins, offset=offset
+        ).reshape(num_channels, num_objects, num_bins)
+    return {"frame_idx": frame_idx, "obj_ids": obj_ids, "masks": masks, "histograms": histograms}
+
+
+def decode_stream(payload: bytes) -> Tuple[Dict[str, Any], Iterator[Dict[str, Any]]]:
+    """Decode a binary payload produced by encode_stream_header followed by frame records.
+
+    Returns:
+        Tuple of the stream metadata and an iterator over decoded frame records.
+    """
+    if payload[:4] != STREAM_MAGIC:
+        raise ValueError("Not a binary mask stream")
+    (metadata_length,) = struct.unpack_from("<I", payload, 4)
+    metadata = json.loads(payload[8:8 + metadata_length].decode("utf-8"))
+
+    def records():
+        offset = 8 + metadata_length
+        while offset < len(payload):
+            (body_length,) = struct.unpack_from("<I", payload, offset)
+            offset += 4
+            yield decode_frame_record(payload[offset:offset + body_length])
+            offset += body_length
+
+    return metadata, records()
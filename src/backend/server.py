@@ -1,16 +1,57 @@
 import os
+import asyncio
+import fcntl
+import hashlib
+import json
+import shutil
+import time
+import uuid
 import aiofiles
 import numpy as np
 import cv2
 from aiohttp import web
+from contextlib import aclosing
 from pathlib import Path
+from collections import OrderedDict
 from datetime import datetime
 import logging
-from typing import Dict, List, TypedDict
-import torch
-from sam2.build_sam import build_sam2_video_predictor
+from typing import Any, Dict, List, Tuple
 
-from insights import compute_histograms
+from embedding_cache import CachedFeatures, EmbeddingCache, InferenceState, suspend_admission
+from export import EXPORT_FORMATS, check_export_format, iter_parquet, write_hdf5
+from frame_images import (
+    IMAGE_FORMATS,
+    ImageCache,
+    encode_frame_image,
+    encode_thumbnail_strip,
+    etag_matches,
+    get_image_options,
+    get_strip_range,
+    make_etag,
+    parse_range,
+)
+from frame_store import FrameStore, FrameWindow, enforce_stores_size_limit, evicted_meta, meta_video_info, read_store_meta
+from inference_pool import InferencePool, InferenceQueueFull
+from insights import (
+    DEFAULT_BINS,
+    DEFAULT_PERCENTILES,
+    DEFAULT_VALUE_RANGE,
+    STATS_CHUNK_FRAMES,
+    FrameReader,
+    chunk_histograms,
+    compute_frame_histograms,
+    compute_timelines,
+    downsample_timelines,
+    histogram_bin_edges,
+)
+from jobs import ACTIVE_STATUSES, CANCELLED, COMPLETED, FAILED, QUEUED, RESUMABLE_STATUSES, Job, JobRegistry
+import radiometric
+from mask_cache import CacheEntry, CacheWriter, MaskCache, cache_key, hash_file
+import metrics
+from metrics import RequestTimings, current_timings, record_stage, stage
+from preview import KeyframeMasks, frame_thumbnails, get_preview_options, interpolate_masks, keyframe_schedule
+from serialization import BINARY_CONTENT_TYPE, MASK_ENCODINGS, encode_error_record, encode_frame_record, encode_stream_header
+from sessions import PromptPoint, Session, SessionRegistry
 
 # Configure logging
 logging.basicConfig(
@@ -19,7 +60,22 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-torch.autocast("cpu", dtype=torch.bfloat16).__enter__()
+# torch and sam2 take seconds to import: they are imported by init_sam2, off the event loop, so that the
+# server accepts connections (static files, uploads, frames) while the model loads
+torch = None
+build_sam2_video_predictor = None
+
+def import_model_libraries():
+    """Import torch and sam2, unless done already (or, for build_sam2_video_predictor, replaced, e.g. by benchmarks)."""
+    global torch, build_sam2_video_predictor
+    if torch is None:
+        import torch
+    if build_sam2_video_predictor is None:
+        from sam2.build_sam import build_sam2_video_predictor
+
+def enter_autocast():
+    """Enter bfloat16 autocast for the calling thread (autocast state is thread-local)."""
+    torch.autocast("cpu", dtype=torch.bfloat16).__enter__()
 
 DEBUG = True
 
@@ -29,47 +85,136 @@ DATA_DIR = BASE_DIR / "data"
 UPLOAD_DIR = DATA_DIR / "videos"
 MASKS_DIR = DATA_DIR / "masks"
 MODEL_DIR = DATA_DIR / "models"
+FRAMES_DIR = DATA_DIR / "frames"
+JOBS_DIR = DATA_DIR / "jobs"
+EXPORTS_DIR = DATA_DIR / "exports"  # HDF5 exports being written, removed once sent, in a directory per server process
 
 # SAM2 model configuration
 MODEL_CONFIG = "configs/sam2.1/sam2.1_hiera_t.yaml"  # internal to sam2 package, do not change
 MODEL_CHECKPOINT = MODEL_DIR /"sam2.1_hiera_tiny.pt"
+MODEL_IMAGE_SIZE = 1024  # image_size of MODEL_CONFIG, recorded in frame stores before the model is loaded
+
+# Size limit of the cache of processed videos in MASKS_DIR; least recently used entries beyond it are evicted
+MASK_CACHE_SIZE = int(os.environ.get("THERMAL_STUDIO_MASK_CACHE_MB", "4096")) * 2**20
+
+# Size limit of the frame stores in FRAMES_DIR; the frames of the least recently used idle recordings beyond it are evicted
+FRAME_STORE_SIZE = int(os.environ.get("THERMAL_STUDIO_FRAME_STORE_MB", "16384")) * 2**20
+
+# Memory budget for the SAM2 inference states of all sessions; idle sessions beyond it are evicted, least recently used first
+SESSION_MEMORY_BUDGET = int(os.environ.get("THERMAL_STUDIO_SESSION_MEMORY_MB", "8192")) * 2**20
+
+# Budget for the image features of frames kept across clicks (see embedding_cache.py), and number of frames
+# around the prompted frame or the scrub position whose features are computed ahead of use when the server is idle
+EMBEDDING_CACHE_SIZE = int(os.environ.get("THERMAL_STUDIO_EMBEDDING_CACHE_MB", "2048")) * 2**20
+PREFETCH_RADIUS = int(os.environ.get("THERMAL_STUDIO_PREFETCH_RADIUS", "4"))
+
+# Normalized input frames of SAM2 kept by each inference state, around the frame being prompted or propagated,
+# and number of them read ahead of the frame; a 1024x1024 frame takes 12 MiB
+FRAME_WINDOW_SIZE = int(os.environ.get("THERMAL_STUDIO_FRAME_WINDOW", "16"))
+FRAME_READ_AHEAD = int(os.environ.get("THERMAL_STUDIO_FRAME_READ_AHEAD", "8"))
+
+# Budget for the encoded frames and thumbnail strips served by /frames (see frame_images.py)
+FRAME_IMAGE_CACHE_SIZE = int(os.environ.get("THERMAL_STUDIO_FRAME_IMAGE_CACHE_MB", "256")) * 2**20
+
+# Model calls run on a pool of worker threads, off the event loop; requests beyond the queue depth get a 503
+INFERENCE_WORKERS = int(os.environ.get("THERMAL_STUDIO_INFERENCE_WORKERS", "1"))
+INFERENCE_QUEUE_DEPTH = int(os.environ.get("THERMAL_STUDIO_INFERENCE_QUEUE_DEPTH", "8"))
+
+# Add a Server-Timing header with the duration of the processing stages to responses (see metrics.py)
+SERVER_TIMING = os.environ.get("THERMAL_STUDIO_SERVER_TIMING", "0") == "1"
 
 # Ensure directories exist
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 MASKS_DIR.mkdir(parents=True, exist_ok=True)
 MODEL_DIR.mkdir(parents=True, exist_ok=True)
+FRAMES_DIR.mkdir(parents=True, exist_ok=True)
+JOBS_DIR.mkdir(parents=True, exist_ok=True)
+EXPORTS_DIR.mkdir(parents=True, exist_ok=True)
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+# Number of points of each series returned by the stats endpoints, unless requested otherwise
+DEFAULT_TIMELINE_POINTS = 1000
+MAX_TIMELINE_POINTS = 100_000
 
 # Global variables
-sam2_predictor = None
-video_cache = {}
-inference_state = None
-current_video_path = None  # Add global variable to track current video path
-
-class PromptPoint(TypedDict):
-    x: float
-    y: float
-    label: int  # 1 for positive, 0 for negative
-    obj_id: int  # object id of the prompt point
-    frame_idx: int  # frame index of the prompt point
+sam2_predictor = None  # set once the model is loaded and warmed up
+inference_pool = InferencePool(INFERENCE_WORKERS, INFERENCE_QUEUE_DEPTH, initializer=enter_autocast)
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_SIZE)
+prefetch_tasks: Dict[str, asyncio.Task] = {}  # background feature prefetch of each session
+# Loading state of the model, reported by /healthz and /readyz: state is one of
+# not_loaded, importing, loading, warming_up, ready and failed
+model_status: Dict[str, Any] = {"state": "not_loaded", "error": None, "load_seconds": None, "warmup_seconds": None}
+model_task: asyncio.Task | None = None
+# State of the data left by previous runs (jobs, cache, uploads), loaded in the background at startup:
+# one of loading, ready and failed, reported by /healthz and /readyz like the model
+data_status: Dict[str, Any] = {"state": "loading", "error": None, "load_seconds": None}
+data_task: asyncio.Task | None = None
+process_started_at = time.time()  # runs of older processes left their temporary files before it
+# Name of the directory of the exports of this process under EXPORTS_DIR, and the lock held on it (see get_process_exports_dir)
+process_exports_name = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+process_exports_lock: Tuple[Path, Any] | None = None
+
+def build_predictor():
+    predictor = build_sam2_video_predictor(
+        MODEL_CONFIG, MODEL_CHECKPOINT, device="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    if predictor.image_size != MODEL_IMAGE_SIZE:
+        raise RuntimeError(f"The model takes {predictor.image_size} pixel frames, not MODEL_IMAGE_SIZE ({MODEL_IMAGE_SIZE})")
+    return predictor
+
+def warm_up(predictor) -> None:
+    """
+    Run the image encoder once on a synthetic frame, a warm blob over a cooler gradient, so that one-time
+    costs (kernel selection, allocations, lazy initialization) are not paid by the first request.
+    """
+    size = predictor.image_size
+    ramp = torch.linspace(-1.0, 1.0, size)
+    blob = torch.exp(-(ramp[:, None] ** 2 + ramp[None, :] ** 2) * 8.0)
+    image = (0.3 * ramp[:, None] + 2.0 * blob).expand(1, 3, size, size)
+    with torch.inference_mode():
+        predictor.forward_image(image.to(predictor.device))
 
 # Initialize SAM2 model
-async def init_sam2():
-    """Initialize the SAM2 model"""
+async def init_sam2() -> bool:
+    """
+    Load the SAM2 model and warm it up, off the event loop. The model is only made available to requests once warmed up.
+
+    Returns:
+        Whether the model was loaded.
+    """
     global sam2_predictor
     try:
-        sam2_predictor = build_sam2_video_predictor(
-            MODEL_CONFIG, MODEL_CHECKPOINT, device="cuda" if torch.cuda.is_available() else "cpu"
-        )
+        start_time = time.perf_counter()
+        model_status.update(state="importing", error=None)
+        await asyncio.to_thread(import_model_libraries)
+        # on the inference workers, whose thread-local torch contexts the model is used with
+        model_status["state"] = "loading"
+        predictor = await inference_pool.run(build_predictor)
+        load_seconds = time.perf_counter() - start_time
+        metrics.model_load_seconds.set(load_seconds)
+
+        model_status["state"] = "warming_up"
+        start_time = time.perf_counter()
+        await inference_pool.run(warm_up, predictor)
+        warmup_seconds = time.perf_counter() - start_time
+        metrics.model_warmup_seconds.set(warmup_seconds)
+
+        sam2_predictor = predictor
+        model_status.update(state="ready", load_seconds=load_seconds, warmup_seconds=warmup_seconds)
+        logger.info(f"SAM2 loaded in {load_seconds:.1f} s and warmed up in {warmup_seconds:.1f} s")
         return True
     except Exception as e:
         logger.error(f"Error initializing SAM2: {e}")
+        model_status.update(state="failed", error=str(e))
         return False
 
-async def get_masks_of_many_frames(sam2_predictor, start_frame_idx: int = 0, num_frames: int | None = None) -> np.ndarray:
+async def get_masks_of_many_frames(sam2_predictor, inference_state, start_frame_idx: int = 0, num_frames: int | None = None) -> np.ndarray:
     """Process num_frames of the video with the prompts applied by the user so far.
 
     Args:
-        sam2_predictor: The SAM2 predictor object, with proper state of prompts.
+        sam2_predictor: The SAM2 predictor object.
+        inference_state: The inference state of the session, with proper state of prompts.
         start_frame_idx: The index of the first frame to process.
         num_frames: The number of frames to process. If None, all frames will be processed.
 
@@ -81,29 +226,47 @@ async def get_masks_of_many_frames(sam2_predictor, start_frame_idx: int = 0, num
         The masks are returned as a numpy array of type uint8, of values 0 and 1,
         where 1 means the pixel is part of the mask.
     """
-    global inference_state
-
     if inference_state is None:
         raise RuntimeError("Inference state not initialized. Please upload a video first.")
     
     if DEBUG:
         logger.debug(f"Processing {num_frames} frames starting from {start_frame_idx}")
 
-    for frame_idx, object_ids, masks in sam2_predictor.propagate_in_video(
-            inference_state=inference_state,
-            start_frame_idx=start_frame_idx,
-            max_frame_num_to_track=num_frames,
-        ):
-        masks = masks.detach().cpu().numpy()
-        masks = masks[:, 0]  # Remove batch dimension
-        masks = (masks > 0).astype(np.uint8)
-        yield frame_idx, masks
-
-async def get_mask_of_a_single_frame(sam2_predictor, frame_idx: int) -> np.ndarray:
+    def propagate():
+        # features of the frames of a long propagation would flush those of the frames the user prompts
+        with suspend_admission(inference_state):
+            propagation = sam2_predictor.propagate_in_video(
+                inference_state=inference_state,
+                start_frame_idx=start_frame_idx,
+                # number of frames tracked after the start frame
+                max_frame_num_to_track=max(num_frames - 1, 0) if num_frames is not None else None,
+            )
+            try:
+                while True:
+                    with stage("propagate"):
+                        step = next(propagation, None)
+                    if step is None:
+                        break
+                    frame_idx, object_ids, masks = step
+                    with stage("copy_to_host"):
+                        masks = masks.detach().cpu().numpy()
+                        masks = masks[:, 0]  # Remove batch dimension
+                        masks = (masks > 0).astype(np.uint8)
+                    yield frame_idx, masks
+            finally:
+                propagation.close()
+
+    # each frame is propagated on a worker thread, so the event loop keeps serving other requests
+    async with aclosing(inference_pool.iterate(propagate())) as propagated:
+        async for frame_idx, masks in propagated:
+            yield frame_idx, masks
+
+async def get_mask_of_a_single_frame(sam2_predictor, inference_state, frame_idx: int) -> np.ndarray:
     """Process a single frame of the video with the prompts applied by the user so far.
 
     Args:
-        sam2_predictor: The SAM2 predictor object, with proper state of prompts.
+        sam2_predictor: The SAM2 predictor object.
+        inference_state: The inference state of the session, with proper state of prompts.
         frame_idx: The index of the frame to process.
     Returns:
         Numpy array of the mask of shape (C, H, W).
@@ -111,17 +274,166 @@ async def get_mask_of_a_single_frame(sam2_predictor, frame_idx: int) -> np.ndarr
         where 1 means the pixel is part of the mask.
     """
     mask = None
-    async for _frame_idx, mask in get_masks_of_many_frames(sam2_predictor, frame_idx, 1):  # only one frame
+    async for _frame_idx, mask in get_masks_of_many_frames(sam2_predictor, inference_state, frame_idx, 1):  # only one frame
         pass
     if _frame_idx != frame_idx:
         logger.warning(f"Frame index mismatch: {_frame_idx} != {frame_idx}")
     return mask
 
+def group_prompts(all_prompts: List[PromptPoint]) -> Dict[Tuple[int, int], List[PromptPoint]]:
+    """Group prompts by (frame_index, object_id) tuple."""
+    prompts_by_frame_idx_and_obj_id = {}
+    for prompt in all_prompts:
+        if (prompt["frame_idx"], prompt["obj_id"]) not in prompts_by_frame_idx_and_obj_id:
+            prompts_by_frame_idx_and_obj_id[(prompt["frame_idx"], prompt["obj_id"])] = []
+        prompts_by_frame_idx_and_obj_id[(prompt["frame_idx"], prompt["obj_id"])].append(prompt)
+    return prompts_by_frame_idx_and_obj_id
+
+def prompt_values(prompts: List[PromptPoint]) -> List[Tuple[float, float, int]]:
+    """The points of a prompt group, for comparing groups regardless of the other keys of the prompts."""
+    return [(prompt["x"], prompt["y"], prompt["label"]) for prompt in prompts]
+
+def apply_prompts(inference_state, all_prompts: List[PromptPoint]) -> None:
+    """
+    Add prompt points to the inference state, grouped by frame and object.
+
+    Args:
+        inference_state: The inference state of the session.
+        all_prompts: List of prompt points with x, y coordinates, a label (positive, negative prompt),
+                    an object id, and a frame index
+    """
+    for (frame_idx, obj_id), prompts in group_prompts(all_prompts).items():
+        add_prompt_group(inference_state, frame_idx, obj_id, prompts)
+
+def add_prompt_group(inference_state, frame_idx: int, obj_id: int, prompts: List[PromptPoint]) -> None:
+    """Add the prompt points of one object on one frame to the inference state, replacing its previous points there."""
+    # Prepare points and labels
+    points = []
+    labels = []
+    
+    # Handle both single point and array of points
+    if isinstance(prompts, dict):
+        # Single point case
+        points.append([prompts["x"], prompts["y"]])
+        labels.append(prompts["label"])
+    else:
+        # Array of points case
+        for prompt in prompts:
+            points.append([prompt["x"], prompt["y"]])
+            labels.append(prompt["label"])
+    
+    if DEBUG:
+        logger.debug(f"Processing {len(points)} points for object {obj_id} in frame {frame_idx}:")
+        for i, (point, label) in enumerate(zip(points, labels)):
+            logger.debug(f"  Point {i + 1}: ({point[0]:.2f}, {point[1]:.2f}) - {'Positive' if label > 0 else 'Negative'}, {label=}")
+    
+    # Convert to numpy arrays
+    points = np.array(points)
+    labels = np.array(labels)
+    
+    # Process frame with SAM2
+    if len(points) > 0:            
+        if DEBUG:
+            logger.debug(f"Calling SAM2 model with {len(points)} points")
+        
+        # Add points to the model
+        processed_frame_idx, obj_ids, masks_frame = sam2_predictor.add_new_points_or_box(
+            inference_state=inference_state,
+            frame_idx=frame_idx,
+            obj_id=obj_id,
+            points=points,
+            labels=labels,
+            clear_old_points=True
+        )
+        if DEBUG:
+            # lets see what obj_ids are
+            logger.debug(f"Object IDs: {obj_ids}")
+        if processed_frame_idx != frame_idx:
+            logger.warning(f"Frame index mismatch: {processed_frame_idx} != {frame_idx}")
+        
+        if DEBUG:
+            logger.debug(f"Generated mask for frame {processed_frame_idx}")
+            if masks_frame is not None:
+                logger.debug(f"Mask shape: {masks_frame.shape}")
+
+def apply_prompt_changes(inference_state, old_prompts: List[PromptPoint], new_prompts: List[PromptPoint]) -> set:
+    """
+    Bring the inference state from the old prompts to the new prompts, touching only what changed.
+
+    Returns:
+        The indices of the frames whose prompts were added, changed or removed.
+    """
+    old_groups = group_prompts(old_prompts)
+    new_groups = group_prompts(new_prompts)
+    removed_obj_ids = {obj_id for _, obj_id in old_groups} - {obj_id for _, obj_id in new_groups}
+    changed_frames = set()
+
+    # objects without any prompt left are dropped from the state altogether
+    for obj_id in removed_obj_ids:
+        sam2_predictor.remove_object(inference_state, obj_id, need_output=False)
+    for frame_idx, obj_id in old_groups.keys() - new_groups.keys():
+        changed_frames.add(frame_idx)
+        if obj_id not in removed_obj_ids:
+            sam2_predictor.clear_all_prompts_in_frame(inference_state, frame_idx, obj_id, need_output=False)
+            drop_frame_outputs(inference_state, frame_idx, obj_id)
+    # only the (frame, object) groups whose points changed are sent to SAM2 again
+    for (frame_idx, obj_id), prompts in new_groups.items():
+        if prompt_values(old_groups.get((frame_idx, obj_id), [])) == prompt_values(prompts):
+            continue
+        changed_frames.add(frame_idx)
+        if (frame_idx, obj_id) in old_groups:
+            sam2_predictor.clear_all_prompts_in_frame(inference_state, frame_idx, obj_id, need_output=False)
+        drop_frame_outputs(inference_state, frame_idx, obj_id)
+        add_prompt_group(inference_state, frame_idx, obj_id, prompts)
+    return changed_frames
+
+def drop_frame_outputs(inference_state, frame_idx: int, obj_id: int) -> None:
+    """
+    Forget every output of an object on a frame, so that its mask there only depends on its current points.
+
+    clear_all_prompts_in_frame keeps the output of the cleared points as a non-conditioning output, and
+    add_new_points_or_box feeds the previous output of a frame to the mask decoder along with the new
+    points: a removed or moved point would otherwise still shape the mask, unlike prompts applied from scratch.
+    The frame is also no longer tracked: the mask of a tracked frame is conditioned on the memory of other
+    frames when points are added to it, while points added to an untracked frame start from nothing.
+    """
+    obj_idx = inference_state["obj_id_to_idx"].get(obj_id)
+    if obj_idx is None:
+        return
+    for outputs in (inference_state["output_dict_per_obj"][obj_idx], inference_state["temp_output_dict_per_obj"][obj_idx]):
+        outputs["cond_frame_outputs"].pop(frame_idx, None)
+        outputs["non_cond_frame_outputs"].pop(frame_idx, None)
+    inference_state["frames_tracked_per_obj"][obj_idx].pop(frame_idx, None)
+
+async def update_session_prompts(session: Session, inference_state, all_prompts: List[PromptPoint]) -> set:
+    """
+    Apply new prompts to the inference state of a session, incrementally (see apply_prompt_changes).
+
+    If applying fails midway, the state is reset and the session forgets its prompts,
+    so that all prompts are re-applied on the next request.
+
+    Returns:
+        The indices of the frames whose prompts changed.
+    """
+    try:
+        changed_frames = await inference_pool.run(apply_prompt_changes, inference_state, session.prompts, all_prompts)
+    except Exception:
+        await inference_pool.run(sam2_predictor.reset_state, inference_state)
+        session.prompts = []
+        session.frame_masks = {}
+        raise
+    session.prompts = list(all_prompts)
+    return changed_frames
+
 # Process frame with prompts
-async def process_frame_with_prompts(all_prompts: List[PromptPoint]) -> Dict[int, np.ndarray]:
+async def process_frame_with_prompts(session: Session, inference_state, all_prompts: List[PromptPoint]) -> Dict[int, np.ndarray]:
     """
     Process a frame with the given prompts using SAM2.
 
+    The prompts are applied incrementally: they are compared with the prompts the session applied last, and
+    only the (frame, object) groups that were added, changed or removed are sent to SAM2. A click therefore
+    costs one decoder pass for the touched object, regardless of how many prompts were placed before.
+
     This function is utilized when user is prompting. It is invoked on each prompt-point placement the user makes.
     It returns the mask of the frame with the prompt-points applied by the SAM2 model. The user then can see this mask
     to see the model's prediction for the mask of the current frame.
@@ -129,12 +441,14 @@ async def process_frame_with_prompts(all_prompts: List[PromptPoint]) -> Dict[int
     return masks for all frames, but this function will not be used then.
     
     Args:
+        session: The session of the recording being prompted. Its prompts and masks are updated.
+        inference_state: The inference state of the session.
         all_prompts: List of prompt points with x, y coordinates, a label (positive, negative prompt), 
                     an object id, and a frame index
         
     Returns:
         Mapping of frame_idx to numpy array of the mask of shape (C, H, W).
-        The whole video will not be processed. Only the frames present in all_prompts will be processed.
+        The whole video will not be processed. Only the prompted frames whose prompts changed will be processed.
     """
     global sam2_predictor
 
@@ -146,91 +460,893 @@ async def process_frame_with_prompts(all_prompts: List[PromptPoint]) -> Dict[int
             logger.debug("\n=== Starting Video Processing ===")
             logger.debug(f"\nPrompts: {all_prompts}")
 
-        sam2_predictor.reset_state(inference_state)
+        changed_frames = await update_session_prompts(session, inference_state, all_prompts)
 
-        # group prompts by (frame_index, object_id) tuple
-        prompts_by_frame_idx_and_obj_id = {}
-        for prompt in all_prompts:
-            if (prompt["frame_idx"], prompt["obj_id"]) not in prompts_by_frame_idx_and_obj_id:
-                prompts_by_frame_idx_and_obj_id[(prompt["frame_idx"], prompt["obj_id"])] = []
-            prompts_by_frame_idx_and_obj_id[(prompt["frame_idx"], prompt["obj_id"])].append(prompt)
-        
-        for (frame_idx, obj_id), prompts in prompts_by_frame_idx_and_obj_id.items():
-            # Prepare points and labels
-            points = []
-            labels = []
-            
-            # Handle both single point and array of points
-            if isinstance(prompts, dict):
-                # Single point case
-                points.append([prompts["x"], prompts["y"]])
-                labels.append(prompts["label"])
-            else:
-                # Array of points case
-                for prompt in prompts:
-                    points.append([prompt["x"], prompt["y"]])
-                    labels.append(prompt["label"])
-            
-            if DEBUG:
-                logger.debug(f"Processing {len(points)} points for object {obj_id} in frame {frame_idx}:")
-                for i, (point, label) in enumerate(zip(points, labels)):
-                    logger.debug(f"  Point {i + 1}: ({point[0]:.2f}, {point[1]:.2f}) - {'Positive' if label > 0 else 'Negative'}, {label=}")
-            
-            # Convert to numpy arrays
-            points = np.array(points)
-            labels = np.array(labels)
-            
-            # Process frame with SAM2
-            if len(points) > 0:            
-                if DEBUG:
-                    logger.debug(f"Calling SAM2 model with {len(points)} points")
-                
-                # Add points to the model
-                processed_frame_idx, obj_ids, masks_frame = sam2_predictor.add_new_points_or_box(
-                    inference_state=inference_state,
-                    frame_idx=frame_idx,
-                    obj_id=obj_id,
-                    points=points,
-                    labels=labels,
-                    clear_old_points=True
-                )
-                if DEBUG:
-                    # lets see what obj_ids are
-                    logger.debug(f"Object IDs: {obj_ids}")
-                if processed_frame_idx != frame_idx:
-                    logger.warning(f"Frame index mismatch: {processed_frame_idx} != {frame_idx}")
-                
-                if DEBUG:
-                    logger.debug(f"Generated mask for frame {processed_frame_idx}")
-                    if masks_frame is not None:
-                        logger.debug(f"Mask shape: {masks_frame.shape}")
-                
-        # Get masks for all frames that have prompts
+        if DEBUG:
+            logger.debug(f"Prompts changed on frames {sorted(changed_frames)}")
+
+        # Get masks for the changed frames that still have prompts
+        prompted_frames = {prompt["frame_idx"] for prompt in all_prompts}
         result = {}
-        for frame_idx in list(set([prompt["frame_idx"] for prompt in all_prompts])):
-            masks_frame = await get_mask_of_a_single_frame(sam2_predictor, frame_idx)
+        for frame_idx in sorted(changed_frames & prompted_frames):
+            masks_frame = await get_mask_of_a_single_frame(sam2_predictor, inference_state, frame_idx)
             result[frame_idx] = masks_frame
-        
+        session.frame_masks = {
+            frame_idx: masks for frame_idx, masks in session.frame_masks.items()
+            if frame_idx in prompted_frames and frame_idx not in result
+        }
+        session.frame_masks.update(result)
+
         return result
-    
+
     except Exception as e:
         logger.error(f"Error processing video: {e}")
+        # the state may be partially updated; re-apply all prompts on the next request
+        await inference_pool.run(sam2_predictor.reset_state, inference_state)
+        session.prompts = []
+        session.frame_masks = {}
         raise
 
+class StoreFrames:
+    """
+    The frames of a frame store as SAM2 reads them from inference_state["images"].
+
+    Each frame is converted on access from the uint8 store to a normalized float32 tensor of shape
+    (3, image_size, image_size), like SAM2's own AsyncVideoFrameLoader, instead of holding the whole
+    video as float32 in memory. Converted frames are kept in a FrameWindow of FRAME_WINDOW_SIZE frames,
+    read ahead in the direction of propagation. With `frame_indices`, only these frames of the store
+    are seen by SAM2, as a shorter video (e.g. the keyframes of a preview).
+    """
+
+    def __init__(self, store: FrameStore, frame_indices: List[int] | None = None, img_mean=(0.485, 0.456, 0.406), img_std=(0.229, 0.224, 0.225)):
+        self.store = store
+        self.frame_indices = frame_indices
+        self.img_mean = torch.tensor(img_mean, dtype=torch.float32)[:, None, None]
+        self.img_std = torch.tensor(img_std, dtype=torch.float32)[:, None, None]
+        num_frames = len(frame_indices) if frame_indices is not None else store.num_frames
+        self.window = FrameWindow(self.read, num_frames, FRAME_WINDOW_SIZE, FRAME_READ_AHEAD)
+
+    def __len__(self) -> int:
+        return len(self.window)
+
+    def __getitem__(self, frame_idx: int) -> "torch.Tensor":
+        return self.window[frame_idx]
+
+    def read(self, frame_idx: int) -> "torch.Tensor":
+        if self.frame_indices is not None:
+            frame_idx = self.frame_indices[frame_idx]
+        image = torch.from_numpy(self.store.read_sam_frame(frame_idx).astype(np.float32) / 255.0).permute(2, 0, 1)
+        return (image - self.img_mean) / self.img_std
+
+def init_state_from_store(store: FrameStore, frame_indices: List[int] | None = None):
+    """
+    Initialize a SAM2 inference state that reads its frames from a frame store.
+
+    Same as SAM2VideoPredictor.init_state with offloading of the video and of the state to the CPU,
+    except that the frames are not decoded again nor held in memory, and that the image features of
+    frames are looked up in and added to the shared embedding cache.
+
+    Args:
+        store: The frame store of the recording.
+        frame_indices: Frames of the store the state is made of, if not all of them. Frame indices of
+            the state are then positions in this list.
+    """
+    inference_state = InferenceState()
+    inference_state["images"] = StoreFrames(store, frame_indices)
+    inference_state["num_frames"] = len(inference_state["images"])
+    inference_state["offload_video_to_cpu"] = True  # Save GPU memory
+    inference_state["offload_state_to_cpu"] = True  # Save GPU memory
+    inference_state["video_height"] = store.height
+    inference_state["video_width"] = store.width
+    inference_state["device"] = sam2_predictor.device
+    inference_state["storage_device"] = torch.device("cpu")
+    inference_state["point_inputs_per_obj"] = {}
+    inference_state["mask_inputs_per_obj"] = {}
+    inference_state["cached_features"] = CachedFeatures(
+        embedding_cache, store.video_hash or str(store.store_dir), inference_state["images"], sam2_predictor.device, frame_indices
+    )
+    inference_state["constants"] = {}
+    inference_state["obj_id_to_idx"] = OrderedDict()
+    inference_state["obj_idx_to_id"] = OrderedDict()
+    inference_state["obj_ids"] = []
+    inference_state["output_dict_per_obj"] = {}
+    inference_state["temp_output_dict_per_obj"] = {}
+    inference_state["frames_tracked_per_obj"] = {}
+    # Warm up the visual backbone and cache the image feature on frame 0
+    start_time = time.perf_counter()
+    with torch.inference_mode():
+        sam2_predictor._get_image_feature(inference_state, frame_idx=0, batch_size=1)
+    warmup_seconds = time.perf_counter() - start_time
+    metrics.model_warmup_seconds.set(warmup_seconds)
+    record_stage("warmup", warmup_seconds)
+    return inference_state
+
+def encode_frame(inference_state, frame_idx: int) -> bool:
+    """Compute the image features of a frame into the embedding cache, unless they are cached. Returns whether they were computed."""
+    features = inference_state["cached_features"]
+    if not isinstance(features, CachedFeatures) or frame_idx in features:
+        return False
+    image = inference_state["images"][frame_idx].to(inference_state["device"]).float().unsqueeze(0)
+    with torch.inference_mode():
+        features.prefetch(frame_idx, sam2_predictor.forward_image(image))
+    return True
+
+async def prefetch_frames(session: Session, center_frame_idx: int) -> None:
+    """
+    Compute the features of the frames around a frame, nearest first, while the inference pool is idle.
+
+    Prefetching stops as soon as other work is waiting for the pool or for the session: interactive
+    requests come first. Each frame is encoded with the session lock held, so that the state is not
+    changed, reset or evicted meanwhile.
+    """
+    offsets = [0] + [sign * distance for distance in range(1, PREFETCH_RADIUS + 1) for sign in (1, -1)]
+    computed = 0
+    for offset in offsets:
+        frame_idx = center_frame_idx + offset
+        if inference_pool.pending > 0 or session.lock.locked():
+            break
+        async with inference_pool.admit(), session.lock:
+            # other work may have been admitted while the lock was awaited; it gets the worker
+            inference_state = session.inference_state
+            if inference_state is None or inference_pool.pending > 1:
+                break
+            if not 0 <= frame_idx < inference_state["num_frames"]:
+                continue
+            computed += await inference_pool.run(encode_frame, inference_state, frame_idx)
+    if computed and DEBUG:
+        logger.debug(f"Prefetched features of {computed} frames around frame {center_frame_idx} of {session.session_id}: {embedding_cache.stats()}")
+
+def schedule_prefetch(session: Session, frame_idx: int) -> None:
+    """Prefetch the features of the frames around a frame in the background, replacing the previous prefetch of the session."""
+    if PREFETCH_RADIUS <= 0 or sam2_predictor is None:
+        return
+    previous = prefetch_tasks.pop(session.session_id, None)
+    if previous is not None:
+        previous.cancel()
+    prefetch_tasks[session.session_id] = asyncio.create_task(prefetch_frames(session, frame_idx))
+
+def ensure_frame_store(session: Session) -> FrameStore:
+    """
+    Open the frame store of a session, decoding its recording into a new store if there is none (e.g. for
+    uploads before the store existed) or if it was evicted (see evict_frame_stores).
+    """
+    if session.frame_store is None:
+        store_dir = FRAMES_DIR / session.session_id
+        store = FrameStore.open(store_dir)
+        if store is None or store.image_size != MODEL_IMAGE_SIZE:
+            meta = evicted_meta(store_dir)
+            if meta is not None:
+                logger.info(f"Decoding {session.session_id} again, its frame store was evicted")
+                store = FrameStore.recreate(store_dir, session.video_path, MODEL_IMAGE_SIZE, meta)
+            else:
+                store = FrameStore.create(store_dir, session.video_path, MODEL_IMAGE_SIZE, session.video_hash)
+        session.frame_store = store
+    session.frame_store.touch()
+    return session.frame_store
+
+def open_frames(session: Session) -> FrameStore:
+    """Frames of a session's recording for analytics: its frame store, decoded again if it was evicted."""
+    return ensure_frame_store(session)
+
+async def evict_frame_stores(keep: FrameStore) -> None:
+    """
+    Keep the frame stores within FRAME_STORE_SIZE, evicting those of the least recently used idle recordings.
+
+    Stores of sessions with an inference state or a request in progress are kept, as is `keep`.
+    Sessions whose store was evicted decode their recording again on their next request.
+    """
+    in_use = {keep.store_dir.resolve().name}
+    for session in sessions.sessions.values():
+        if session.frame_store is not None and (session.inference_state is not None or session.lock.locked()):
+            in_use.add(session.frame_store.store_dir.resolve().name)
+    evicted = set(await asyncio.to_thread(enforce_stores_size_limit, FRAMES_DIR, FRAME_STORE_SIZE, in_use))
+    for session in list(sessions.sessions.values()):
+        if session.frame_store is not None and session.frame_store.store_dir.resolve().name in evicted:
+            sessions.release_frame_store(session)
+
+async def build_inference_state(session: Session):
+    """Build the inference state of a session from its frame store, and re-apply the prompts of the session."""
+    def build():
+        inference_state = init_state_from_store(ensure_frame_store(session))
+        if session.prompts:
+            apply_prompts(inference_state, session.prompts)
+        return inference_state
+
+    # running the image encoder on the first frame takes a while; keep it off the event loop
+    return await inference_pool.run(build)
+
+def get_preview_keyframes(session: Session, preview_options: Dict[str, Any]) -> List[int]:
+    """Keyframes of a preview of a session's recording: its schedule, with the prompted frames as keyframes."""
+    store = ensure_frame_store(session)
+    # the thumbnails of the store are enough to compare frames, without reading every frame
+    thumbnails = frame_thumbnails(store.thumbnails if store.thumbnails is not None else store.frames) if preview_options["adaptive"] else None
+    prompted_frames = {prompt["frame_idx"] for prompt in session.prompts}
+    return keyframe_schedule(store.num_frames, preview_options["stride"], prompted_frames, thumbnails)
+
+def build_preview_state(session: Session, keyframes: List[int]):
+    """Build an inference state made of the keyframes of a preview only, with the prompts of the session moved to their keyframes."""
+    positions = {frame_idx: position for position, frame_idx in enumerate(keyframes)}
+    inference_state = init_state_from_store(ensure_frame_store(session), keyframes)
+    apply_prompts(inference_state, [{**prompt, "frame_idx": positions[prompt["frame_idx"]]} for prompt in session.prompts])
+    return inference_state
+
+sessions = SessionRegistry(SESSION_MEMORY_BUDGET, build_inference_state)
+jobs = JobRegistry(JOBS_DIR)
+mask_cache = MaskCache(MASKS_DIR, MASK_CACHE_SIZE)
+frame_image_cache = ImageCache(FRAME_IMAGE_CACHE_SIZE)
+uploads_by_hash: Dict[str, str] = {}  # hash of each uploaded recording (with the layout of stacks) -> its session id
+
+def get_session(session_id: str | None) -> Session | None:
+    """
+    Look up the session of an uploaded recording.
+
+    Sessions are keyed by the unique filename returned by /upload. A recording that is still in
+    UPLOAD_DIR but has no session (e.g. after a restart) gets a new session, without prompts.
+    Without a session id, the most recently uploaded session is used, for older clients.
+    """
+    session = sessions.get(session_id)
+    if session is not None or session_id is None:
+        return session
+
+    file_path = UPLOAD_DIR / session_id
+    if Path(session_id).name != session_id or not file_path.is_file():
+        return None
+    frame_store = FrameStore.open(FRAMES_DIR / session_id)
+    # the store may have been evicted; its metadata is kept, and it is decoded again on first use
+    meta = frame_store.meta if frame_store is not None else evicted_meta(FRAMES_DIR / session_id)
+    video_info = meta_video_info(meta) if meta is not None else read_video_info(file_path)
+    if video_info is None:
+        return None
+    session = Session(session_id, str(file_path), video_info)
+    session.frame_store = frame_store
+    if meta is not None:
+        session.video_hash = meta.get("video_hash")
+    sessions.add(session)
+    return session
+
+def find_upload(video_hash: str) -> Session | None:
+    """The session of a recording with the given hash (see handle_upload) that was uploaded before, if it is still on disk."""
+    session_id = uploads_by_hash.get(video_hash)
+    if session_id is None:
+        return None
+    session = get_session(session_id)
+    if session is None:
+        uploads_by_hash.pop(video_hash, None)
+    return session
+
+def load_upload_index() -> None:
+    """Index the recordings uploaded by previous runs of the server by content hash, from their frame stores."""
+    for store_dir in FRAMES_DIR.iterdir():
+        meta = read_store_meta(store_dir) if ".tmp-" not in store_dir.name else None
+        if meta is not None and meta.get("video_hash") is not None and (UPLOAD_DIR / store_dir.name).is_file():
+            uploads_by_hash.setdefault(meta["video_hash"], store_dir.name)
+    logger.info(f"Indexed {len(uploads_by_hash)} uploaded recordings")
+
+def read_video_info(file_path: Path) -> Dict[str, Any] | None:
+    """Read the properties of a recording with OpenCV, or None if it cannot be opened."""
+    cap = cv2.VideoCapture(str(file_path))
+    if not cap.isOpened():
+        return None
+    video_info = {
+        "frames": int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+        "fps": cap.get(cv2.CAP_PROP_FPS),
+        "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+    }
+    cap.release()
+    return video_info
+
+def queue_full_response(error: InferenceQueueFull) -> web.Response:
+    logger.warning(str(error))
+    return web.json_response({
+        "status": "error",
+        "message": "The server is busy processing other requests. Please try again shortly."
+    }, status=503, headers={"Retry-After": "1"})
+
+def model_unavailable_response() -> web.Response | None:
+    """Response to requests that need the model while it is not ready: 503 while it loads, 500 if it failed to load."""
+    if sam2_predictor is not None:
+        return None
+    if model_status["state"] == "failed":
+        return web.json_response({
+            "status": "error",
+            "message": f"SAM2 model could not be loaded: {model_status['error']}. Please check server logs for details."
+        }, status=500)
+    return web.json_response({
+        "status": "error",
+        "message": "The SAM2 model is still loading. Please try again shortly.",
+        "model": model_status,
+    }, status=503, headers={"Retry-After": "5"})
+
+def superseded_response(session: Session) -> web.Response:
+    return web.json_response({
+        "status": "superseded",
+        "message": f"A newer prompt request was received for {session.session_id}"
+    }, status=409)
+
+def session_not_found_response(session_id: str | None) -> web.Response:
+    return web.json_response({
+        "status": "error",
+        "message": f"Unknown video: {session_id}. Please upload a video first." if session_id else "Please upload a video first."
+    }, status=404)
+
+def get_object_ids(inference_state) -> List[int]:
+    """Object ids known to the inference state, in the order of the mask channels."""
+    return list(inference_state["obj_ids"])
+
+def route_name(request) -> str:
+    """Route of a request for metric labels, e.g. /jobs/{job_id}, so that labels do not grow with ids."""
+    resource = request.match_info.route.resource
+    return resource.canonical if resource is not None else "unmatched"
+
+def wants_binary(request) -> bool:
+    """Whether the client negotiated the binary mask transport (see serialization.py)."""
+    return BINARY_CONTENT_TYPE in request.headers.get("Accept", "") or request.query.get("format") == "binary"
+
+def wants_stream(request) -> bool:
+    """Whether the client asked for results to be streamed frame by frame as they are propagated."""
+    return NDJSON_CONTENT_TYPE in request.headers.get("Accept", "") or request.query.get("stream") == "1"
+
+def preview_info(preview_options: Dict[str, Any], keyframes: List[int]) -> Dict[str, Any]:
+    """Description of a preview in responses: its options and the keyframes SAM2 ran on; the other frames were interpolated."""
+    return {**preview_options, "keyframes": keyframes}
+
+async def make_masks_response(
+    request,
+    masks_dict: Dict[int, np.ndarray],
+    obj_ids: List[int],
+    histograms: Dict[str, Any] | None = None,
+    preview: Dict[str, Any] | None = None,
+) -> web.Response:
+    """Serialize masks, and optionally histograms, in the format negotiated with the client.
+
+    Binary clients get bit-packed (or, with `?encoding=rle`, run-length encoded) frame records.
+    Other clients get the nested-list JSON. Payload size and encode time are logged and
+    reported in the X-Payload-Bytes and X-Encode-Time-Ms headers, so both formats can be compared.
+    The results of a preview are labelled with its `preview` description (see preview_info).
+    The payload of a whole video takes a while to encode, so it is encoded off the event loop.
+    """
+    def encode_binary() -> bytes:
+        encoding = request.query.get("encoding", "bitpack")
+        metadata = {"encoding": encoding, "num_frames": len(masks_dict)}
+        if histograms is not None and histograms["bin_edges"] is not None:
+            metadata["bin_edges"] = histograms["bin_edges"].tolist()
+        if preview is not None:
+            metadata["preview"] = preview
+        chunks = [encode_stream_header(metadata)]
+        for frame_idx, mask in masks_dict.items():
+            frame_histograms = histograms["histograms"].get(frame_idx) if histograms is not None else None
+            chunks.append(encode_frame_record(frame_idx, obj_ids, mask, frame_histograms, encoding))
+        return b"".join(chunks)
+
+    def encode_json() -> bytes:
+        payload = {
+            "status": "success",
+            # Convert the masks to a format that can be serialized to JSON
+            "masks": {str(k): v.tolist() for k, v in masks_dict.items()},
+        }
+        if histograms is not None:
+            # convert histograms to a format that can be serialized to JSON
+            payload["histograms"] = {
+                "histograms": {str(k): v.tolist() for k, v in histograms["histograms"].items()},
+                "bin_edges": histograms["bin_edges"].tolist() if histograms["bin_edges"] is not None else None
+            }
+        if preview is not None:
+            payload["preview"] = preview
+        return json.dumps(payload).encode("utf-8")
+
+    start_time = time.perf_counter()
+    if wants_binary(request):
+        body = await asyncio.to_thread(encode_binary)
+        content_type = BINARY_CONTENT_TYPE
+    else:
+        body = await asyncio.to_thread(encode_json)
+        content_type = "application/json"
+    encode_seconds = time.perf_counter() - start_time
+    encode_ms = encode_seconds * 1000
+    record_stage("encode", encode_seconds)
+    metrics.response_bytes.observe(len(body), route=route_name(request), format="binary" if content_type == BINARY_CONTENT_TYPE else "json")
+
+    logger.info(f"Encoded {len(masks_dict)} frames as {content_type}: {len(body)} bytes in {encode_ms:.1f} ms")
+    return web.Response(body=body, content_type=content_type, headers={
+        "X-Payload-Bytes": str(len(body)),
+        "X-Encode-Time-Ms": f"{encode_ms:.1f}",
+    })
+
+def check_mask_encoding(request) -> web.Response | None:
+    """Return an error response if the requested mask encoding is not supported."""
+    encoding = request.query.get("encoding", "bitpack")
+    if encoding not in MASK_ENCODINGS:
+        return web.json_response({
+            "status": "error",
+            "message": f"Unsupported mask encoding: {encoding}. Supported: {', '.join(MASK_ENCODINGS)}"
+        }, status=400)
+    return None
+
+def get_histogram_options(session: Session, request_data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Histogram options of a request: monochrome conversion, number of bins and value range.
+
+    8-bit recordings default to one bin per intensity. Radiometric stacks are histogrammed in their
+    native domain, by default with 256 bins over the range of their values. Both can be overridden
+    with `histogram_bins` and `histogram_range` ([low, high), in native units).
+
+    Raises:
+        ValueError: If the options are invalid.
+    """
+    stack_range = session.video_info["radiometric"]["histogram_range"] if "radiometric" in session.video_info else None
+    bins = int(request_data.get('histogram_bins', DEFAULT_BINS))
+    value_range = request_data.get('histogram_range') or stack_range or DEFAULT_VALUE_RANGE
+    if not 1 <= bins < 65536:
+        raise ValueError(f"histogram_bins must be between 1 and 65535, got {bins}")
+    if len(value_range) != 2 or not float(value_range[0]) < float(value_range[1]):
+        raise ValueError(f"histogram_range must be [low, high] with low < high, got {value_range}")
+    return {
+        "convert_to_monochrome": bool(request_data.get('convert_to_monochrome', False)),
+        "bins": bins,
+        "value_range": [float(value_range[0]), float(value_range[1])],
+    }
+
+def get_histogram_channels(session: Session, histogram_options: Dict[str, Any]) -> int:
+    """Number of channels of the histograms computed with the given options (see compute_histograms_of_frame)."""
+    radiometric_stack = "radiometric" in session.video_info
+    return 1 if radiometric_stack or histogram_options["convert_to_monochrome"] else 3
+
+def get_bin_edges(session: Session, histogram_options: Dict[str, Any]) -> np.ndarray:
+    """Bin edges of the histograms computed with the given options (one row per channel of the histograms)."""
+    return histogram_bin_edges(
+        histogram_options["bins"], histogram_options["value_range"], num_channels=get_histogram_channels(session, histogram_options)
+    )
+
+def get_timeline_options(params) -> Tuple[int, List[float]]:
+    """
+    Number of points and percentiles of the series requested from a stats endpoint.
+
+    `num_points` defaults to DEFAULT_TIMELINE_POINTS. `percentiles` is a list of numbers, or a
+    comma-separated string in query parameters, and defaults to DEFAULT_PERCENTILES.
+
+    Raises:
+        ValueError: If the options are invalid.
+    """
+    num_points = int(params.get('num_points', DEFAULT_TIMELINE_POINTS))
+    if not 2 <= num_points <= MAX_TIMELINE_POINTS:
+        raise ValueError(f"num_points must be between 2 and {MAX_TIMELINE_POINTS}, got {num_points}")
+    percentiles = params.get('percentiles', DEFAULT_PERCENTILES)
+    if isinstance(percentiles, str):
+        percentiles = [p for p in percentiles.split(',') if p.strip()]
+    percentiles = [float(p) for p in percentiles]
+    if any(not 0 <= p <= 100 for p in percentiles):
+        raise ValueError(f"percentiles must be between 0 and 100, got {percentiles}")
+    return num_points, percentiles
+
+async def timelines_response(histogram_chunks, bin_edges: np.ndarray, obj_ids: List[int], num_points: int, percentiles: List[float]) -> web.Response:
+    """Reduce the histograms of a processed video to per-object statistics over time, downsampled to `num_points` points per series."""
+    def summarize():
+        frame_indices, stats = compute_timelines(histogram_chunks, bin_edges, percentiles)
+        return len(frame_indices), downsample_timelines(frame_indices, stats, obj_ids, num_points)
+
+    start_time = time.perf_counter()
+    num_frames, timelines = await asyncio.to_thread(summarize)
+    logger.info(f"Summarized {num_frames} frames of {len(obj_ids)} objects in {(time.perf_counter() - start_time) * 1000:.1f} ms")
+    return web.json_response({
+        "status": "success",
+        "num_frames": num_frames,
+        "num_points": num_points,
+        "percentiles": percentiles,
+        "objects": timelines,
+    })
+
+def compute_histograms_of_frame(frames: FrameStore | FrameReader, frame_idx: int, mask: np.ndarray, histogram_options: Dict[str, Any]) -> np.ndarray | None:
+    """Compute histograms of a frame that was just propagated, reading it from the frame store or the shared frame reader.
+
+    Frames of radiometric stacks are histogrammed in their native data type.
+    """
+    convert_to_monochrome = histogram_options["convert_to_monochrome"]
+    with stage("read_frame"):
+        if isinstance(frames, FrameStore) and frames.radiometric is not None:
+            frame = frames.read_radiometric(frame_idx)
+            convert_to_monochrome = False  # single-channel already
+        else:
+            frame = frames.read(frame_idx)
+    if frame is None:
+        logger.warning(f"Frame {frame_idx} could not be read from {frames.file_path}")
+        return None
+    with stage("histograms"):
+        return compute_frame_histograms(
+            frame, mask, convert_to_monochrome, histogram_options["bins"], histogram_options["value_range"]
+        )
+
+async def process_video_frames(session: Session, inference_state, histogram_options: Dict[str, Any], cache_writer: CacheWriter | None = None):
+    """Propagate the prompts through the whole video, yielding (frame_idx, mask, histograms) of each frame as soon as it is propagated.
+
+    The results are also written to the cache writer, which is committed once every frame was produced,
+    or aborted if the run stops early.
+    """
+    def store_frame(frames, frame_idx: int, mask: np.ndarray) -> np.ndarray | None:
+        histograms = compute_histograms_of_frame(frames, frame_idx, mask, histogram_options)
+        if cache_writer is not None:
+            with stage("cache_write"):
+                cache_writer.append(frame_idx, mask, histograms)
+        return histograms
+
+    start_time = time.perf_counter()
+    try:
+        # frames are propagated in order, so each frame is decoded once, alongside the propagation
+        frames = open_frames(session)
+        async with aclosing(get_masks_of_many_frames(sam2_predictor, inference_state)) as propagated:
+            async for frame_idx, mask in propagated:
+                # histograms and cache writes run off the event loop, like the propagation
+                histograms = await asyncio.to_thread(store_frame, frames, frame_idx, mask)
+                metrics.frames_total.inc(source="propagated")
+                yield frame_idx, mask, histograms
+        metrics.video_fps.observe(inference_state["num_frames"] / (time.perf_counter() - start_time), source="full")
+        if cache_writer is not None:
+            await asyncio.to_thread(cache_writer.commit)
+    finally:
+        if cache_writer is not None:
+            cache_writer.abort()
+
+async def preview_video_frames(session: Session, preview_state, keyframes: List[int], histogram_options: Dict[str, Any], cache_writer: CacheWriter | None = None):
+    """Propagate the prompts through the keyframes of a preview, yielding (frame_idx, mask, histograms) of every frame in order.
+
+    The masks of the frames between two keyframes are interpolated once SAM2 produced the second one
+    (see preview.interpolate_masks), and their histograms are computed from the interpolated masks.
+    Results are cached like those of process_video_frames.
+    """
+    def store_frame(frames, frame_idx: int, mask: np.ndarray):
+        histograms = compute_histograms_of_frame(frames, frame_idx, mask, histogram_options)
+        if cache_writer is not None:
+            cache_writer.append(frame_idx, mask, histograms)
+        return frame_idx, mask, histograms
+
+    def fill_gap(frames, previous: KeyframeMasks, current: KeyframeMasks):
+        """Interpolated results of the frames strictly between two keyframes."""
+        return [
+            store_frame(frames, frame_idx, interpolate_masks(previous, current, frame_idx))
+            for frame_idx in range(previous.frame_idx + 1, current.frame_idx)
+        ]
+
+    def emit(result, source):
+        metrics.frames_total.inc(source=source)
+        return result
+
+    start_time = time.perf_counter()
+    try:
+        frames = open_frames(session)
+        previous = None
+        async with aclosing(get_masks_of_many_frames(sam2_predictor, preview_state)) as propagated:
+            async for position, mask in propagated:
+                frame_idx = keyframes[position]
+                with stage("interpolate"):
+                    current = await asyncio.to_thread(KeyframeMasks, frame_idx, mask)
+                    gap = await asyncio.to_thread(fill_gap, frames, previous, current) if previous is not None else []
+                for result in gap:
+                    yield emit(result, "interpolated")
+                yield emit(await asyncio.to_thread(store_frame, frames, frame_idx, mask), "propagated")
+                previous = current
+        metrics.video_fps.observe(session.frame_store.num_frames / (time.perf_counter() - start_time), source="preview")
+        if cache_writer is not None:
+            await asyncio.to_thread(cache_writer.commit)
+    finally:
+        if cache_writer is not None:
+            cache_writer.abort()
+
+async def cached_video_frames(entry: CacheEntry):
+    """Yield (frame_idx, mask, histograms) of each frame of a processed video read from the cache."""
+    start_time = time.perf_counter()
+    for frame_idx, mask, histograms in entry.iter_frames():
+        metrics.frames_total.inc(source="cached")
+        yield frame_idx, mask, histograms
+    metrics.video_fps.observe(entry.num_frames / (time.perf_counter() - start_time), source="cached")
+
+async def collect_video_frames(results, bin_edges: np.ndarray) -> Tuple[Dict[int, np.ndarray], Dict[str, Any]]:
+    """Gather the results of a video into the masks dictionary and histograms expected by make_masks_response."""
+    masks_dict = {}
+    histograms = {"histograms": {}, "bin_edges": bin_edges}
+    async with aclosing(results) as frames:
+        async for frame_idx, mask, frame_histograms in frames:
+            masks_dict[frame_idx] = mask
+            if frame_histograms is not None:
+                histograms["histograms"][frame_idx] = frame_histograms
+    return masks_dict, histograms
+
+def get_model_id() -> str:
+    """Identify the model configuration and checkpoint file, so that cached results of another model are not reused."""
+    stat = MODEL_CHECKPOINT.stat() if MODEL_CHECKPOINT.exists() else None
+    return f"{MODEL_CONFIG}:{MODEL_CHECKPOINT.name}:{stat.st_size if stat else 0}:{stat.st_mtime_ns if stat else 0}"
+
+async def get_cache_key(session: Session, histogram_options: Dict[str, Any], preview_options: Dict[str, Any] | None = None) -> str:
+    """Cache key of the results of processing a session's recording with its current prompts, fully or as a preview."""
+    if session.video_hash is None:
+        session.video_hash = await asyncio.to_thread(hash_file, session.video_path)
+    return cache_key(session.video_hash, session.prompts, get_model_id(), histogram_options, preview_options)
+
+async def stream_process_video(
+    request,
+    obj_ids: List[int],
+    num_frames: int,
+    bin_edges: np.ndarray,
+    results,
+    preview: Dict[str, Any] | None = None,
+) -> web.StreamResponse:
+    """Stream masks and histograms of each frame as soon as they are produced.
+
+    Binary clients get the stream header followed by one frame record per frame. Other clients get
+    newline-delimited JSON: a metadata line followed by one line per frame. Nothing is accumulated
+    across frames, so server memory stays bounded regardless of the length of the recording.
+
+    Args:
+        obj_ids: Object ids, one for each channel of the masks.
+        num_frames: The number of frames of the video.
+        bin_edges: Bin edges of the histograms.
+        results: Async iterator of (frame_idx, mask, histograms), e.g. process_video_frames.
+        preview: Description of the preview the results are from (see preview_info), if any. It is
+            sent with the metadata, and each JSON line tells whether its frame was inferred or interpolated.
+    """
+    binary = wants_binary(request)
+    encoding = request.query.get("encoding", "bitpack")
+    metadata = {
+        "encoding": encoding,
+        "num_frames": num_frames,
+        "obj_ids": obj_ids,
+        "bin_edges": bin_edges.tolist(),
+    }
+    keyframes = None
+    if preview is not None:
+        metadata["preview"] = preview
+        keyframes = set(preview["keyframes"])
+
+    response = web.StreamResponse(headers={"Content-Type": BINARY_CONTENT_TYPE if binary else NDJSON_CONTENT_TYPE})
+    timings = current_timings.get()
+    if SERVER_TIMING and timings is not None:
+        # headers go out before the frames: only the stages so far (queueing, state building) are reported
+        response.headers["Server-Timing"] = timings.header()
+    await response.prepare(request)
+    if binary:
+        await response.write(encode_stream_header(metadata))
+    else:
+        await response.write((json.dumps(metadata) + "\n").encode("utf-8"))
+
+    frames_sent = 0
+    payload_bytes = 0
+    start_time = time.perf_counter()
+    try:
+        # closed deterministically when the client disconnects, while the session lock is still held
+        async with aclosing(results) as frames:
+            async for frame_idx, mask, histograms in frames:
+                with stage("encode"):
+                    if binary:
+                        chunk = encode_frame_record(frame_idx, obj_ids, mask, histograms, encoding)
+                    else:
+                        record = {
+                            "frame_idx": frame_idx,
+                            "obj_ids": obj_ids,
+                            "masks": mask.tolist(),
+                            "histograms": histograms.tolist() if histograms is not None else None,
+                        }
+                        if keyframes is not None:
+                            record["source"] = "inferred" if frame_idx in keyframes else "interpolated"
+                        chunk = (json.dumps(record) + "\n").encode("utf-8")
+                with stage("transfer"):
+                    await response.write(chunk)
+                frames_sent += 1
+                payload_bytes += len(chunk)
+    except ConnectionResetError:
+        logger.info(f"Client disconnected after {frames_sent} streamed frames")
+        return response
+    except Exception as e:
+        logger.error(f"Error streaming processed video: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+        message = f"Error processing video: {str(e)}"
+        if binary:
+            await response.write(encode_error_record(message))
+        else:
+            await response.write((json.dumps({"status": "error", "message": message}) + "\n").encode("utf-8"))
+
+    logger.info(f"Streamed {frames_sent} frames: {payload_bytes} bytes in {time.perf_counter() - start_time:.1f} s")
+    metrics.response_bytes.observe(payload_bytes, route=route_name(request), format="binary" if binary else "ndjson")
+    await response.write_eof()
+    return response
+
+def get_process_exports_dir() -> Path:
+    """
+    Directory of the exports of this process under EXPORTS_DIR, created on first use.
+
+    The process holds a lock on its .lock file for as long as it runs, so that other processes sharing the
+    data directory (e.g. a restarted server, or a benchmark) can tell the exports of a live process from
+    those left by a process that is gone (see remove_stale_exports).
+    """
+    global process_exports_lock
+    exports_dir = EXPORTS_DIR / process_exports_name
+    if process_exports_lock is None or process_exports_lock[0] != exports_dir:
+        exports_dir.mkdir(parents=True, exist_ok=True)
+        lock_file = open(exports_dir / ".lock", "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        process_exports_lock = (exports_dir, lock_file)
+    return exports_dir
+
+def remove_stale_exports() -> None:
+    """Remove the exports left in EXPORTS_DIR by processes that are gone, e.g. interrupted by a restart."""
+    for path in EXPORTS_DIR.iterdir():
+        # directories of processes started since are skipped: they may not hold their lock yet
+        if path.name == process_exports_name or path.stat().st_mtime >= process_started_at:
+            continue
+        if path.is_dir():
+            try:
+                with open(path / ".lock", "a") as lock_file:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:  # its process is still running
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink()  # exports written before exports had a directory per process
+
+async def export_response(
+    request,
+    export_format: str,
+    frames,
+    obj_ids: List[int],
+    histogram_shape: Tuple[int, int, int] | None,
+    bin_edges: np.ndarray,
+    percentiles: List[float],
+    name: str,
+    metadata: Dict[str, Any],
+) -> web.StreamResponse:
+    """
+    Stream an export of results to a Parquet or HDF5 file (see export.py), written a chunk of frames at a time.
+
+    Parquet files are sent as their row groups are written. HDF5 files are written to the directory of
+    this process under EXPORTS_DIR first, then sent and removed: HDF5 writers update the file in place.
+
+    Args:
+        frames: Iterator of (frame_idx, masks, histograms) of each frame, read from disk, e.g. CacheEntry.iter_frames().
+        name: Name of the recording, for the name of the file.
+    """
+    extension, content_type = EXPORT_FORMATS[export_format]
+    response = web.StreamResponse(headers={
+        "Content-Type": content_type,
+        "Content-Disposition": f'attachment; filename="{Path(name).stem}{extension}"',
+    })
+    payload_bytes = 0
+    start_time = time.perf_counter()
+    export_path = None
+    try:
+        if export_format == "parquet":
+            chunks = iter_parquet(frames, obj_ids, histogram_shape, bin_edges, percentiles, metadata)
+        else:
+            export_path = get_process_exports_dir() / f"{uuid.uuid4().hex}{extension}"
+            with stage("export"):
+                await asyncio.to_thread(write_hdf5, export_path, frames, obj_ids, histogram_shape, bin_edges, percentiles, metadata)
+            response.content_length = export_path.stat().st_size
+            chunks = None
+        await response.prepare(request)
+        if chunks is not None:
+            while True:
+                with stage("export"):
+                    chunk = await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    break
+                with stage("transfer"):
+                    await response.write(chunk)
+                payload_bytes += len(chunk)
+        else:
+            async with aiofiles.open(export_path, "rb") as f:
+                while chunk := await f.read(2**20):
+                    with stage("transfer"):
+                        await response.write(chunk)
+                    payload_bytes += len(chunk)
+    except ConnectionResetError:
+        logger.info(f"Client disconnected after {payload_bytes} bytes of an export")
+        return response
+    except Exception as e:
+        if not response.prepared:
+            raise
+        # the file is incomplete: drop the connection rather than end the response, so that it is not taken for a whole file
+        logger.error(f"Error exporting {name}: {e}")
+        if request.transport is not None:
+            request.transport.close()
+        return response
+    finally:
+        if export_path is not None:
+            export_path.unlink(missing_ok=True)
+    logger.info(f"Exported {name} to {export_format}: {payload_bytes} bytes in {time.perf_counter() - start_time:.1f} s")
+    metrics.response_bytes.observe(payload_bytes, route=route_name(request), format=export_format)
+    await response.write_eof()
+    return response
+
+async def run_job(job: Job) -> None:
+    """
+    Run a job, or resume it from the first frame it has no results for.
+
+    The job holds the session lock while it runs. It propagates with the prompts it was created with,
+    re-applying them to the session if they changed since. Results are checkpointed as they are
+    produced; on cancellation or failure the frames produced so far are checkpointed too.
+    Resuming after the inference state was rebuilt (e.g. after a restart) continues tracking from the
+    prompts alone, without the memory of the frames tracked before the resume point.
+    """
+    try:
+        session = get_session(job.session_id)
+        if session is None:
+            raise RuntimeError(f"Unknown video: {job.session_id}")
+        async with inference_pool.admit(), session.lock:
+            inference_state = await sessions.ensure_state(session)
+            try:
+                if session.prompts != job.prompts:
+                    await update_session_prompts(session, inference_state, job.prompts)
+                obj_ids = get_object_ids(inference_state)
+                if job.obj_ids is None:
+                    job.obj_ids = obj_ids
+                # keep the mask channels in the order of the first run
+                channel_order = [obj_ids.index(obj_id) for obj_id in job.obj_ids]
+                job.num_frames = inference_state["num_frames"]
+                job.start_run()
+                logger.info(f"Job {job.job_id}: processing frames {job.next_frame_idx} to {job.num_frames - 1}")
+
+                def record_frame(frames, frame_idx: int, mask: np.ndarray) -> None:
+                    job.record(frame_idx, mask, compute_histograms_of_frame(frames, frame_idx, mask, job.histogram_options))
+
+                frames = open_frames(session)
+                async with aclosing(get_masks_of_many_frames(
+                        sam2_predictor, inference_state, job.next_frame_idx, job.num_frames - job.next_frame_idx
+                )) as propagated:
+                    async for frame_idx, mask in propagated:
+                        # histograms and checkpoints run off the event loop, like the propagation
+                        await asyncio.to_thread(record_frame, frames, frame_idx, mask[channel_order])
+            finally:
+                await sessions.update_usage(session)
+        job.status = COMPLETED
+        logger.info(f"Job {job.job_id}: completed")
+    except asyncio.CancelledError:
+        job.status = CANCELLED
+        logger.info(f"Job {job.job_id}: cancelled after {job.frames_done} frames")
+    except Exception as e:
+        job.status = FAILED
+        job.error = str(e)
+        logger.error(f"Job {job.job_id}: failed: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+    finally:
+        await asyncio.to_thread(job.checkpoint)
+
+def start_job(job: Job) -> None:
+    job.status = QUEUED
+    job.task = asyncio.create_task(run_job(job))
+
+def get_job_histogram_channels(job: Job) -> int:
+    """
+    Number of channels of the histograms of a job: that of the histograms it stored, or else that of its options.
+
+    Reads the job's checkpoints, so it is called on a worker thread.
+    """
+    for _, _, histograms in job.iter_results():
+        if histograms is not None:
+            return histograms.shape[0]
+    session = get_session(job.session_id)
+    if session is not None:
+        return get_histogram_channels(session, job.histogram_options)
+    return 1 if job.histogram_options["convert_to_monochrome"] else 3
+
+def get_job_histogram_layout(job: Job) -> Tuple[np.ndarray, Tuple[int, int, int]]:
+    """Bin edges of the histograms of a job, and the [N, C, bins] shape of the histograms of a frame."""
+    num_channels = get_job_histogram_channels(job)
+    bin_edges = histogram_bin_edges(job.histogram_options["bins"], job.histogram_options["value_range"], num_channels=num_channels)
+    return bin_edges, (num_channels, len(job.obj_ids or []), job.histogram_options["bins"])
+
+def job_not_found_response(job_id: str) -> web.Response:
+    return web.json_response({"status": "error", "message": f"Unknown job: {job_id}"}, status=404)
+
 # API Routes
 async def handle_upload(request):
-    """Handle video upload"""
-    global inference_state, current_video_path
+    """
+    Handle video upload. Uploads are accepted while the model loads: the frames are decoded without it.
+
+    The whole recording is decoded into its frame store before the response, in bounded memory. An
+    inference state needs the exact number of frames, which OpenCV only knows for sure once every frame
+    was decoded, and the value range of a stack needs every frame too. The response therefore waits for
+    the decode, and its latency grows with the length of the recording.
+    """
     try:
-        # Check if SAM2 is initialized
-        if sam2_predictor is None:
-            initialized = await init_sam2()
-            if not initialized:
-                return web.json_response({
-                    "status": "error",
-                    "message": "SAM2 model not initialized. Please check server logs for details."
-                }, status=500)
-        
         # Check if the request has a video file
         if not request.content_type or not request.content_type.startswith('multipart/form-data'):
             return web.json_response({"status": "error", "message": "No video file provided"}, status=400)
@@ -248,64 +1364,121 @@ async def handle_upload(request):
             return web.json_response({"status": "error", "message": "No filename provided"}, status=400)
         
         # Generate a unique filename
+        # (uploads within the same second, e.g. re-uploads of a recording, are told apart by a random suffix)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        unique_filename = f"{timestamp}_{filename}"
+        unique_filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{filename}"
         file_path = UPLOAD_DIR / unique_filename
         
-        # Save the file
+        # Save the file under a temporary name, hashing its content as it streams in
+        part_path = UPLOAD_DIR / f".{unique_filename}.part"
+        digest = hashlib.sha256()
         size = 0
-        async with aiofiles.open(file_path, 'wb') as f:
+        async with aiofiles.open(part_path, 'wb') as f:
             while True:
                 chunk = await field.read_chunk()
                 if not chunk:
                     break
                 size += len(chunk)
+                digest.update(chunk)
                 await f.write(chunk)
+        video_hash = digest.hexdigest()
+        source = {key: request.query[key] for key in ("width", "height", "dtype") if key in request.query}
+        fps = 30.0
+        if radiometric.is_radiometric(filename):
+            # the same bytes read with another layout are another recording
+            try:
+                fps = float(request.query.get("fps", fps))
+                video_hash = radiometric.layout_hash(video_hash, filename, source, fps)
+            except (TypeError, ValueError) as e:
+                os.remove(str(part_path))
+                return web.json_response({"status": "error", "message": f"Could not read radiometric stack: {e}"}, status=400)
+
+        # A recording that was uploaded before is neither written nor decoded again: the new upload links
+        # to its file and frame store, in a session of its own, with its own prompts and inference state
+        existing_session = find_upload(video_hash)
+        if existing_session is not None:
+            logger.info(f"{filename} ({size} bytes) is a re-upload of {existing_session.session_id}")
+            try:
+                os.link(existing_session.video_path, file_path)
+                os.remove(str(part_path))
+            except OSError:
+                os.rename(part_path, file_path)
+            # (the store of the first upload is decoded again if it was evicted)
+            frame_store = await asyncio.to_thread(ensure_frame_store, existing_session)
+            frame_store.link(FRAMES_DIR / unique_filename)
+            session = Session(unique_filename, str(file_path), existing_session.video_info)
+            session.frame_store = frame_store
+            session.video_hash = video_hash
+            sessions.add(session)
+            try:
+                if sam2_predictor is not None:
+                    async with inference_pool.admit(), session.lock:
+                        await sessions.ensure_state(session)
+            except InferenceQueueFull as e:
+                sessions.remove(unique_filename)
+                FrameStore.remove(FRAMES_DIR / unique_filename)
+                os.remove(str(file_path))
+                return queue_full_response(e)
+            return web.json_response({
+                "status": "success",
+                "filename": unique_filename,
+                "deduplicated": True,
+                **session.video_info
+            })
+        os.rename(part_path, file_path)
         
-        # Get video properties using OpenCV
-        cap = cv2.VideoCapture(str(file_path))
-        if not cap.isOpened():
-            return web.json_response({"status": "error", "message": "Could not open video file"}, status=400)
-        
-        # Get video properties
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        
-        # Release the video capture
-        cap.release()
+        # Decode the video once, into its frame store; its properties are read from there.
+        # Radiometric stacks are kept as uploaded and only their 8-bit view is stored.
+        try:
+            with stage("decode"):
+                if radiometric.is_radiometric(filename):
+                    frame_store = await asyncio.to_thread(
+                        FrameStore.create_from_stack, FRAMES_DIR / unique_filename, str(file_path), MODEL_IMAGE_SIZE,
+                        video_hash, source, fps,
+                    )
+                else:
+                    frame_store = await asyncio.to_thread(
+                        FrameStore.create, FRAMES_DIR / unique_filename, file_path, MODEL_IMAGE_SIZE, video_hash
+                    )
+        except (TypeError, ValueError) as e:
+            os.remove(str(file_path))
+            message = f"Could not read radiometric stack: {e}" if radiometric.is_radiometric(filename) else "Could not open video file"
+            return web.json_response({"status": "error", "message": message}, status=400)
+        if frame_store.num_frames == 0:
+            FrameStore.remove(FRAMES_DIR / unique_filename)
+            os.remove(str(file_path))
+            return web.json_response({"status": "error", "message": "Could not read any frame of the video file"}, status=400)
+        video_info = frame_store.video_info()
+        await evict_frame_stores(frame_store)
         
-        # Initialize inference state with the video
+        # Initialize inference state with the video, in a new session keyed by the unique filename
+        session = Session(unique_filename, str(file_path), video_info)
+        session.frame_store = frame_store
+        session.video_hash = video_hash
+        sessions.add(session)
         try:
-            inference_state = sam2_predictor.init_state(
-                str(file_path),
-                offload_video_to_cpu=True,  # Save GPU memory
-                offload_state_to_cpu=True   # Save GPU memory
-            )
-            
-            # Store the current video path
-            current_video_path = str(file_path)
-            
-            # Cache video info using the unique filename
-            video_cache[unique_filename] = {
-                "path": str(file_path),
-                "frames": total_frames,
-                "fps": fps,
-                "width": width,
-                "height": height
-            }
+            # while the model loads, the state is built by the first prompt request instead
+            if sam2_predictor is not None:
+                async with inference_pool.admit(), session.lock:
+                    await sessions.ensure_state(session)
+            uploads_by_hash[video_hash] = unique_filename
             
             return web.json_response({
                 "status": "success",
                 "filename": unique_filename,  # Return the unique filename to the client
-                "frames": total_frames,
-                "fps": fps,
-                "width": width,
-                "height": height
+                "deduplicated": False,
+                **video_info
             })
+        except InferenceQueueFull as e:
+            sessions.remove(unique_filename)
+            FrameStore.remove(FRAMES_DIR / unique_filename)
+            if os.path.exists(file_path):
+                os.remove(str(file_path))
+            return queue_full_response(e)
         except Exception as e:
             logger.error(f"Error initializing inference state: {e}")
+            sessions.remove(unique_filename)
+            FrameStore.remove(FRAMES_DIR / unique_filename)
             # Clean up the file if it was created
             if os.path.exists(file_path):
                 os.remove(str(file_path))
@@ -316,60 +1489,98 @@ async def handle_upload(request):
         # Clean up the file if it was created
         if 'file_path' in locals() and os.path.exists(file_path):
             os.remove(str(file_path))
+        if 'part_path' in locals() and os.path.exists(part_path):
+            os.remove(str(part_path))
         return web.json_response({"status": "error", "message": str(e)}, status=500)
 
 
 async def handle_process_video(request):
-    """Handle video processing with prompts applied by the user so far"""
-    global current_video_path
+    """
+    Handle video processing with prompts applied by the user so far.
+
+    With `preview` in the request, SAM2 runs only on keyframes and the masks of the other frames are
+    interpolated (see preview.py), which is much faster on long recordings. The results are labelled
+    with the keyframes. A preview is upgraded to a full run by requesting the video again without `preview`.
+    """
     try:
         # Check if SAM2 is initialized
-        if sam2_predictor is None:
-            initialized = await init_sam2()
-            if not initialized:
-                return web.json_response({
-                    "status": "error",
-                    "message": "SAM2 model not initialized. Please check server logs for details."
-                }, status=500)
+        unavailable = model_unavailable_response()
+        if unavailable is not None:
+            return unavailable
                 
         if DEBUG:
             logger.debug("=== Received Video Processing Request ===")
+
+        encoding_error = check_mask_encoding(request)
+        if encoding_error is not None:
+            return encoding_error
         
         # Get request data
         request_data = await request.json()
-        convert_to_monochrome = request_data.get('convert_to_monochrome', False)
-        
-        if DEBUG:
-            logger.debug(f"Monochrome mode: {convert_to_monochrome}")
         
+        session = get_session(request_data.get('filename'))
+        if session is None:
+            return session_not_found_response(request_data.get('filename'))
+        try:
+            histogram_options = get_histogram_options(session, request_data)
+            preview_options = get_preview_options(request_data.get('preview'))
+        except (TypeError, ValueError) as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+        bin_edges = get_bin_edges(session, histogram_options)
+
+        # Serve the results from the cache if the video was already processed with these prompts
+        cached = mask_cache.get(await get_cache_key(session, histogram_options, preview_options))
+        if cached is not None:
+            logger.info(f"Serving {cached.num_frames} cached frames of {session.session_id}")
+            preview = preview_info(preview_options, cached.keyframes) if preview_options is not None else None
+            if wants_stream(request):
+                return await stream_process_video(
+                    request, cached.obj_ids, cached.num_frames, bin_edges, cached_video_frames(cached), preview
+                )
+            masks_dict, histograms = await collect_video_frames(cached_video_frames(cached), bin_edges)
+            return await make_masks_response(request, masks_dict, cached.obj_ids, histograms, preview)
+
         # Process video with SAM2
         try:
-            # Process video with prompts
-            masks_dict = {}
-            async for frame_idx, mask in get_masks_of_many_frames(sam2_predictor):
-                masks_dict[frame_idx] = mask
+            async with inference_pool.admit(), session.lock:
+                key = await get_cache_key(session, histogram_options, preview_options)
+                if preview_options is not None:
+                    # a separate, short-lived inference state made of the keyframes only
+                    keyframes = await inference_pool.run(get_preview_keyframes, session, preview_options)
+                    preview_state = await inference_pool.run(build_preview_state, session, keyframes)
+                    logger.info(f"Previewing {session.session_id} on {len(keyframes)} of {session.frame_store.num_frames} frames")
+                    obj_ids = get_object_ids(preview_state)
+                    num_frames = session.frame_store.num_frames
+                    preview = preview_info(preview_options, keyframes)
+                    cache_writer = mask_cache.writer(key, obj_ids, num_frames, keyframes)
+                    results = preview_video_frames(session, preview_state, keyframes, histogram_options, cache_writer)
+                    if wants_stream(request):
+                        return await stream_process_video(request, obj_ids, num_frames, bin_edges, results, preview)
+                    masks_dict, histograms = await collect_video_frames(results, bin_edges)
+                    return await make_masks_response(request, masks_dict, obj_ids, histograms, preview)
+
+                inference_state = await sessions.ensure_state(session)
+                try:
+                    obj_ids = get_object_ids(inference_state)
+                    cache_writer = mask_cache.writer(key, obj_ids, inference_state["num_frames"])
+                    results = process_video_frames(session, inference_state, histogram_options, cache_writer)
+                    if wants_stream(request):
+                        return await stream_process_video(request, obj_ids, inference_state["num_frames"], bin_edges, results)
+
+                    # Process video with prompts, computing histograms of each frame as it is propagated
+                    masks_dict, histograms = await collect_video_frames(results, bin_edges)
+                finally:
+                    # tracking results are kept in the inference state
+                    await sessions.update_usage(session)
             
             if DEBUG:
                 logger.debug("\n=== Processing Results ===")
                 logger.debug(f"Generated masks for {len(masks_dict)} frames")
+
+            return await make_masks_response(request, masks_dict, obj_ids, histograms)
             
-            # Convert the masks to a format that can be serialized to JSON
-            masks_json = {str(k): v.tolist() for k, v in masks_dict.items()}
-            
-            # compute histograms
-            histograms = compute_histograms(masks_dict, current_video_path, convert_to_monochrome)
-            # convert histograms to a format that can be serialized to JSON
-            histograms_json = {
-                "histograms": {str(k): v.tolist() for k, v in histograms["histograms"].items()},
-                "bin_edges": histograms["bin_edges"].tolist()
-            }
-            
-            return web.json_response({
-                "status": "success",
-                "masks": masks_json,
-                "histograms": histograms_json
-            })
-            
+        except InferenceQueueFull as e:
+            return queue_full_response(e)
         except Exception as e:
             logger.error(f"Error processing video with SAM2: {e}")
             import traceback
@@ -390,14 +1601,14 @@ async def handle_process_frame(request):
     """Handle processing a single frame with prompts"""
     try:
         # Check if SAM2 is initialized
-        if sam2_predictor is None:
-            initialized = await init_sam2()
-            if not initialized:
-                return web.json_response({
-                    "status": "error",
-                    "message": "SAM2 model not initialized. Please check server logs for details."
-                }, status=500)
+        unavailable = model_unavailable_response()
+        if unavailable is not None:
+            return unavailable
         
+        encoding_error = check_mask_encoding(request)
+        if encoding_error is not None:
+            return encoding_error
+
         # Parse request data
         data = await request.json()
         
@@ -409,6 +1620,14 @@ async def handle_process_frame(request):
         
         frame_idx = data['frame_idx']
         prompts = data['prompts']
+
+        session = get_session(data.get('filename'))
+        if session is None:
+            return session_not_found_response(data.get('filename'))
+        # Each request carries the whole prompt set, and prompts are applied incrementally from those the
+        # session applied last: a request superseded by a newer one of the session while it waits can be
+        # skipped, the newer one applies its changes too. Rapid clicks then cost about one inference.
+        generation = session.begin_prompt_request()
         
         if DEBUG:
             logger.debug(f"Processing frame {frame_idx} with prompts: {prompts}")
@@ -416,15 +1635,20 @@ async def handle_process_frame(request):
         # Process frame with prompts
         try:
             # Process the frame with prompts
-            masks_dict = await process_frame_with_prompts(prompts)
-            
-            # Convert the masks to a format that can be serialized to JSON
-            masks_json = {str(k): v.tolist() for k, v in masks_dict.items()}
-            
-            return web.json_response({
-                "status": "success",
-                "masks": masks_json
-            })
+            async with inference_pool.admit(), session.lock:
+                if session.is_superseded(generation):
+                    if DEBUG:
+                        logger.debug(f"Skipping superseded prompt request {generation} of {session.session_id}")
+                    return superseded_response(session)
+                inference_state = await sessions.ensure_state(session)
+                masks_dict = await process_frame_with_prompts(session, inference_state, prompts)
+                obj_ids = get_object_ids(inference_state)
+            # the user is likely to prompt the frames around next
+            schedule_prefetch(session, frame_idx)
+
+            return await make_masks_response(request, masks_dict, obj_ids)
+        except InferenceQueueFull as e:
+            return queue_full_response(e)
         except Exception as e:
             logger.error(f"Error processing frame: {e}")
             import traceback
@@ -440,36 +1664,454 @@ async def handle_process_frame(request):
             "message": str(e)
         }, status=500)
 
+async def handle_prefetch(request):
+    """Compute the image features of the frames around the scrub position of the user in the background, so that prompting them skips the encoder"""
+    try:
+        data = await request.json()
+        session = get_session(data.get('filename'))
+        if session is None:
+            return session_not_found_response(data.get('filename'))
+        try:
+            frame_idx = int(data['frame_idx'])
+        except (KeyError, TypeError, ValueError):
+            return web.json_response({"status": "error", "message": "frame_idx must be an integer"}, status=400)
+        # only sessions with a live inference state are prefetched; building one is left to the next prompt
+        schedule_prefetch(session, frame_idx)
+        return web.json_response({"status": "success", "embedding_cache": embedding_cache.stats()}, status=202)
+    except Exception as e:
+        logger.error(f"Error handling prefetch request: {e}")
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
+
+async def handle_stats(request):
+    """
+    Per-object statistics over time of a video processed with its current prompts: pixel count, and mean, min,
+    max and percentiles per channel. Each series is downsampled to at most `num_points` points, keeping the
+    extremes of the full series. Takes the histogram and preview options of /process-video, and is served
+    from the results it cached.
+    """
+    try:
+        request_data = await request.json()
+        session = get_session(request_data.get('filename'))
+        if session is None:
+            return session_not_found_response(request_data.get('filename'))
+        try:
+            histogram_options = get_histogram_options(session, request_data)
+            preview_options = get_preview_options(request_data.get('preview'))
+            num_points, percentiles = get_timeline_options(request_data)
+        except (TypeError, ValueError) as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+
+        cached = mask_cache.get(await get_cache_key(session, histogram_options, preview_options))
+        if cached is None:
+            return web.json_response({
+                "status": "error",
+                "message": "This video was not processed with its current prompts and histogram options yet"
+            }, status=404)
+        return await timelines_response(
+            cached.iter_histogram_chunks(STATS_CHUNK_FRAMES), get_bin_edges(session, histogram_options),
+            cached.obj_ids, num_points, percentiles,
+        )
+    except Exception as e:
+        logger.error(f"Error handling stats request: {e}")
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
+
+async def handle_export(request):
+    """
+    Export the masks, histograms and per-object statistics of a processed video to a Parquet or HDF5 file
+    ("format": "parquet" or "hdf5"). Takes the histogram and preview options of /process-video and the
+    percentiles of /stats, and is served from the results it cached.
+    """
+    try:
+        request_data = await request.json()
+        session = get_session(request_data.get('filename'))
+        if session is None:
+            return session_not_found_response(request_data.get('filename'))
+        try:
+            export_format = request_data.get('format', 'parquet')
+            check_export_format(export_format)
+            histogram_options = get_histogram_options(session, request_data)
+            preview_options = get_preview_options(request_data.get('preview'))
+            _, percentiles = get_timeline_options(request_data)
+        except (TypeError, ValueError) as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+
+        cached = mask_cache.get(await get_cache_key(session, histogram_options, preview_options))
+        if cached is None:
+            return web.json_response({
+                "status": "error",
+                "message": "This video was not processed with its current prompts and histogram options yet"
+            }, status=404)
+        metadata = {
+            "recording": session.session_id,
+            "video_hash": session.video_hash,
+            "num_frames": cached.num_frames,
+            "keyframes": cached.keyframes,
+            "histogram_options": histogram_options,
+        }
+        histogram_shape = cached.histograms.shape[1:] if cached.histograms is not None else None
+        return await export_response(
+            request, export_format, cached.iter_frames(), cached.obj_ids, histogram_shape,
+            get_bin_edges(session, histogram_options), percentiles, session.session_id, metadata,
+        )
+    except Exception as e:
+        logger.error(f"Error handling export request: {e}")
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
+
+async def handle_create_job(request):
+    """Start processing a whole video in the background, with the prompts applied by the user so far"""
+    try:
+        # Check if SAM2 is initialized
+        unavailable = model_unavailable_response()
+        if unavailable is not None:
+            return unavailable
+
+        request_data = await request.json()
+        session = get_session(request_data.get('filename'))
+        if session is None:
+            return session_not_found_response(request_data.get('filename'))
+        if not session.prompts:
+            return web.json_response({"status": "error", "message": "No prompts applied to this video yet"}, status=400)
+        if inference_pool.full:
+            return queue_full_response(InferenceQueueFull("Inference queue is full, not starting a job"))
+
+        try:
+            histogram_options = get_histogram_options(session, request_data)
+        except (TypeError, ValueError) as e:
+            return web.json_response({"status": "error", "message": str(e)}, status=400)
+
+        job = jobs.create(session.session_id, session.prompts, histogram_options, session.video_info["frames"])
+        start_job(job)
+        return web.json_response({"status": "success", "job": job.progress()}, status=202)
+    except Exception as e:
+        logger.error(f"Error handling create job request: {e}")
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
+
+async def handle_list_jobs(request):
+    """List the jobs, optionally only those of one video (?filename=...)"""
+    filename = request.query.get('filename')
+    return web.json_response({
+        "status": "success",
+        "jobs": [job.progress() for job in jobs.jobs.values() if filename is None or job.session_id == filename],
+    })
+
+async def handle_get_job(request):
+    """Report the progress of a job: frames done, frames per second and estimated time left"""
+    job = jobs.get(request.match_info['job_id'])
+    if job is None:
+        return job_not_found_response(request.match_info['job_id'])
+    return web.json_response({"status": "success", "job": job.progress()})
+
+async def handle_get_job_results(request):
+    """Return the masks and histograms a job produced so far, optionally for a range of frames"""
+    job = jobs.get(request.match_info['job_id'])
+    if job is None:
+        return job_not_found_response(request.match_info['job_id'])
+    encoding_error = check_mask_encoding(request)
+    if encoding_error is not None:
+        return encoding_error
+    try:
+        start_frame_idx = int(request.query.get('start_frame_idx', 0))
+        num_frames = int(request.query['num_frames']) if 'num_frames' in request.query else None
+    except ValueError:
+        return web.json_response({"status": "error", "message": "start_frame_idx and num_frames must be integers"}, status=400)
+
+    def collect():
+        masks_dict = {}
+        histograms = {"histograms": {}, "bin_edges": get_job_histogram_layout(job)[0]}
+        for frame_idx, mask, frame_histograms in job.iter_results(start_frame_idx, num_frames):
+            masks_dict[frame_idx] = mask
+            if frame_histograms is not None:
+                histograms["histograms"][frame_idx] = frame_histograms
+        return masks_dict, histograms
+
+    # checkpointed chunks are read from disk
+    masks_dict, histograms = await asyncio.to_thread(collect)
+    return await make_masks_response(request, masks_dict, job.obj_ids or [], histograms)
+
+async def handle_get_job_stats(request):
+    """Per-object statistics over time of the frames a job produced so far, downsampled like those of /stats"""
+    job = jobs.get(request.match_info['job_id'])
+    if job is None:
+        return job_not_found_response(request.match_info['job_id'])
+    try:
+        num_points, percentiles = get_timeline_options(request.query)
+    except ValueError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+
+    bin_edges, histogram_shape = await asyncio.to_thread(get_job_histogram_layout, job)
+    obj_ids = job.obj_ids or []
+    frames = ((frame_idx, histograms) for frame_idx, _, histograms in job.iter_results())
+    return await timelines_response(chunk_histograms(frames, histogram_shape), bin_edges, obj_ids, num_points, percentiles)
+
+async def handle_export_job(request):
+    """Export the frames a job produced so far, optionally a range of them, like /export (?format=parquet|hdf5)"""
+    job = jobs.get(request.match_info['job_id'])
+    if job is None:
+        return job_not_found_response(request.match_info['job_id'])
+    try:
+        export_format = request.query.get('format', 'parquet')
+        check_export_format(export_format)
+        _, percentiles = get_timeline_options(request.query)
+        start_frame_idx = int(request.query.get('start_frame_idx', 0))
+        num_frames = int(request.query['num_frames']) if 'num_frames' in request.query else None
+    except ValueError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+
+    bin_edges, histogram_shape = await asyncio.to_thread(get_job_histogram_layout, job)
+    obj_ids = job.obj_ids or []
+    metadata = {"recording": job.session_id, "job_id": job.job_id, "num_frames": job.num_frames, "histogram_options": job.histogram_options}
+    return await export_response(
+        request, export_format, job.iter_results(start_frame_idx, num_frames), obj_ids, histogram_shape,
+        bin_edges, percentiles, job.session_id, metadata,
+    )
+
+async def handle_resume_job(request):
+    """Resume a cancelled, failed or interrupted job from its last checkpoint"""
+    job = jobs.get(request.match_info['job_id'])
+    if job is None:
+        return job_not_found_response(request.match_info['job_id'])
+    if job.status not in RESUMABLE_STATUSES:
+        return web.json_response({"status": "error", "message": f"Job is {job.status}, it cannot be resumed"}, status=409)
+    unavailable = model_unavailable_response()
+    if unavailable is not None:
+        return unavailable
+    if inference_pool.full:
+        return queue_full_response(InferenceQueueFull("Inference queue is full, not resuming a job"))
+    start_job(job)
+    return web.json_response({"status": "success", "job": job.progress()}, status=202)
+
+async def handle_delete_job(request):
+    """Cancel a running job, keeping its checkpoint; delete a job that is not running"""
+    job = jobs.get(request.match_info['job_id'])
+    if job is None:
+        return job_not_found_response(request.match_info['job_id'])
+    if job.status in ACTIVE_STATUSES and job.task is not None:
+        job.task.cancel()
+        await asyncio.wait([job.task])  # wait for the checkpoint of the frames produced so far
+        return web.json_response({"status": "success", "job": job.progress()})
+    jobs.remove(job.job_id)
+    return web.json_response({"status": "success", "job": {**job.progress(), "status": "deleted"}})
+
+async def image_response(request, session: Session, etag: str, image_format: str, encode) -> web.StreamResponse:
+    """
+    Serve an encoded image of a recording: from the browser cache if it still has it, else from the image
+    cache, else encoded by `encode` off the event loop. The whole image is sent, or a single byte range of it.
+    """
+    headers = {
+        "ETag": etag,
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Accept-Ranges": "bytes",
+    }
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        return web.Response(status=304, headers=headers)
+    image = frame_image_cache.get(etag)
+    if image is None:
+        def read_and_encode():
+            return encode(open_frames(session))
+
+        with stage("encode_frame"):
+            image = await asyncio.to_thread(read_and_encode)
+        frame_image_cache.put(etag, image)
+
+    headers["Content-Type"] = IMAGE_FORMATS[image_format][1]
+    # a range of an image that changed since is not served; If-Range may only hold the ETag, as there is no Last-Modified
+    if_range = request.headers.get("If-Range")
+    try:
+        byte_range = parse_range(request.headers.get("Range"), len(image)) if if_range is None or if_range == etag else None
+    except ValueError:
+        return web.Response(status=416, headers={**headers, "Content-Range": f"bytes */{len(image)}"})
+    if byte_range is None:
+        return web.Response(body=image, headers=headers)
+    first, last = byte_range
+    headers["Content-Range"] = f"bytes {first}-{last}/{len(image)}"
+    return web.Response(status=206, body=image[first:last + 1], headers=headers)
+
+def get_frames_session(request) -> Tuple[Session | None, web.Response | None]:
+    video = request.match_info['video']
+    session = get_session(video)
+    if session is None:
+        return None, session_not_found_response(video)
+    return session, None
+
+async def handle_get_frame(request):
+    """
+    Serve a frame of a recording as a JPEG or PNG image (?format=jpeg|png, ?quality=1-100), optionally
+    downscaled to a height (?height=...), for random access to the frames without seeking a video
+    """
+    session, error = get_frames_session(request)
+    if error is not None:
+        return error
+    try:
+        image_options = get_image_options(request.query)
+    except ValueError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+    frame_idx = int(request.match_info['idx'])
+    num_frames = session.video_info["frames"]
+    if frame_idx >= num_frames:
+        return web.json_response({"status": "error", "message": f"frame must be between 0 and {num_frames - 1}"}, status=404)
+    etag = make_etag(session.video_hash or session.session_id, "frame", frame_idx, *image_options.values())
+    try:
+        return await image_response(
+            request, session, etag, image_options["format"],
+            lambda frames: encode_frame_image(frames, frame_idx, image_options),
+        )
+    except IndexError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=404)
+    except Exception as e:
+        logger.error(f"Error serving frame {frame_idx} of {session.session_id}: {e}")
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
+
+async def handle_get_thumbnail_strip(request):
+    """
+    Serve the thumbnails of a range of frames side by side as one image: frames start, start + step, ...
+    (?start=0&count=...&step=1), with the image options of /frames/{video}/{idx}
+    """
+    session, error = get_frames_session(request)
+    if error is not None:
+        return error
+    try:
+        image_options = get_image_options(request.query)
+        start, count, step = get_strip_range(request.query, session.video_info["frames"])
+    except ValueError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=400)
+    etag = make_etag(session.video_hash or session.session_id, "strip", start, count, step, *image_options.values())
+    try:
+        return await image_response(
+            request, session, etag, image_options["format"],
+            lambda frames: encode_thumbnail_strip(frames, start, count, step, image_options),
+        )
+    except IndexError as e:
+        return web.json_response({"status": "error", "message": str(e)}, status=404)
+    except Exception as e:
+        logger.error(f"Error serving thumbnails of {session.session_id}: {e}")
+        return web.json_response({"status": "error", "message": str(e)}, status=500)
+
+async def handle_healthz(request):
+    """Liveness: the server is up and serving requests, whatever the state of the model and data"""
+    return web.json_response({"status": "ok", "model": model_status, "data": data_status})
+
+async def handle_readyz(request):
+    """Readiness: 200 once the model is warmed up and the data of previous runs is loaded, 503 before, and if either failed"""
+    ready = sam2_predictor is not None and data_status["state"] == "ready"
+    return web.json_response({"status": "ready" if ready else "not_ready", "model": model_status, "data": data_status}, status=200 if ready else 503)
+
+async def handle_metrics(request):
+    """Metrics in the Prometheus text format (see metrics.py)"""
+    return web.Response(body=metrics.registry.render().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+@web.middleware
+async def timing_middleware(request, handler):
+    """Time each request and its stages, and add the Server-Timing header to responses that are not streamed, if enabled."""
+    timings = RequestTimings()
+    token = current_timings.set(timings)
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        if SERVER_TIMING and not response.prepared:
+            response.headers["Server-Timing"] = timings.header()
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        current_timings.reset(token)
+        metrics.request_seconds.observe(time.perf_counter() - timings.start, route=route_name(request), method=request.method, status=status)
+
 async def handle_root(request):
     """Serve the index.html file"""
     return web.FileResponse(BASE_DIR / "src" / "frontend" / "static" / "index.html")
 
 # Create application
-app = web.Application()
+app = web.Application(middlewares=[timing_middleware])
+
+# Gauges read when the metrics are collected
+metrics.registry.register(metrics.Gauge("thermal_studio_model_ready", "1 once SAM2 is loaded and warmed up.", function=lambda: float(sam2_predictor is not None)))
+metrics.registry.register(metrics.Gauge("thermal_studio_inference_pending", "Inference jobs admitted, running or waiting.", function=lambda: inference_pool.pending))
+metrics.registry.register(metrics.Gauge("thermal_studio_inference_queued", "Inference jobs waiting for a worker.", function=lambda: inference_pool.queued))
+metrics.registry.register(metrics.Gauge("thermal_studio_sessions", "Uploaded recordings with a session.", function=lambda: len(sessions.sessions)))
+metrics.registry.register(metrics.Gauge("thermal_studio_session_state_bytes", "Estimated memory of the inference states of all sessions.", function=lambda: sessions.used_bytes()))
+metrics.registry.register(metrics.Gauge("thermal_studio_embedding_cache_bytes", "Memory of the cached image features.", function=lambda: embedding_cache.stats()["used_bytes"]))
+metrics.registry.register(metrics.Gauge("thermal_studio_frame_image_cache_bytes", "Memory of the cached frame images and thumbnail strips.", function=lambda: frame_image_cache.stats()["used_bytes"]))
 
 # Add routes
 app.router.add_get('/', handle_root)  # Add root route
+app.router.add_get('/healthz', handle_healthz)
+app.router.add_get('/readyz', handle_readyz)
+app.router.add_get('/metrics', handle_metrics)
 app.router.add_post('/upload', handle_upload)
 app.router.add_post('/process-video', handle_process_video)
 app.router.add_post('/process-frame', handle_process_frame)  # Use the new handler instead of the function directly
+app.router.add_post('/prefetch', handle_prefetch)
+app.router.add_get('/frames/{video}/strip', handle_get_thumbnail_strip)
+app.router.add_get(r'/frames/{video}/{idx:\d+}', handle_get_frame)
+app.router.add_post('/stats', handle_stats)
+app.router.add_post('/export', handle_export)
+app.router.add_post('/jobs', handle_create_job)
+app.router.add_get('/jobs', handle_list_jobs)
+app.router.add_get('/jobs/{job_id}', handle_get_job)
+app.router.add_get('/jobs/{job_id}/results', handle_get_job_results)
+app.router.add_get('/jobs/{job_id}/stats', handle_get_job_stats)
+app.router.add_get('/jobs/{job_id}/export', handle_export_job)
+app.router.add_post('/jobs/{job_id}/resume', handle_resume_job)
+app.router.add_delete('/jobs/{job_id}', handle_delete_job)
 
 # Add static routes for different content types
 app.router.add_static('/static', path=str(BASE_DIR / "src" / "frontend" / "static"))
 app.router.add_static('/static/videos', path=str(UPLOAD_DIR))  # Serve videos from data/videos
 app.router.add_static('/static/masks', path=str(MASKS_DIR))  # Serve masks from data/masks
 
-async def startup(app):
-    """Initialize the application on startup."""
+def load_data() -> None:
+    """Load the jobs and uploads of previous runs, and remove what their interrupted runs left behind."""
+    jobs.load()
+    mask_cache.remove_incomplete(started_before=process_started_at)
+    remove_stale_exports()
+    load_upload_index()
+
+async def init_data() -> bool:
+    """
+    Load the data of previous runs off the event loop: it opens every job and frame store of the data directory.
+
+    Returns:
+        Whether the data was loaded.
+    """
     try:
-        # Initialize SAM2 model
-        initialized = await init_sam2()
-        if not initialized:
-            logger.warning("SAM2 model initialization failed. The model will be initialized on first use.")
+        start_time = time.perf_counter()
+        await asyncio.to_thread(load_data)
+        load_seconds = time.perf_counter() - start_time
+        data_status.update(state="ready", load_seconds=load_seconds)
+        logger.info(f"Loaded the data of previous runs in {load_seconds:.1f} s")
+        return True
     except Exception as e:
-        logger.error(f"Error during startup: {e}")
-        logger.warning("SAM2 model initialization failed. The model will be initialized on first use.")
+        logger.error(f"Error loading the data of previous runs: {e}")
+        data_status.update(state="failed", error=str(e))
+        return False
+
+async def startup(app):
+    """
+    Initialize the application on startup. SAM2 and the data of previous runs are loaded in the background:
+    the server listens meanwhile, see /readyz.
+    """
+    global model_task, data_task
+    data_task = asyncio.create_task(init_data())
+    model_task = asyncio.create_task(init_sam2())
+
+async def cleanup(app):
+    """Stop the running jobs, checkpointing them, and the inference workers on shutdown."""
+    running = [job.task for job in jobs.jobs.values() if job.active and job.task is not None]
+    for task in running:
+        task.cancel()
+    if running:
+        await asyncio.wait(running)
+    for task in prefetch_tasks.values():
+        task.cancel()
+    for task in (model_task, data_task):
+        if task is not None:
+            task.cancel()
+    inference_pool.shutdown()
 
 app.on_startup.append(startup)
+app.on_cleanup.append(cleanup)
 
 if __name__ == '__main__':
     web.run_app(app, host='0.0.0.0', port=8080) 
\ No newline at end of file
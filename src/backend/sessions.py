@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict, List, TypedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class PromptPoint(TypedDict):
+    x: float
+    y: float
+    label: int  # 1 for positive, 0 for negative
+    obj_id: int  # object id of the prompt point
+    frame_idx: int  # frame index of the prompt point
+
+
+class Session:
+    """
+    Everything the server keeps for one uploaded recording.
+
+    A session owns the SAM2 inference state of its recording, the prompts the user applied so far,
+    and the masks last computed for the prompted frames. The inference state can be evicted to free
+    memory; it is then rebuilt from the recording and the prompts on the next request.
+    """
+
+    def __init__(self, session_id: str, video_path: str, video_info: Dict[str, Any]):
+        self.session_id = session_id
+        self.video_path = video_path
+        self.video_info = video_info  # frames, fps, width, height
+        self.video_hash: str | None = None  # SHA-256 of the recording, computed on first use
+        self.frame_store = None  # decoded frames of the recording (frame_store.FrameStore)
+        self.inference_state = None
+        self.state_bytes = 0
+        self.prompts: List[PromptPoint] = []
+        self.frame_masks: Dict[int, np.ndarray] = {}  # masks of the prompted frames, as last returned to the user
+        self.last_used = time.monotonic()
+        # Serializes model work on this session; a session is idle when its lock is free
+        self.lock = asyncio.Lock()
+        # Number of prompt requests received; a request is superseded once a newer one was received
+        self.prompt_generation = 0
+
+    def touch(self) -> None:
+        self.last_used = time.monotonic()
+
+    def begin_prompt_request(self) -> int:
+        """Register a new prompt request, superseding those still pending. Returns its generation."""
+        self.prompt_generation += 1
+        return self.prompt_generation
+
+    def is_superseded(self, generation: int) -> bool:
+        """Whether a newer prompt request than the one of `generation` was received."""
+        return generation < self.prompt_generation
+
+
+def estimate_state_bytes(inference_state: Any) -> int:
+    """Estimate the memory held by a SAM2 inference state by summing the sizes of its tensors."""
+    seen = set()
+    total = 0
+    stack = [inference_state]
+    while stack:
+        value = stack.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if hasattr(value, "element_size") and hasattr(value, "nelement"):  # torch.Tensor
+            total += value.element_size() * value.nelement()
+        elif isinstance(value, np.ndarray):
+            total += value.nbytes
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return total
+
+
+class SessionRegistry:
+    """
+    Sessions keyed by upload id, with a memory budget for their inference states.
+
+    When the inference states of all sessions exceed the budget, the states of the least recently
+    used idle sessions are evicted. A session whose state was evicted keeps its prompts, and its
+    state is rebuilt transparently by `ensure_state`.
+    """
+
+    def __init__(self, memory_budget: int, build_state: Callable[[Session], Awaitable[Any]]):
+        """
+        Args:
+            memory_budget: Budget, in bytes, for the inference states of all sessions.
+            build_state: Coroutine function that builds the inference state of a session
+                from its recording and re-applies its prompts.
+        """
+        self.memory_budget = memory_budget
+        self.build_state = build_state
+        self.sessions: Dict[str, Session] = {}
+        self.latest_session_id: str | None = None
+
+    def add(self, session: Session) -> None:
+        self.sessions[session.session_id] = session
+        self.latest_session_id = session.session_id
+
+    def remove(self, session_id: str) -> None:
+        session = self.sessions.pop(session_id, None)
+        if self.latest_session_id == session_id:
+            self.latest_session_id = None
+        if session is not None:
+            self.release_frame_store(session)
+
+    def get(self, session_id: str | None) -> Session | None:
+        """Look up a session. Without a session id, the most recently uploaded session is returned."""
+        if session_id is None:
+            session_id = self.latest_session_id
+        return self.sessions.get(session_id) if session_id is not None else None
+
+    def used_bytes(self) -> int:
+        return sum(session.state_bytes for session in self.sessions.values())
+
+    async def ensure_state(self, session: Session) -> Any:
+        """
+        Return the inference state of a session, rebuilding it if it was evicted.
+
+        Must be called with the session lock held.
+        """
+        session.touch()
+        if session.inference_state is None:
+            logger.info(f"Building inference state of session {session.session_id}")
+            session.inference_state = await self.build_state(session)
+        await self.update_usage(session)
+        return session.inference_state
+
+    async def update_usage(self, session: Session) -> None:
+        """
+        Re-estimate the memory of a session's state (it grows with tracking results) and enforce the budget.
+
+        The state is walked off the event loop: after a propagation it holds the outputs of every frame.
+        """
+        inference_state = session.inference_state
+        session.state_bytes = await asyncio.to_thread(estimate_state_bytes, inference_state) if inference_state is not None else 0
+        self.enforce_budget(keep=session)
+
+    def evict(self, session: Session) -> None:
+        if session.inference_state is None:
+            return
+        logger.info(f"Evicting inference state of session {session.session_id} ({session.state_bytes / 2**20:.0f} MiB)")
+        session.inference_state = None
+        session.state_bytes = 0
+        # the state read its frames from the store, which is opened again when the state is rebuilt
+        self.release_frame_store(session)
+
+    def release_frame_store(self, session: Session) -> None:
+        """Let go of the frame store of a session, and close it unless another session shares it."""
+        store, session.frame_store = session.frame_store, None
+        if store is not None and all(other.frame_store is not store for other in self.sessions.values()):
+            store.release()
+
+    def enforce_budget(self, keep: Session | None = None) -> None:
+        """Evict the states of least recently used idle sessions until the budget is met."""
+        if self.used_bytes() <= self.memory_budget:
+            return
+        candidates = sorted(
+            (s for s in self.sessions.values() if s is not keep and s.inference_state is not None and not s.lock.locked()),
+            key=lambda s: s.last_used,
+        )
+        for session in candidates:
+            if self.used_bytes() <= self.memory_budget:
+                break
+            self.evict(session)
+        if self.used_bytes() > self.memory_budget:
+            logger.warning(
+                f"Inference states use {self.used_bytes() / 2**20:.0f} MiB, "
+                f"over the budget of {self.memory_budget / 2**20:.0f} MiB, but no idle session is left to evict"
+            )
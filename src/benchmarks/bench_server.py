@@ -0,0 +1,293 @@
+"""
+End-to-end benchmark of the server on synthetic thermal recordings.
+
+Generates a recording of warm objects moving over a cooler, noisy background and drives the aiohttp app
+of server.py through a test client: model loading until /readyz reports it ready, upload, two
+/process-frame clicks per object, /process-video (first run, then served from the mask cache) and a
+preview. It also times compute_histograms and the mask encodings directly. By default SAM2 is replaced by the deterministic StubPredictor (see
+stub_predictor.py), so runs need neither a GPU nor a checkpoint; with --model tiny the real tiny model
+in data/models is used.
+
+The server runs on a temporary data directory, so benchmarks neither read nor pollute data/.
+Results are written as JSON (--output), with the configuration and the commit they were measured on,
+so that runs of two commits can be compared.
+
+Usage:
+    python src/benchmarks/bench_server.py --width 640 --height 512 --frames 300 --objects 3 --output bench.json
+    python src/benchmarks/bench_server.py --model tiny --frames 100
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+import cv2
+import numpy as np
+from aiohttp import FormData
+from aiohttp.test_utils import TestClient, TestServer
+
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+import server  # noqa: E402
+from insights import compute_histograms  # noqa: E402
+from jobs import JobRegistry  # noqa: E402
+from mask_cache import MaskCache  # noqa: E402
+from serialization import BINARY_CONTENT_TYPE, encode_frame_record  # noqa: E402
+from stub_predictor import build_stub_predictor  # noqa: E402
+
+
+def object_tracks(num_frames: int, width: int, height: int, num_objects: int, seed: int = 0) -> np.ndarray:
+    """Centers (x, y) of the objects in each frame, of shape [F, num_objects, 2], on smooth Lissajous paths."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(num_frames)[:, np.newaxis] / max(num_frames, 1)
+    phase = rng.uniform(0, 2 * np.pi, size=(2, num_objects))
+    speed = rng.uniform(0.5, 2.0, size=(2, num_objects))
+    x = width * (0.5 + 0.3 * np.sin(2 * np.pi * speed[0] * t + phase[0]))
+    y = height * (0.5 + 0.3 * np.cos(2 * np.pi * speed[1] * t + phase[1]))
+    return np.stack([x, y], axis=-1)
+
+
+def object_radius(width: int, height: int, num_objects: int) -> float:
+    return min(width, height) / (4 * max(num_objects, 2))
+
+
+def synthetic_thermal_video(path: Path, num_frames: int, width: int, height: int, num_objects: int, fps: float = 30.0, seed: int = 0) -> np.ndarray:
+    """
+    Write a synthetic thermal recording: warm Gaussian blobs moving over a cooler background with a
+    vertical gradient and sensor noise, rendered with an ironbow-like palette as thermal cameras export.
+
+    Returns:
+        The object tracks (see object_tracks).
+    """
+    rng = np.random.default_rng(seed)
+    tracks = object_tracks(num_frames, width, height, num_objects, seed)
+    radius = object_radius(width, height, num_objects)
+    yy, xx = np.mgrid[:height, :width].astype(np.float32)
+    background = 60 + 40 * yy / height
+    temperatures = rng.uniform(150, 230, size=num_objects)
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"Could not open a video writer for {path}")
+    try:
+        for frame_idx in range(num_frames):
+            frame = background + rng.normal(0, 4, size=(height, width)).astype(np.float32)
+            for obj_idx in range(num_objects):
+                cx, cy = tracks[frame_idx, obj_idx]
+                blob = np.exp(-((xx - cx) ** 2 + (yy - cy) ** 2) / (2 * (radius / 2) ** 2))
+                frame = np.maximum(frame, background + (temperatures[obj_idx] - 60) * blob)
+            gray = np.clip(frame, 0, 255).astype(np.uint8)
+            writer.write(cv2.applyColorMap(gray, cv2.COLORMAP_INFERNO))
+    finally:
+        writer.release()
+    return tracks
+
+
+def disc_masks(tracks: np.ndarray, width: int, height: int, radius: float) -> Dict[int, np.ndarray]:
+    """Masks of shape (C, H, W) of each frame: a disc around each object, as tracking would produce."""
+    yy, xx = np.mgrid[:height, :width]
+    masks = {}
+    for frame_idx, centers in enumerate(tracks):
+        masks[frame_idx] = np.stack([
+            ((xx - cx) ** 2 + (yy - cy) ** 2 <= radius ** 2) for cx, cy in centers
+        ]).astype(np.uint8)
+    return masks
+
+
+def timed(fn, repeats: int) -> Dict[str, float]:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return {"best_s": min(timings), "median_s": statistics.median(timings)}
+
+
+def summarize_latencies(latencies: List[float]) -> Dict[str, float]:
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "mean_s": statistics.fmean(latencies),
+        "p50_s": latencies[len(latencies) // 2],
+        "max_s": latencies[-1],
+    }
+
+
+def use_temporary_data_dir(data_dir: Path) -> None:
+    """Point the server at an empty data directory."""
+    server.UPLOAD_DIR = data_dir / "videos"
+    server.MASKS_DIR = data_dir / "masks"
+    server.FRAMES_DIR = data_dir / "frames"
+    server.JOBS_DIR = data_dir / "jobs"
+    server.EXPORTS_DIR = data_dir / "exports"
+    for directory in (server.UPLOAD_DIR, server.MASKS_DIR, server.FRAMES_DIR, server.JOBS_DIR, server.EXPORTS_DIR):
+        directory.mkdir(parents=True, exist_ok=True)
+    server.mask_cache = MaskCache(server.MASKS_DIR, server.MASK_CACHE_SIZE)
+    server.jobs = JobRegistry(server.JOBS_DIR)
+
+
+async def read_body(response, start: float) -> Tuple[int, float | None]:
+    """Read a streamed response. Returns its size and the time from `start` to its first chunk."""
+    size = 0
+    first_chunk = None
+    async for chunk in response.content.iter_any():
+        if first_chunk is None:
+            first_chunk = time.perf_counter() - start
+        size += len(chunk)
+    return size, first_chunk
+
+
+async def bench_endpoints(video_path: Path, tracks: np.ndarray) -> Dict[str, Any]:
+    results: Dict[str, Any] = {}
+    async with TestClient(TestServer(server.app)) as client:
+        # the model loads in the background once the server is up
+        start = time.perf_counter()
+        while True:
+            response = await client.get("/readyz")
+            readiness = await response.json()
+            model = readiness["model"]
+            if response.status == 200:
+                break
+            if model["state"] == "failed":
+                raise RuntimeError(f"Model failed to load: {model['error']}")
+            if readiness["data"]["state"] == "failed":
+                raise RuntimeError(f"Data failed to load: {readiness['data']['error']}")
+            await asyncio.sleep(0.05)
+        results["model_ready"] = {"seconds": time.perf_counter() - start, "load_s": model["load_seconds"], "warmup_s": model["warmup_seconds"]}
+
+        with open(video_path, "rb") as f:
+            data = FormData()
+            data.add_field("file", f, filename=video_path.name, content_type="video/mp4")
+            start = time.perf_counter()
+            response = await client.post("/upload", data=data)
+            upload = await response.json()
+        results["upload"] = {"seconds": time.perf_counter() - start, "status": response.status}
+        if response.status != 200:
+            raise RuntimeError(f"Upload failed: {upload}")
+        filename = upload["filename"]
+
+        # one click per object on the first frame, then a correction click on each, as a user would
+        prompts = []
+        latencies = []
+        for round_idx in range(2):
+            for obj_idx, (x, y) in enumerate(tracks[0]):
+                prompts.append({"x": float(x) + round_idx * 2.0, "y": float(y), "label": 1, "obj_id": obj_idx, "frame_idx": 0})
+                start = time.perf_counter()
+                response = await client.post(
+                    "/process-frame", json={"filename": filename, "frame_idx": 0, "prompts": prompts},
+                    headers={"Accept": BINARY_CONTENT_TYPE},
+                )
+                await response.read()
+                latencies.append(time.perf_counter() - start)
+                if response.status != 200:
+                    raise RuntimeError(f"/process-frame failed with status {response.status}")
+        results["process_frame"] = summarize_latencies(latencies)
+
+        body = {"filename": filename}
+        for name, request_body in (("process_video", body), ("process_video_cached", body), ("process_video_preview", {**body, "preview": True})):
+            start = time.perf_counter()
+            response = await client.post("/process-video?stream=1", json=request_body, headers={"Accept": BINARY_CONTENT_TYPE})
+            size, first_chunk = await read_body(response, start)
+            seconds = time.perf_counter() - start
+            if response.status != 200:
+                raise RuntimeError(f"/process-video failed with status {response.status}")
+            results[name] = {
+                "seconds": seconds,
+                "time_to_first_chunk_s": first_chunk,
+                "frames_per_second": len(tracks) / seconds,
+                "payload_bytes": size,
+            }
+
+        start = time.perf_counter()
+        response = await client.post("/stats", json=body)
+        await response.read()
+        results["stats"] = {"seconds": time.perf_counter() - start, "status": response.status}
+    return results
+
+
+def bench_direct(video_path: Path, tracks: np.ndarray, width: int, height: int, num_objects: int, repeats: int) -> Dict[str, Any]:
+    masks = disc_masks(tracks, width, height, object_radius(width, height, num_objects))
+    obj_ids = list(range(num_objects))
+    histograms = compute_histograms(masks, str(video_path))["histograms"]
+    num_frames = len(masks)
+    results = {"compute_histograms": timed(lambda: compute_histograms(masks, str(video_path)), repeats)}
+    for encoding in ("bitpack", "rle"):
+        records = [encode_frame_record(frame_idx, obj_ids, mask, histograms.get(frame_idx), encoding) for frame_idx, mask in masks.items()]
+        results[f"encode_{encoding}"] = {
+            **timed(lambda: [encode_frame_record(frame_idx, obj_ids, mask, histograms.get(frame_idx), encoding) for frame_idx, mask in masks.items()], repeats),
+            "payload_bytes": sum(len(record) for record in records),
+        }
+    results["encode_json"] = {
+        **timed(lambda: json.dumps({str(k): v.tolist() for k, v in masks.items()}), repeats),
+        "payload_bytes": len(json.dumps({str(k): v.tolist() for k, v in masks.items()})),
+    }
+    for result in results.values():
+        result["per_frame_ms"] = result["best_s"] * 1000 / num_frames
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=512)
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--objects", type=int, default=3)
+    parser.add_argument("--fps", type=float, default=30.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3, help="Repeats of the direct measurements; the best is reported.")
+    parser.add_argument("--model", choices=("stub", "tiny"), default="stub", help="StubPredictor, or the real tiny SAM2 model.")
+    parser.add_argument("--output", type=Path, help="File to write the JSON results to (default: standard output).")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    server.DEBUG = False
+    if args.model == "stub":
+        server.build_sam2_video_predictor = build_stub_predictor
+
+    with tempfile.TemporaryDirectory(prefix="thermal-studio-bench-") as tmp:
+        data_dir = Path(tmp)
+        use_temporary_data_dir(data_dir)
+        video_path = data_dir / "synthetic.mp4"
+        tracks = synthetic_thermal_video(video_path, args.frames, args.width, args.height, args.objects, args.fps, args.seed)
+        results = {
+            "endpoints": asyncio.run(bench_endpoints(video_path, tracks)),
+            "direct": bench_direct(video_path, tracks, args.width, args.height, args.objects, args.repeats),
+        }
+        server.inference_pool.shutdown()
+
+    report = {
+        "config": vars(args) | {"output": str(args.output) if args.output else None},
+        "environment": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "torch": server.torch.__version__,
+            "device": str(server.sam2_predictor.device) if server.sam2_predictor is not None else None,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        args.output.write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Deterministic stand-in for the SAM2 video predictor, for benchmarks on CPU without a checkpoint.
+
+StubPredictor implements the part of SAM2VideoPredictor the server uses, on the inference states the
+server builds (see server.init_state_from_store). Its image encoder average-pools the input frame into
+a small feature map; its masks are discs around the prompted points, which follow the hot pixels of
+the feature map from frame to frame. The results are meaningless for segmentation, but the server does
+the same work around them as around SAM2: frame reads, feature caching, prompt bookkeeping,
+histograms and serialization.
+
+build_stub_predictor has the signature of sam2.build_sam.build_sam2_video_predictor.
+"""
+from typing import Any, Dict, List, Tuple
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+# Side of the feature map of the stub image encoder
+FEATURE_SIZE = 64
+# Minimum radius of the disc of an object, in pixels of the video
+MIN_RADIUS = 8.0
+
+
+class StubPredictor:
+    def __init__(self, image_size: int = 1024, device: str = "cpu"):
+        self.image_size = image_size
+        self.device = torch.device(device)
+
+    def forward_image(self, img_batch: torch.Tensor) -> Dict[str, Any]:
+        features = F.adaptive_avg_pool2d(img_batch, FEATURE_SIZE)
+        pos_enc = torch.zeros_like(features)
+        return {
+            "vision_features": features,
+            "vision_pos_enc": [pos_enc, pos_enc, pos_enc],
+            "backbone_fpn": [F.interpolate(features, scale_factor=4), F.interpolate(features, scale_factor=2), features],
+        }
+
+    def _get_image_feature(self, inference_state, frame_idx: int, batch_size: int) -> Tuple[torch.Tensor, Dict[str, Any]]:
+        # same caching protocol as SAM2VideoPredictor._get_image_feature
+        image, backbone_out = inference_state["cached_features"].get(frame_idx, (None, None))
+        if backbone_out is None:
+            image = inference_state["images"][frame_idx].to(self.device).float().unsqueeze(0)
+            backbone_out = self.forward_image(image)
+            inference_state["cached_features"] = {frame_idx: (image, backbone_out)}
+        return image, backbone_out
+
+    def _obj_idx(self, inference_state, obj_id: int) -> int:
+        obj_idx = inference_state["obj_id_to_idx"].get(obj_id)
+        if obj_idx is None:
+            obj_idx = len(inference_state["obj_id_to_idx"])
+            inference_state["obj_id_to_idx"][obj_id] = obj_idx
+            inference_state["obj_idx_to_id"][obj_idx] = obj_id
+            inference_state["obj_ids"] = list(inference_state["obj_id_to_idx"])
+            inference_state["point_inputs_per_obj"][obj_idx] = {}
+            inference_state["mask_inputs_per_obj"][obj_idx] = {}
+            inference_state["output_dict_per_obj"][obj_idx] = {}
+            inference_state["temp_output_dict_per_obj"][obj_idx] = {}
+            inference_state["frames_tracked_per_obj"][obj_idx] = {}
+        return obj_idx
+
+    def add_new_points_or_box(self, inference_state, frame_idx: int, obj_id: int, points=None, labels=None, clear_old_points: bool = True, **kwargs):
+        obj_idx = self._obj_idx(inference_state, obj_id)
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 2)
+        labels = np.asarray(labels, dtype=np.int32).reshape(-1)
+        frame_inputs = inference_state["point_inputs_per_obj"][obj_idx]
+        if not clear_old_points and frame_idx in frame_inputs:
+            old_points, old_labels = frame_inputs[frame_idx]
+            points = np.concatenate([old_points, points])
+            labels = np.concatenate([old_labels, labels])
+        frame_inputs[frame_idx] = (points, labels)
+        self._get_image_feature(inference_state, frame_idx, 1)
+        return frame_idx, inference_state["obj_ids"], self._frame_masks(inference_state, frame_idx, self._prompt_discs(inference_state, frame_idx))
+
+    def clear_all_prompts_in_frame(self, inference_state, frame_idx: int, obj_id: int, need_output: bool = True):
+        obj_idx = inference_state["obj_id_to_idx"].get(obj_id)
+        if obj_idx is not None:
+            inference_state["point_inputs_per_obj"][obj_idx].pop(frame_idx, None)
+        if need_output:
+            return frame_idx, inference_state["obj_ids"], self._frame_masks(inference_state, frame_idx, self._prompt_discs(inference_state, frame_idx))
+
+    def remove_object(self, inference_state, obj_id: int, strict: bool = False, need_output: bool = True):
+        if obj_id not in inference_state["obj_id_to_idx"]:
+            return inference_state["obj_ids"], []
+        remaining = [
+            (other_id, inference_state["point_inputs_per_obj"][obj_idx])
+            for other_id, obj_idx in inference_state["obj_id_to_idx"].items() if other_id != obj_id
+        ]
+        self.reset_state(inference_state)
+        for other_id, frame_inputs in remaining:
+            inference_state["point_inputs_per_obj"][self._obj_idx(inference_state, other_id)] = frame_inputs
+        return inference_state["obj_ids"], []
+
+    def reset_state(self, inference_state) -> None:
+        for key in ("obj_id_to_idx", "obj_idx_to_id"):
+            inference_state[key].clear()
+        inference_state["obj_ids"] = []
+        for key in ("point_inputs_per_obj", "mask_inputs_per_obj", "output_dict_per_obj", "temp_output_dict_per_obj", "frames_tracked_per_obj"):
+            inference_state[key].clear()
+
+    def propagate_in_video(self, inference_state, start_frame_idx: int | None = None, max_frame_num_to_track: int | None = None, reverse: bool = False):
+        num_frames = inference_state["num_frames"]
+        prompted = [frame_idx for inputs in inference_state["point_inputs_per_obj"].values() for frame_idx in inputs]
+        if not prompted:
+            raise RuntimeError("No points are provided; please add points first")
+        if start_frame_idx is None:
+            start_frame_idx = min(prompted)
+        if max_frame_num_to_track is None:
+            max_frame_num_to_track = num_frames
+        step = -1 if reverse else 1
+        end_frame_idx = max(min(start_frame_idx + step * max_frame_num_to_track, num_frames - 1), 0)
+        discs = self._prompt_discs(inference_state, start_frame_idx)
+        for frame_idx in range(start_frame_idx, end_frame_idx + step, step):
+            prompt_discs = self._prompt_discs(inference_state, frame_idx)
+            discs = [prompt if prompt is not None else disc for prompt, disc in zip(prompt_discs, discs)]
+            discs = self._follow(inference_state, frame_idx, discs)
+            yield frame_idx, inference_state["obj_ids"], self._frame_masks(inference_state, frame_idx, discs)
+
+    def _prompt_discs(self, inference_state, frame_idx: int) -> List[Tuple[float, float, float] | None]:
+        """Disc (x, y, radius) of each object from its prompts on a frame: centered on its positive points, covering them."""
+        discs = []
+        for obj_idx in range(len(inference_state["obj_ids"])):
+            inputs = inference_state["point_inputs_per_obj"].get(obj_idx, {}).get(frame_idx)
+            positive = inputs[0][inputs[1] > 0] if inputs is not None else np.zeros((0, 2))
+            if len(positive) == 0:
+                discs.append(None)
+                continue
+            center = positive.mean(axis=0)
+            radius = max(float(np.linalg.norm(positive - center, axis=1).max()) * 1.5, MIN_RADIUS)
+            discs.append((float(center[0]), float(center[1]), radius))
+        return discs
+
+    def _follow(self, inference_state, frame_idx: int, discs):
+        """Move each disc to the centroid of the hot pixels of the feature map around it."""
+        _, backbone_out = self._get_image_feature(inference_state, frame_idx, 1)
+        heat = backbone_out["vision_features"][0].mean(dim=0)
+        heat = torch.clamp(heat - heat.mean(), min=0)
+        scale_x = FEATURE_SIZE / inference_state["video_width"]
+        scale_y = FEATURE_SIZE / inference_state["video_height"]
+        moved = []
+        for disc in discs:
+            if disc is None:
+                moved.append(None)
+                continue
+            x, y, radius = disc
+            x0, x1 = int(max((x - 2 * radius) * scale_x, 0)), int(min((x + 2 * radius) * scale_x + 1, FEATURE_SIZE))
+            y0, y1 = int(max((y - 2 * radius) * scale_y, 0)), int(min((y + 2 * radius) * scale_y + 1, FEATURE_SIZE))
+            window = heat[y0:y1, x0:x1]
+            total = float(window.sum())
+            if total > 0:
+                ys, xs = torch.meshgrid(torch.arange(y0, y1, dtype=torch.float32), torch.arange(x0, x1, dtype=torch.float32), indexing="ij")
+                x = float((window * xs).sum()) / total / scale_x
+                y = float((window * ys).sum()) / total / scale_y
+            moved.append((x, y, radius))
+        return moved
+
+    def _frame_masks(self, inference_state, frame_idx: int, discs) -> torch.Tensor:
+        """Mask logits of shape (num_objects, 1, video_height, video_width): positive inside the disc of each object."""
+        height, width = inference_state["video_height"], inference_state["video_width"]
+        ys = torch.arange(height, dtype=torch.float32)[:, None]
+        xs = torch.arange(width, dtype=torch.float32)[None, :]
+        masks = torch.full((len(discs), 1, height, width), -1.0)
+        for obj_idx, disc in enumerate(discs):
+            if disc is not None:
+                x, y, radius = disc
+                masks[obj_idx, 0] = radius - torch.sqrt((xs - x) ** 2 + (ys - y) ** 2)
+        return masks
+
+
+def build_stub_predictor(config_file: str = None, ckpt_path: str = None, device: str = "cpu", **kwargs) -> StubPredictor:
+    return StubPredictor(device=device)
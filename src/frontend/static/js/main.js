@@ -8,6 +8,172 @@ const MASK_COLORS = [
     'rgba(70, 130, 180, 0.5)'  // Steel blue
 ];
 
+// Binary mask transport, see src/backend/serialization.py for the format
+const BINARY_CONTENT_TYPE = 'application/octet-stream';
+const MASK_STREAM_MAGIC = 'TSM1';
+const MASK_ENCODING_RLE = 1;
+// Frame index of the record that ends a stream that failed part way, followed by a JSON error
+const ERROR_RECORD_FRAME_IDX = 0xFFFFFFFF;
+
+// Frames between keyframes of a preview (see the preview option of /process-video)
+const PREVIEW_STRIDE = 8;
+
+// Delay after the last move of the frame slider before the server is asked to prefetch the frames around
+const PREFETCH_DEBOUNCE_MS = 150;
+// Delay after the last click before the prompts are sent, so that a burst of clicks makes a single request
+const PROMPT_DEBOUNCE_MS = 80;
+
+// Format of the frames fetched from /frames/{video}/{idx} while scrubbing, instead of seeking the video
+const FRAME_IMAGE_FORMAT = 'jpeg';
+
+class MaskDecoder {
+    // Decode a whole binary payload: the stream header followed by frame records.
+    static decode(buffer) {
+        const reader = new MaskStreamReader();
+        const frames = reader.push(new Uint8Array(buffer));
+        return { metadata: reader.metadata, frames };
+    }
+
+    // Decode the body of a single frame record starting at `offset`.
+    static decodeRecord(buffer, offset) {
+        const view = new DataView(buffer);
+        const frameIdx = view.getUint32(offset, true);
+        const numObjects = view.getUint16(offset + 4, true);
+        const maskEncoding = view.getUint8(offset + 6);
+        const numChannels = view.getUint8(offset + 7);
+        const height = view.getUint32(offset + 8, true);
+        const width = view.getUint32(offset + 12, true);
+        const numBins = view.getUint32(offset + 16, true);
+        offset += 20;
+
+        const objectIds = [];
+        for (let i = 0; i < numObjects; i++) {
+            objectIds.push(view.getInt32(offset, true));
+            offset += 4;
+        }
+
+        const maskPayloadLength = view.getUint32(offset, true);
+        offset += 4;
+        const payload = new Uint8Array(buffer, offset, maskPayloadLength);
+        offset += maskPayloadLength;
+        const masks = maskEncoding === MASK_ENCODING_RLE
+            ? MaskDecoder.unpackRLE(payload, numObjects, width * height)
+            : MaskDecoder.unpackBits(payload, numObjects, width * height);
+
+        // histograms[channel][object] is an Int32Array of numBins counts
+        let histograms = null;
+        if (numChannels > 0) {
+            // copy, so that the Int32Array view is aligned
+            const counts = new Int32Array(buffer.slice(offset, offset + numChannels * numObjects * numBins * 4));
+            histograms = [];
+            for (let c = 0; c < numChannels; c++) {
+                const channel = [];
+                for (let o = 0; o < numObjects; o++) {
+                    const start = (c * numObjects + o) * numBins;
+                    channel.push(counts.subarray(start, start + numBins));
+                }
+                histograms.push(channel);
+            }
+        }
+
+        return {
+            frameIdx,
+            objectIds,
+            masks: masks.map(data => ({ width, height, data })),
+            histograms
+        };
+    }
+
+    // Bit-packed masks: 8 pixels per byte, least significant bit first.
+    static unpackBits(payload, numObjects, pixelsPerObject) {
+        const masks = [];
+        for (let o = 0; o < numObjects; o++) {
+            const data = new Uint8Array(pixelsPerObject);
+            const base = o * pixelsPerObject;
+            for (let i = 0; i < pixelsPerObject; i++) {
+                const bit = base + i;
+                data[i] = (payload[bit >> 3] >> (bit & 7)) & 1;
+            }
+            masks.push(data);
+        }
+        return masks;
+    }
+
+    // Run-length encoded masks: per object, a run count and runs alternating between background and foreground.
+    static unpackRLE(payload, numObjects, pixelsPerObject) {
+        const view = new DataView(payload.buffer, payload.byteOffset, payload.byteLength);
+        const masks = [];
+        let offset = 0;
+        for (let o = 0; o < numObjects; o++) {
+            const data = new Uint8Array(pixelsPerObject);
+            const numRuns = view.getUint32(offset, true);
+            offset += 4;
+            let position = 0;
+            for (let r = 0; r < numRuns; r++) {
+                const run = view.getUint32(offset, true);
+                offset += 4;
+                if (r % 2 === 1) {
+                    data.fill(1, position, position + run);
+                }
+                position += run;
+            }
+            masks.push(data);
+        }
+        return masks;
+    }
+}
+
+// Incremental decoder of a binary mask stream, fed with chunks as they arrive over the network
+class MaskStreamReader {
+    constructor() {
+        this.pending = new Uint8Array(0);
+        this.metadata = null;
+        this.error = null;  // message of the error record that ended the stream, if any
+    }
+
+    // Append a chunk and return the frame records that became complete.
+    push(chunk) {
+        const merged = new Uint8Array(this.pending.length + chunk.length);
+        merged.set(this.pending);
+        merged.set(chunk, this.pending.length);
+        const view = new DataView(merged.buffer);
+        const frames = [];
+        let offset = 0;
+
+        if (!this.metadata) {
+            if (merged.length < 8) {
+                this.pending = merged;
+                return frames;
+            }
+            const magic = String.fromCharCode(...merged.subarray(0, 4));
+            if (magic !== MASK_STREAM_MAGIC) {
+                throw new Error('Not a binary mask stream');
+            }
+            const metadataLength = view.getUint32(4, true);
+            if (merged.length < 8 + metadataLength) {
+                this.pending = merged;
+                return frames;
+            }
+            this.metadata = JSON.parse(new TextDecoder().decode(merged.subarray(8, 8 + metadataLength)));
+            offset = 8 + metadataLength;
+        }
+
+        while (offset + 4 <= merged.length) {
+            const bodyLength = view.getUint32(offset, true);
+            if (offset + 4 + bodyLength > merged.length) break;
+            if (view.getUint32(offset + 4, true) === ERROR_RECORD_FRAME_IDX) {
+                const body = merged.subarray(offset + 8, offset + 4 + bodyLength);
+                this.error = JSON.parse(new TextDecoder().decode(body)).message;
+            } else {
+                frames.push(MaskDecoder.decodeRecord(merged.buffer, offset + 4));
+            }
+            offset += 4 + bodyLength;
+        }
+        this.pending = merged.slice(offset);
+        return frames;
+    }
+}
+
 // State Management
 class AppState {
     constructor(ui) {
@@ -28,6 +194,9 @@ class AppState {
         this.objects = {};
         this.currentObjectId = null;
         this.histograms = null;  // Store histograms data
+        this.timelines = null;  // Per-object statistics over time, from /stats
+        this.preview = null;  // Options and keyframes of the preview shown, null for full tracking results
+        this.frameImage = null;  // Frame fetched from the server while scrubbing: {frameIdx, image}
     }
 
     reset() {
@@ -36,6 +205,7 @@ class AppState {
         this.objects = {};
         this.currentObjectId = 1;
         this.histograms = null;  // Reset histograms
+        this.timelines = null;
         
         // Create initial object
         this.objects[this.currentObjectId] = {
@@ -48,10 +218,14 @@ class AppState {
         // Update UI to show the first object as active
         this.ui.updateObjectsList();
         
-        // Reset monochrome toggle
+        // Reset monochrome and preview toggles
         if (this.ui.elements.monochromeToggle) {
             this.ui.elements.monochromeToggle.checked = false;
         }
+        if (this.ui.elements.previewToggle) {
+            this.ui.elements.previewToggle.checked = false;
+        }
+        this.preview = null;
     }
 }
 
@@ -80,7 +254,9 @@ class UIManager {
             progressText: document.querySelector('.progress-text'),
             fileInput: document.getElementById('file-input'),
             fileInputLabel: document.querySelector('.primary-btn'),
-            monochromeToggle: document.getElementById('monochrome-toggle')
+            monochromeToggle: document.getElementById('monochrome-toggle'),
+            previewToggle: document.getElementById('preview-toggle'),
+            runFullTrackingBtn: document.getElementById('run-full-tracking')
         };
         this.histogramCanvas = document.getElementById('histogramCanvas');
         this.histogramCtx = this.histogramCanvas ? this.histogramCanvas.getContext('2d') : null;
@@ -126,6 +302,13 @@ class UIManager {
         this.elements.workspace.style.display = 'flex';
     }
 
+    setProcessingStatus(text) {
+        const status = document.getElementById('processing-status');
+        if (status) {
+            status.textContent = text;
+        }
+    }
+
     showTooltip() {
         this.elements.tooltip.style.display = 'block';
     }
@@ -142,9 +325,12 @@ class VideoManager {
         this.ui = ui;
         this.histogramCanvas = document.getElementById('histogramCanvas');
         this.histogramCtx = this.histogramCanvas ? this.histogramCanvas.getContext('2d') : null;
+        this.timelineCanvas = document.getElementById('timelineCanvas');
+        this.timelineCtx = this.timelineCanvas ? this.timelineCanvas.getContext('2d') : null;
     }
 
     async loadVideo(filename) {
+        this.state.frameImage = null;
         return new Promise((resolve, reject) => {
             this.state.videoElement = document.createElement('video');
             this.state.videoElement.src = `/static/videos/${filename}`;
@@ -201,14 +387,38 @@ class VideoManager {
         }
     }
 
+    // Fetch a frame from the server and draw it once loaded, unless the user moved on to another frame.
+    // Seeking the video can take long on large recordings and lands on a frame near the requested time,
+    // which the masks of the requested frame do not match; the server reads the exact frame from its frame store.
+    showFrame(frameIdx) {
+        if (!this.state.currentVideo) return;
+        if (this.pendingFrameImage) {
+            this.pendingFrameImage.onload = null;
+            this.pendingFrameImage.src = '';  // cancel the request of a frame the user scrubbed past
+        }
+        const image = new Image();
+        this.pendingFrameImage = image;
+        image.onload = () => {
+            this.pendingFrameImage = null;
+            if (this.state.currentFrame !== frameIdx) return;
+            this.state.frameImage = { frameIdx, image };
+            this.drawFrame();
+        };
+        image.src = `/frames/${encodeURIComponent(this.state.currentVideo.filename)}/${frameIdx}?format=${FRAME_IMAGE_FORMAT}`;
+    }
+
     drawFrame() {
         if (!this.state.ctx || !this.state.videoElement) return;
         
         // Clear canvas
         this.state.ctx.clearRect(0, 0, this.state.canvasElement.width, this.state.canvasElement.height);
         
-        // Draw video frame
-        this.state.ctx.drawImage(this.state.videoElement, 0, 0, this.state.canvasElement.width, this.state.canvasElement.height);
+        // Draw video frame: the frame fetched from the server if it is the current one, else the video
+        const frameImage = this.state.frameImage;
+        const source = !this.state.isPlaying && frameImage && frameImage.frameIdx === this.state.currentFrame
+            ? frameImage.image
+            : this.state.videoElement;
+        this.state.ctx.drawImage(source, 0, 0, this.state.canvasElement.width, this.state.canvasElement.height);
         
         // Draw masks and points
         this.drawMasks();
@@ -218,6 +428,7 @@ class VideoManager {
         // Only draw if we're in inspection mode
         if (this.ui.app.objectManager.isInspectionMode) {
             this.drawHistogram();
+            this.drawTimeline();
         }
     }
 
@@ -257,8 +468,13 @@ class VideoManager {
             
             // Handle different mask formats
             let maskData, maskHeight, maskWidth;
-            
-            if (Array.isArray(mask) && mask.length > 0) {
+
+            if (mask && mask.data instanceof Uint8Array) {
+                // Binary transport: flat [height * width] mask with explicit dimensions
+                maskData = mask.data;
+                maskHeight = mask.height;
+                maskWidth = mask.width;
+            } else if (Array.isArray(mask) && mask.length > 0) {
                 if (Array.isArray(mask[0]) && Array.isArray(mask[0][0])) {
                     // Case 1: 3D array [num_objects, height, width]
                     console.log("Processing 3D mask array format");
@@ -280,41 +496,43 @@ class VideoManager {
                     maskWidth = maskHeight;
                     maskData = mask;
                 }
-                
-                console.log(`Processing mask for object ${objectId} with dimensions ${maskWidth}x${maskHeight}`);
-                
-                // Scale factors for mapping mask coordinates to canvas coordinates
-                const scaleX = this.state.canvasElement.width / maskWidth;
-                const scaleY = this.state.canvasElement.height / maskHeight;
-                
-                // Convert the mask data to canvas pixels
-                for (let y = 0; y < this.state.canvasElement.height; y++) {
-                    for (let x = 0; x < this.state.canvasElement.width; x++) {
-                        // Map canvas coordinates back to mask coordinates
-                        const maskY = Math.floor(y / scaleY);
-                        const maskX = Math.floor(x / scaleX);
-                        
-                        // Get mask value based on data format
-                        let maskValue = 0;
-                        if (Array.isArray(maskData[maskY])) {
-                            // 2D array format
-                            maskValue = maskData[maskY][maskX] || 0;
-                        } else {
-                            // 1D array format
-                            const idx = maskY * maskWidth + maskX;
-                            maskValue = maskData[idx] || 0;
-                        }
-                        
-                        // Check if the mask has a value at this position
-                        if (maskY < maskHeight && maskX < maskWidth && maskValue > 0) {
-                            const idx = (y * this.state.canvasElement.width + x) * 4;
-                            // Blend the colors using alpha compositing
-                            const alpha = color.a * 255;
-                            data[idx] = (data[idx] * (255 - alpha) + color.r * alpha) / 255;     // R
-                            data[idx + 1] = (data[idx + 1] * (255 - alpha) + color.g * alpha) / 255; // G
-                            data[idx + 2] = (data[idx + 2] * (255 - alpha) + color.b * alpha) / 255; // B
-                            data[idx + 3] = Math.min(255, data[idx + 3] + alpha); // A
-                        }
+            }
+
+            if (!maskData) return;
+            
+            console.log(`Processing mask for object ${objectId} with dimensions ${maskWidth}x${maskHeight}`);
+            
+            // Scale factors for mapping mask coordinates to canvas coordinates
+            const scaleX = this.state.canvasElement.width / maskWidth;
+            const scaleY = this.state.canvasElement.height / maskHeight;
+            
+            // Convert the mask data to canvas pixels
+            for (let y = 0; y < this.state.canvasElement.height; y++) {
+                for (let x = 0; x < this.state.canvasElement.width; x++) {
+                    // Map canvas coordinates back to mask coordinates
+                    const maskY = Math.floor(y / scaleY);
+                    const maskX = Math.floor(x / scaleX);
+                    
+                    // Get mask value based on data format
+                    let maskValue = 0;
+                    if (Array.isArray(maskData[maskY])) {
+                        // 2D array format
+                        maskValue = maskData[maskY][maskX] || 0;
+                    } else {
+                        // 1D array format
+                        const idx = maskY * maskWidth + maskX;
+                        maskValue = maskData[idx] || 0;
+                    }
+                    
+                    // Check if the mask has a value at this position
+                    if (maskY < maskHeight && maskX < maskWidth && maskValue > 0) {
+                        const idx = (y * this.state.canvasElement.width + x) * 4;
+                        // Blend the colors using alpha compositing
+                        const alpha = color.a * 255;
+                        data[idx] = (data[idx] * (255 - alpha) + color.r * alpha) / 255;     // R
+                        data[idx + 1] = (data[idx + 1] * (255 - alpha) + color.g * alpha) / 255; // G
+                        data[idx + 2] = (data[idx + 2] * (255 - alpha) + color.b * alpha) / 255; // B
+                        data[idx + 3] = Math.min(255, data[idx + 3] + alpha); // A
                     }
                 }
             }
@@ -382,7 +600,7 @@ class VideoManager {
         
         const binEdges = this.state.histograms.bin_edges[0]; // Use first channel's bin edges
 
-        if (!histograms || !binEdges) return;
+        if (!histograms || histograms.some(h => !h) || !binEdges) return;
 
         // Clear histogram canvas
         this.histogramCtx.clearRect(0, 0, this.histogramCanvas.width, this.histogramCanvas.height);
@@ -407,12 +625,14 @@ class VideoManager {
         this.histogramCtx.lineTo(width - padding.right, height - padding.bottom);
         this.histogramCtx.stroke();
 
-        // Find max value across all channels for scaling
-        const maxValue = Math.max(...histograms.map(h => Math.max(...h)));
+        // Find max value across all channels for scaling (without spreading the bins into arguments)
+        let maxValue = 0;
+        histograms.forEach(h => h.forEach(value => { if (value > maxValue) maxValue = value; }));
 
         // Draw histogram lines for each channel
         const channelColors = hasRGBChannels ? ['#FF4444', '#44FF44', '#4444FF'] : ['#FFFFFF'];
-        const barWidth = graphWidth / 256; // 256 bins
+        const numBins = histograms[0].length; // 256 for 8-bit video, configurable for radiometric stacks
+        const barWidth = graphWidth / numBins;
 
         histograms.forEach((histogram, channelIndex) => {
             this.histogramCtx.strokeStyle = channelColors[channelIndex];
@@ -437,14 +657,16 @@ class VideoManager {
         this.histogramCtx.fillStyle = '#fff';
         this.histogramCtx.font = '10px Arial';
         
-        // X-axis labels
+        // X-axis labels, in the units of the bin edges (intensities, or raw counts of radiometric stacks)
         const numXLabels = 5;
         this.histogramCtx.textAlign = 'center';
         this.histogramCtx.textBaseline = 'top';
         for (let i = 0; i <= numXLabels; i++) {
             const x = padding.left + (i / numXLabels) * graphWidth;
-            const binIndex = Math.floor((i / numXLabels) * 255);
-            this.histogramCtx.fillText(binIndex.toString(), x, height - padding.bottom + 5);
+            const edgeIndex = Math.round((i / numXLabels) * (binEdges.length - 1));
+            const edge = binEdges[edgeIndex];
+            const label = Number.isInteger(edge) ? edge.toString() : edge.toPrecision(4);
+            this.histogramCtx.fillText(label, x, height - padding.bottom + 5);
         }
 
         // Y-axis labels
@@ -480,6 +702,96 @@ class VideoManager {
         }
     }
 
+    // Plot the mean, min and max of the active object over the whole recording, with a cursor at the current frame
+    drawTimeline() {
+        if (!this.timelineCtx || !this.state.timelines || !this.state.currentObjectId) return;
+
+        const timelines = this.state.timelines;
+        const timeline = timelines.objects.find(obj => obj.obj_id === this.state.currentObjectId - 1);
+        const ctx = this.timelineCtx;
+        const width = this.timelineCanvas.width;
+        const height = this.timelineCanvas.height;
+        const padding = { top: 20, right: 30, bottom: 30, left: 40 };
+        const graphWidth = width - padding.left - padding.right;
+        const graphHeight = height - padding.top - padding.bottom;
+
+        ctx.clearRect(0, 0, width, height);
+        ctx.fillStyle = 'rgba(0, 0, 0, 0.2)';
+        ctx.fillRect(0, 0, width, height);
+        if (!timeline) return;
+
+        // Value range across the min and max series of all channels
+        let low = Infinity;
+        let high = -Infinity;
+        ['min', 'max'].forEach(stat => timeline[stat].forEach(series => series.values.forEach(value => {
+            if (value === null) return;
+            if (value < low) low = value;
+            if (value > high) high = value;
+        })));
+        if (low === Infinity) return;  // the object is absent from every frame
+        if (high === low) high = low + 1;
+
+        const lastFrame = Math.max(timelines.num_frames - 1, 1);
+        const toX = frameIdx => padding.left + (frameIdx / lastFrame) * graphWidth;
+        const toY = value => height - padding.bottom - ((value - low) / (high - low)) * graphHeight;
+
+        // Draw axes
+        ctx.strokeStyle = '#666';
+        ctx.lineWidth = 1;
+        ctx.beginPath();
+        ctx.moveTo(padding.left, padding.top);
+        ctx.lineTo(padding.left, height - padding.bottom);
+        ctx.lineTo(width - padding.right, height - padding.bottom);
+        ctx.stroke();
+
+        // Draw the series of each channel; frames where the object is absent break the lines
+        const channelColors = timeline.mean.length === 3 ? ['#FF4444', '#44FF44', '#4444FF'] : ['#FFFFFF'];
+        const drawSeries = (series, color, alpha) => {
+            ctx.strokeStyle = color;
+            ctx.globalAlpha = alpha;
+            ctx.beginPath();
+            let drawing = false;
+            series.frame_idx.forEach((frameIdx, i) => {
+                const value = series.values[i];
+                if (value === null) {
+                    drawing = false;
+                } else if (drawing) {
+                    ctx.lineTo(toX(frameIdx), toY(value));
+                } else {
+                    ctx.moveTo(toX(frameIdx), toY(value));
+                    drawing = true;
+                }
+            });
+            ctx.stroke();
+            ctx.globalAlpha = 1;
+        };
+        timeline.mean.forEach((series, channel) => {
+            drawSeries(timeline.min[channel], channelColors[channel], 0.35);
+            drawSeries(timeline.max[channel], channelColors[channel], 0.35);
+            drawSeries(series, channelColors[channel], 1);
+        });
+
+        // Cursor at the current frame
+        ctx.strokeStyle = '#FFD700';
+        ctx.beginPath();
+        ctx.moveTo(toX(this.state.currentFrame), padding.top);
+        ctx.lineTo(toX(this.state.currentFrame), height - padding.bottom);
+        ctx.stroke();
+
+        // Draw labels
+        ctx.fillStyle = '#fff';
+        ctx.font = '10px Arial';
+        ctx.textAlign = 'center';
+        ctx.textBaseline = 'top';
+        [0, lastFrame].forEach(frameIdx => ctx.fillText(frameIdx.toString(), toX(frameIdx), height - padding.bottom + 5));
+        ctx.textAlign = 'right';
+        ctx.textBaseline = 'middle';
+        [low, high].forEach(value => {
+            const label = Number.isInteger(value) ? value.toString() : value.toPrecision(4);
+            ctx.fillText(label, padding.left - 5, toY(value));
+        });
+    }
+
     parseRGBA(rgba) {
         const match = rgba.match(/rgba\((\d+),\s*(\d+),\s*(\d+),\s*([\d.]+)\)/);
         if (match) {
@@ -501,7 +813,10 @@ class VideoManager {
 
     updateHistogram() {
         if (this.ui.app.objectManager.isInspectionMode) {
-            requestAnimationFrame(() => this.drawHistogram());
+            requestAnimationFrame(() => {
+                this.drawHistogram();
+                this.drawTimeline();
+            });
         }
     }
 }
@@ -522,6 +837,28 @@ class ObjectManager {
             this.handleCanvasClick(e, true);
         };
         this.isInspectionMode = false;
+        this.prefetchTimer = null;
+        this.promptTimer = null;
+        this.promptWaiters = [];  // resolvers of the processFrame calls folded into the pending request
+        this.promptSeq = 0;  // sequence number of the last prompt request sent
+        this.maskSeq = {};  // frame index -> sequence number of the request its masks come from
+    }
+
+    // Let the server compute the image features of the frames around the scrub position while the user
+    // looks for one to prompt, so that the click on it skips the image encoder
+    schedulePrefetch() {
+        clearTimeout(this.prefetchTimer);
+        if (this.isInspectionMode || !this.state.currentVideo) return;
+        this.prefetchTimer = setTimeout(() => {
+            fetch('/prefetch', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    filename: this.state.currentVideo.filename,
+                    frame_idx: this.state.currentFrame
+                })
+            }).catch(error => console.warn('Prefetch request failed:', error));
+        }, PREFETCH_DEBOUNCE_MS);
     }
 
     setActiveObject(objectId) {
@@ -744,7 +1081,32 @@ class ObjectManager {
         return -1; // No point found at this location
     }
 
-    async processFrame() {
+    // Send the prompts once clicks pause; resolves when the request of the last click is done
+    processFrame() {
+        clearTimeout(this.promptTimer);
+        return new Promise(resolve => {
+            this.promptWaiters.push(resolve);
+            this.promptTimer = setTimeout(async () => {
+                const waiters = this.promptWaiters;
+                this.promptWaiters = [];
+                await this.sendPrompts();
+                waiters.forEach(waiter => waiter());
+            }, PROMPT_DEBOUNCE_MS);
+        });
+    }
+
+    // Masks of a frame are only replaced by those of a newer request, in case responses arrive out of order
+    acceptMasks(frameIdx, seq) {
+        if ((this.maskSeq[frameIdx] || 0) > seq) {
+            console.log(`Dropping outdated masks of frame ${frameIdx} from request ${seq}`);
+            return false;
+        }
+        this.maskSeq[frameIdx] = seq;
+        return true;
+    }
+
+    async sendPrompts() {
+        const seq = ++this.promptSeq;
         const framePoints = [];
         for (const objId in this.state.objects) {
             const obj = this.state.objects[objId];
@@ -765,17 +1127,31 @@ class ObjectManager {
             const response = await fetch('/process-frame', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json'
+                    'Content-Type': 'application/json',
+                    'Accept': BINARY_CONTENT_TYPE
                 },
                 body: JSON.stringify({
+                    filename: this.state.currentVideo.filename,
                     frame_idx: this.state.currentFrame,
                     prompts: framePoints
                 })
             });
             
+            if (response.status === 409) {
+                // superseded on the server by a newer request, which returns the masks of these prompts too
+                console.log(`Prompt request ${seq} was superseded`);
+                return;
+            }
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
+
+            if (this.isBinaryResponse(response)) {
+                const { frames } = MaskDecoder.decode(await response.arrayBuffer());
+                this.storeMaskRecords(frames.filter(frame => this.acceptMasks(frame.frameIdx, seq)));
+                this.videoManager.drawFrame();
+                return;
+            }
             
             const result = await response.json();
             console.log('Received mask result:', result);
@@ -783,6 +1159,7 @@ class ObjectManager {
             if (result.masks) {
                 // Process each frame's masks in the response
                 Object.entries(result.masks).forEach(([frameIdx, maskData]) => {
+                    if (!this.acceptMasks(frameIdx, seq)) return;
                     // Initialize masks for this frame if not exists
                     if (!this.state.masks[frameIdx]) {
                         this.state.masks[frameIdx] = {};
@@ -813,6 +1190,115 @@ class ObjectManager {
         }
     }
 
+    // Fill in the results view progressively, as frames are streamed by /process-video
+    async readMaskStream(response) {
+        const streamReader = new MaskStreamReader();
+        const bodyReader = response.body.getReader();
+        let received = 0;
+
+        this.state.masks = {};
+        this.state.histograms = null;
+        while (true) {
+            const { done, value } = await bodyReader.read();
+            if (done) break;
+
+            const frames = streamReader.push(value);
+            if (!streamReader.metadata) continue;
+            if (!this.state.histograms) {
+                this.state.histograms = { histograms: {}, bin_edges: streamReader.metadata.bin_edges };
+                this.state.preview = streamReader.metadata.preview || null;
+            }
+            this.storeMaskRecords(frames);
+            received += frames.length;
+            this.ui.setProcessingStatus(`Tracked ${received} of ${streamReader.metadata.num_frames} frames`);
+
+            if (frames.some(frame => frame.frameIdx === this.state.currentFrame)) {
+                this.videoManager.drawFrame();
+            }
+        }
+
+        if (streamReader.error) {
+            throw new Error(streamReader.error);
+        }
+        if (streamReader.metadata && received < streamReader.metadata.num_frames) {
+            throw new Error(`Processing stopped after ${received} of ${streamReader.metadata.num_frames} frames`);
+        }
+        this.showPreviewStatus();
+        console.log('Processed all frame masks:', this.state.masks);
+        this.videoManager.drawFrame();
+    }
+
+    // Tell whether the results are a preview, which can then be upgraded to full tracking
+    showPreviewStatus() {
+        const preview = this.state.preview;
+        if (this.ui.elements.runFullTrackingBtn) {
+            this.ui.elements.runFullTrackingBtn.style.display = preview ? 'block' : 'none';
+        }
+        if (preview) {
+            const numFrames = Object.keys(this.state.masks).length;
+            this.ui.setProcessingStatus(`Preview: tracked ${preview.keyframes.length} of ${numFrames} frames, the others are interpolated`);
+        } else {
+            this.ui.setProcessingStatus('');
+        }
+    }
+
+    isBinaryResponse(response) {
+        const contentType = response.headers.get('Content-Type') || '';
+        if (!contentType.startsWith(BINARY_CONTENT_TYPE)) return false;
+        console.log(`Received ${response.headers.get('X-Payload-Bytes')} bytes, encoded in ${response.headers.get('X-Encode-Time-Ms')} ms`);
+        return true;
+    }
+
+    // Store decoded binary frame records (see MaskDecoder) in the application state
+    storeMaskRecords(frames) {
+        frames.forEach(frame => {
+            if (!this.state.masks[frame.frameIdx]) {
+                this.state.masks[frame.frameIdx] = {};
+            }
+            frame.objectIds.forEach((objId, i) => {
+                // Convert from 0-based backend id to 1-based frontend id
+                this.state.masks[frame.frameIdx][objId + 1] = frame.masks[i];
+            });
+
+            if (frame.histograms && this.state.histograms) {
+                // Index histograms by backend object id, as drawHistogram expects
+                this.state.histograms.histograms[frame.frameIdx] = frame.histograms.map(channel => {
+                    const byObjectId = [];
+                    frame.objectIds.forEach((objId, i) => {
+                        byObjectId[objId] = channel[i];
+                    });
+                    return byObjectId;
+                });
+            }
+        });
+    }
+
+    // Fetch the statistics of each object over the whole recording, downsampled to about one point per pixel of the timeline
+    async loadTimelines() {
+        const canvas = this.videoManager.timelineCanvas;
+        if (!canvas) return;
+        try {
+            const response = await fetch('/stats', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    filename: this.state.currentVideo.filename,
+                    convert_to_monochrome: this.ui.elements.monochromeToggle.checked,
+                    preview: this.state.preview ? { stride: this.state.preview.stride, adaptive: this.state.preview.adaptive } : undefined,
+                    num_points: Math.max(2 * canvas.width, 100)
+                })
+            });
+            if (!response.ok) {
+                throw new Error(await response.text());
+            }
+            this.state.timelines = await response.json();
+            this.videoManager.drawTimeline();
+        } catch (error) {
+            // the timeline is optional: the per-frame histograms are still shown
+            console.error('Error loading object statistics:', error);
+        }
+    }
+
     switchToInspectionMode() {
         this.isInspectionMode = true;
         
@@ -895,13 +1381,15 @@ class ObjectManager {
             item.addEventListener('click', () => {
                 const objectId = parseInt(item.dataset.id);
                 this.setActiveObject(objectId);
-                // Redraw the histogram for the newly selected object
+                // Redraw the histogram and timeline for the newly selected object
                 this.videoManager.drawHistogram();
+                this.videoManager.drawTimeline();
             });
         });
     }
 
-    async trackObjects() {
+    // Track the objects through the whole video; a preview tracks keyframes only (see /process-video)
+    async trackObjects(preview = this.ui.elements.previewToggle && this.ui.elements.previewToggle.checked) {
         if (!this.state.currentVideo) return;
         
         const prompts = [];
@@ -926,22 +1414,35 @@ class ObjectManager {
             
             // Switch to inspection mode
             this.switchToInspectionMode();
+            this.state.timelines = null;
+            this.state.preview = null;
+            if (this.ui.elements.runFullTrackingBtn) {
+                this.ui.elements.runFullTrackingBtn.style.display = 'none';
+            }
             
-            const response = await fetch('/process-video', {
+            const response = await fetch('/process-video?stream=1', {
                 method: 'POST',
                 headers: {
-                    'Content-Type': 'application/json'
+                    'Content-Type': 'application/json',
+                    'Accept': BINARY_CONTENT_TYPE
                 },
                 body: JSON.stringify({
                     filename: this.state.currentVideo.filename,
                     prompts: prompts,
-                    convert_to_monochrome: this.ui.elements.monochromeToggle.checked
+                    convert_to_monochrome: this.ui.elements.monochromeToggle.checked,
+                    preview: preview ? { stride: PREVIEW_STRIDE } : undefined
                 })
             });
             
             if (!response.ok) {
                 throw new Error(`Processing failed: ${await response.text()}`);
             }
+
+            if (this.isBinaryResponse(response)) {
+                await this.readMaskStream(response);
+                await this.loadTimelines();
+                return;
+            }
             
             const data = await response.json();
             console.log('Received video processing result:', data);
@@ -952,6 +1453,7 @@ class ObjectManager {
                 
                 // Store histograms data
                 this.state.histograms = data.histograms;
+                this.state.preview = data.preview || null;
                 
                 // Process masks for each frame
                 Object.entries(data.masks).forEach(([frameIdx, maskData]) => {
@@ -978,6 +1480,8 @@ class ObjectManager {
                 });
                 
                 console.log('Processed all frame masks:', this.state.masks);
+                this.showPreviewStatus();
+                await this.loadTimelines();
                 this.videoManager.drawFrame();
             } else {
                 throw new Error('Processing failed: ' + data.message);
@@ -1137,7 +1641,9 @@ class Application {
                 this.state.currentFrame = frameValue;
                 this.state.videoElement.currentTime = frameValue / this.state.fps;
                 this.videoManager.drawFrame();
+                this.videoManager.showFrame(frameValue);
                 this.ui.elements.frameDisplay.textContent = this.videoManager.formatTime(this.state.videoElement.currentTime);
+                this.objectManager.schedulePrefetch();
             }
         });
         
@@ -1145,6 +1651,10 @@ class Application {
         this.ui.elements.addObjectBtn.addEventListener('click', () => this.objectManager.addObject());
         this.ui.elements.startOverBtn.addEventListener('click', () => this.objectManager.startOver());
         this.ui.elements.trackObjectsBtn.addEventListener('click', () => this.objectManager.trackObjects());
+        if (this.ui.elements.runFullTrackingBtn) {
+            // upgrade a preview: track every frame with the same prompts
+            this.ui.elements.runFullTrackingBtn.addEventListener('click', () => this.objectManager.trackObjects(false));
+        }
         
         // Back to selection button handler
         const backToSelectionBtn = document.getElementById('back-to-selection');
@@ -1236,6 +1746,12 @@ class Application {
                 this.videoManager.histogramCanvas.height = 150;
                 this.videoManager.drawHistogram();
             }
+            if (this.videoManager.timelineCanvas) {
+                const container = this.videoManager.timelineCanvas.parentElement;
+                this.videoManager.timelineCanvas.width = container.clientWidth;
+                this.videoManager.timelineCanvas.height = 150;
+                this.videoManager.drawTimeline();
+            }
         });
     }
 }
@@ -0,0 +1,41 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# backend modules are imported as top-level modules, as the server does
+sys.path.insert(0, str(Path(__file__).parent.parent / "backend"))
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """Point the server at an empty data directory, with empty registries."""
+    import server
+    from jobs import JobRegistry
+    from mask_cache import MaskCache
+    from sessions import SessionRegistry
+
+    for name, directory in [("UPLOAD_DIR", "videos"), ("MASKS_DIR", "masks"), ("FRAMES_DIR", "frames"), ("JOBS_DIR", "jobs"), ("EXPORTS_DIR", "exports")]:
+        (tmp_path / directory).mkdir()
+        monkeypatch.setattr(server, name, tmp_path / directory)
+    monkeypatch.setattr(server, "mask_cache", MaskCache(tmp_path / "masks", server.MASK_CACHE_SIZE))
+    monkeypatch.setattr(server, "jobs", JobRegistry(tmp_path / "jobs"))
+    monkeypatch.setattr(server, "sessions", SessionRegistry(server.SESSION_MEMORY_BUDGET, server.build_inference_state))
+    monkeypatch.setattr(server, "uploads_by_hash", {})
+    return tmp_path
+
+
+@pytest.fixture
+def app(data_dir):
+    """A new application with the routes and startup of server.app, which can only run on one event loop."""
+    from aiohttp import web
+
+    import server
+
+    app = web.Application(middlewares=list(server.app.middlewares))
+    for route in server.app.router.routes():
+        if not isinstance(route.resource, web.StaticResource):
+            app.router.add_route(route.method, route.resource.canonical, route.handler)
+    app.on_startup.extend(server.app.on_startup)
+    app.on_cleanup.extend(server.app.on_cleanup)
+    return app
@@ -0,0 +1,21 @@
+import cv2
+import numpy as np
+
+from frame_store import LEGACY_SAM_FRAMES, FrameStore
+
+
+def test_frames_are_resized_for_sam2_as_they_are_read(tmp_path):
+    stack = np.arange(3 * 48 * 80, dtype=np.uint16).reshape(3, 48, 80)
+    stack_path = tmp_path / "stack.raw"
+    stack.tofile(stack_path)
+    store = FrameStore.create_from_stack(tmp_path / "store", str(stack_path), 128, source={"width": 80, "height": 48})
+    assert sorted(path.name for path in store.store_dir.iterdir()) == ["frames.raw", "meta.json", "thumbnails.raw"]
+
+    expected = cv2.resize(cv2.cvtColor(np.asarray(store.frames[2]), cv2.COLOR_BGR2RGB), (128, 128))
+    np.testing.assert_array_equal(store.read_sam_frame(2), expected)
+    store.release()
+
+    # stores of earlier versions also kept the frames at the input size of SAM2
+    (store.store_dir / LEGACY_SAM_FRAMES).write_bytes(b"\0" * 16)
+    FrameStore.open(store.store_dir).release()
+    assert not (store.store_dir / LEGACY_SAM_FRAMES).exists()
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+
+import server
+from insights import _bin_values, compute_batch_histograms, compute_frame_histograms, compute_temporal_stats, histogram_bin_edges
+
+
+def make_mask(height: int, width: int) -> np.ndarray:
+    mask = np.zeros((1, height, width), dtype=np.uint8)
+    mask[0, 8:24, 4:17] = 1  # 208 pixels
+    return mask
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int8, np.uint16, np.int16])
+def test_bin_values_matches_np_histogram(dtype):
+    info = np.iinfo(dtype)
+    rng = np.random.default_rng(0)
+    values = rng.integers(info.min, info.max, size=10000, endpoint=True).astype(dtype)
+    for bins, value_range in [(16, (int(info.min), int(info.max) + 1)), (10, (-20, 100)), (7, (0, 50))]:
+        indices = _bin_values(values, bins, value_range)
+        counts = np.bincount(indices, minlength=bins + 1)[:bins]
+        # np.histogram closes its last bin, the bins of compute_batch_histograms are half-open
+        in_range = values[(values >= value_range[0]) & (values < value_range[1])]
+        expected, _ = np.histogram(in_range, bins=bins, range=value_range)
+        np.testing.assert_array_equal(counts, expected)
+
+
+def test_int16_frame_histograms_match_np_histogram():
+    rng = np.random.default_rng(1)
+    frame = rng.integers(-3000, 3000, size=(32, 32)).astype(np.int16)
+    mask = make_mask(32, 32)
+    bins, value_range = 64, (-4096, 4096)
+
+    histograms = compute_frame_histograms(frame, mask, bins=bins, value_range=value_range)
+    expected, _ = np.histogram(frame[mask[0] > 0], bins=bins, range=value_range)
+    np.testing.assert_array_equal(histograms[0, 0], expected)
+    assert histograms.sum() == 208
+
+    stats = compute_temporal_stats(histograms[np.newaxis], histogram_bin_edges(bins, value_range, num_channels=1))
+    assert stats["count"][0, 0] == 208
+
+
+def test_batch_histograms_count_overlapping_objects_in_each():
+    rng = np.random.default_rng(2)
+    frames = rng.integers(0, 65536, size=(2, 24, 24, 1)).astype(np.uint16)
+    masks = np.zeros((2, 2, 24, 24), dtype=np.uint8)
+    masks[:, 0, :12] = 1
+    masks[:, 1, 6:18] = 1
+    bins, value_range = 32, (0, 65536)
+
+    histograms = compute_batch_histograms(frames, masks, bins, value_range)
+    for batch_idx in range(2):
+        for obj_idx in range(2):
+            expected, _ = np.histogram(frames[batch_idx, ..., 0][masks[batch_idx, obj_idx] > 0], bins=bins, range=value_range)
+            np.testing.assert_array_equal(histograms[batch_idx, 0, obj_idx], expected)
+
+
+def test_temporal_stats_of_monochrome_histograms_of_8bit_frames():
+    rng = np.random.default_rng(0)
+    frame = rng.integers(0, 256, size=(32, 32, 3), dtype=np.uint8)
+    mask = make_mask(32, 32)
+    options = {"convert_to_monochrome": True, "bins": 256, "value_range": [0, 256]}
+    histograms = compute_frame_histograms(frame, mask, convert_to_monochrome=True)
+    bin_edges = server.get_bin_edges(SimpleNamespace(video_info={}), options)
+    assert histograms.shape == (1, 1, 256) and bin_edges.shape == (1, 257)
+
+    stats = compute_temporal_stats(histograms[np.newaxis], bin_edges, percentiles=[50])
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)[mask[0] > 0]
+    assert stats["count"][0, 0] == 208
+    assert stats["mean"][0, 0, 0] == pytest.approx(gray.mean())
+    assert stats["min"][0, 0, 0] == gray.min() and stats["max"][0, 0, 0] == gray.max()
@@ -0,0 +1,57 @@
+import asyncio
+import io
+import threading
+
+import numpy as np
+import pyarrow.parquet as pq
+from aiohttp.test_utils import TestClient, TestServer
+
+import server
+from jobs import CHECKPOINT_INTERVAL, Job, JobRegistry
+
+
+def test_results_are_read_once_each_while_frames_are_checkpointed_on_another_thread(tmp_path):
+    registry = JobRegistry(tmp_path)
+    job = registry.create("recording.mp4", [], {"convert_to_monochrome": False, "bins": 4, "value_range": [0, 256]}, 100)
+    num_frames = 3 * CHECKPOINT_INTERVAL + 5
+
+    def produce():
+        for frame_idx in range(num_frames):
+            job.record(frame_idx, np.full((1, 4, 4), frame_idx % 2, dtype=np.uint8), np.full((3, 1, 4), frame_idx, dtype=np.int32))
+
+    producer = threading.Thread(target=produce)
+    producer.start()
+    while producer.is_alive():
+        frame_indices = [frame_idx for frame_idx, _, _ in job.iter_results()]
+        assert frame_indices == list(range(len(frame_indices)))
+    producer.join()
+    job.checkpoint()
+
+    reloaded = Job.load(job.job_dir)
+    results = list(reloaded.iter_results())
+    assert [frame_idx for frame_idx, _, _ in results] == list(range(num_frames))
+    assert all(histograms[0, 0, 0] == frame_idx and masks.max() == frame_idx % 2 for frame_idx, masks, histograms in results)
+
+
+def test_monochrome_job_is_exported_with_one_histogram_channel(app, data_dir):
+    options = {"convert_to_monochrome": True, "bins": 256, "value_range": [0, 256]}
+    job = server.jobs.create("recording.mp4", [], options, 3)
+    job.obj_ids = [0]
+    job.record(0, np.ones((1, 4, 4), dtype=np.uint8), np.eye(1, 256, 10, dtype=np.int32)[np.newaxis] * 16)
+    job.record(1, np.ones((1, 4, 4), dtype=np.uint8), None)  # a frame that could not be read
+    job.status = "completed"
+    job.checkpoint()
+
+    async def run():
+        async with TestClient(TestServer(app)) as client:
+            stats = await client.get(f"/jobs/{job.job_id}/stats")
+            assert stats.status == 200, await stats.text()
+            export = await client.get(f"/jobs/{job.job_id}/export", params={"format": "parquet"})
+            assert export.status == 200, await export.text()
+            return await stats.json(), await export.read()
+
+    stats, export = asyncio.run(run())
+    timeline = stats["objects"][0]
+    assert len(timeline["mean"]) == 1 and timeline["mean"][0]["values"][0] == 10
+    table = pq.read_table(io.BytesIO(export))
+    assert table.num_rows == 2
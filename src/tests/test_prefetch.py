@@ -0,0 +1,64 @@
+import asyncio
+
+import pytest
+
+import server
+from inference_pool import InferencePool
+from sessions import Session
+
+
+@pytest.fixture(autouse=True)
+def inference_pool(monkeypatch):
+    pool = InferencePool(2, 4)
+    monkeypatch.setattr(server, "inference_pool", pool)
+    monkeypatch.setattr(server, "PREFETCH_RADIUS", 2)
+    yield pool
+    pool.shutdown()
+
+
+def make_session() -> Session:
+    session = Session("recording.mp4", "recording.mp4", {})
+    session.inference_state = {"num_frames": 10}
+    return session
+
+
+def test_frames_are_prefetched_with_the_session_lock_held(monkeypatch):
+    session = make_session()
+    encoded = []
+
+    def encode_frame(inference_state, frame_idx):
+        assert inference_state is session.inference_state and session.lock.locked()
+        encoded.append(frame_idx)
+        return True
+
+    monkeypatch.setattr(server, "encode_frame", encode_frame)
+    asyncio.run(server.prefetch_frames(session, 0))
+    assert encoded == [0, 1, 2]
+
+
+def test_prefetching_stops_when_a_request_is_admitted(monkeypatch):
+    session = make_session()
+    encoded = []
+
+    async def run():
+        async def click():
+            async with server.inference_pool.admit(), session.lock:
+                await asyncio.sleep(0.05)
+
+        def encode_frame(inference_state, frame_idx):
+            encoded.append(frame_idx)
+            if frame_idx == 5:
+                asyncio.run_coroutine_threadsafe(start_click(), loop).result()
+            return True
+
+        async def start_click():
+            clicks.append(asyncio.create_task(click()))
+
+        loop = asyncio.get_running_loop()
+        clicks = []
+        monkeypatch.setattr(server, "encode_frame", encode_frame)
+        await server.prefetch_frames(session, 5)
+        await asyncio.gather(*clicks)
+
+    asyncio.run(run())
+    assert encoded == [5]
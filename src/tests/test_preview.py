@@ -0,0 +1,30 @@
+import cv2
+import numpy as np
+
+from frame_store import FrameStore
+from preview import frame_thumbnails, keyframe_schedule
+
+
+def smooth_scene(rng) -> np.ndarray:
+    coarse = rng.uniform(1000, 2000, size=(6, 8)).astype(np.float32)
+    return cv2.resize(coarse, (128, 96), interpolation=cv2.INTER_CUBIC).astype(np.uint16)
+
+
+def test_adaptive_schedule_from_store_thumbnails_matches_full_frames(tmp_path):
+    rng = np.random.default_rng(0)
+    # a scene that changes abruptly at frame 20, and slowly otherwise
+    stack = np.repeat(smooth_scene(rng)[None], 40, axis=0)
+    stack[20:] = smooth_scene(rng)
+    stack += np.arange(40, dtype=np.uint16)[:, None, None]
+    stack_path = tmp_path / "stack.raw"
+    stack.tofile(stack_path)
+
+    store = FrameStore.create_from_stack(tmp_path / "store", str(stack_path), 64, source={"width": 128, "height": 96})
+    from_thumbnails = frame_thumbnails(store.thumbnails)
+    from_frames = frame_thumbnails(store.frames)
+    assert np.abs(from_thumbnails - from_frames).mean(axis=(1, 2)).max() < 1
+
+    schedule = keyframe_schedule(store.num_frames, 16, set(), from_thumbnails)
+    assert schedule == keyframe_schedule(store.num_frames, 16, set(), from_frames)
+    assert 20 in schedule
+    store.release()
@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+import server
+
+
+def make_prompt(x: float, y: float, label: int = 1, obj_id: int = 1, frame_idx: int = 0) -> dict:
+    return {"x": x, "y": y, "label": label, "obj_id": obj_id, "frame_idx": frame_idx}
+
+
+def test_drop_frame_outputs_forgets_the_outputs_of_one_object_on_one_frame():
+    def outputs():
+        return {"cond_frame_outputs": {0: "cond", 1: "cond"}, "non_cond_frame_outputs": {0: "non-cond", 2: "non-cond"}}
+
+    def tracked():
+        return {0: {"reverse": False}, 1: {"reverse": False}}
+
+    inference_state = {
+        "obj_id_to_idx": {7: 0, 8: 1},
+        "output_dict_per_obj": {0: outputs(), 1: outputs()},
+        "temp_output_dict_per_obj": {0: outputs(), 1: outputs()},
+        "frames_tracked_per_obj": {0: tracked(), 1: tracked()},
+    }
+    server.drop_frame_outputs(inference_state, 0, 7)
+    server.drop_frame_outputs(inference_state, 0, 9)  # unknown objects are ignored
+
+    for key in ("output_dict_per_obj", "temp_output_dict_per_obj"):
+        assert inference_state[key][0] == {"cond_frame_outputs": {1: "cond"}, "non_cond_frame_outputs": {2: "non-cond"}}
+        assert inference_state[key][1] == outputs()
+    assert inference_state["frames_tracked_per_obj"] == {0: {1: {"reverse": False}}, 1: tracked()}
+
+
+@pytest.fixture(scope="module")
+def predictor():
+    pytest.importorskip("torch")
+    pytest.importorskip("sam2")
+    if not server.MODEL_CHECKPOINT.exists():
+        pytest.skip(f"{server.MODEL_CHECKPOINT} is missing")
+    server.import_model_libraries()
+    previous, server.sam2_predictor = server.sam2_predictor, server.build_predictor()
+    yield server.sam2_predictor
+    server.sam2_predictor = previous
+
+
+@pytest.fixture
+def video_dir(tmp_path):
+    import cv2
+
+    ramp = np.linspace(0, 60, 256, dtype=np.float32)
+    frame = np.repeat((ramp[np.newaxis, :] + ramp[:, np.newaxis])[..., np.newaxis], 3, axis=2)
+    cv2.circle(frame, (80, 90), 30, (220, 220, 220), -1)
+    cv2.circle(frame, (190, 170), 25, (200, 200, 200), -1)
+    for frame_idx in range(2):
+        cv2.imwrite(str(tmp_path / f"{frame_idx:05d}.jpg"), frame.astype(np.uint8))
+    return tmp_path
+
+
+def frame_mask(predictor, inference_state, frame_idx: int = 0) -> np.ndarray:
+    for _, _, masks in predictor.propagate_in_video(inference_state, start_frame_idx=frame_idx, max_frame_num_to_track=0):
+        return (masks[:, 0] > 0).cpu().numpy()
+
+
+def test_incremental_prompts_match_prompts_applied_from_scratch(predictor, video_dir):
+    first_click = make_prompt(80, 90)
+    wrong_click = make_prompt(190, 170)
+
+    incremental = predictor.init_state(str(video_dir))
+    # like process_frame_with_prompts, the mask of the frame is propagated after each change
+    clicks = [[first_click], [first_click, wrong_click], [first_click]]  # the user deletes the wrong click
+    for previous, prompts in zip([[]] + clicks, clicks):
+        server.apply_prompt_changes(incremental, previous, prompts)
+        frame_mask(predictor, incremental)
+
+    from_scratch = predictor.init_state(str(video_dir))
+    server.apply_prompt_changes(from_scratch, [], [first_click])
+
+    np.testing.assert_array_equal(frame_mask(predictor, incremental), frame_mask(predictor, from_scratch))
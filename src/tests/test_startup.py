@@ -0,0 +1,82 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import server
+
+
+def test_data_of_previous_runs_is_loaded_in_the_background(app, data_dir, monkeypatch):
+    job_dir = data_dir / "jobs" / "previous"
+    job_dir.mkdir()
+    with open(job_dir / "job.json", "w") as f:
+        json.dump({
+            "job_id": "previous", "session_id": "recording.mp4", "prompts": [], "histogram_options": None,
+            "num_frames": 10, "status": "running", "error": None, "obj_ids": None, "created_at": 0,
+            "chunks": [], "frames_done": 0, "next_frame_idx": 0,
+        }, f)
+    interrupted = data_dir / "masks" / "key.tmp-interrupted"
+    interrupted.mkdir()
+    os.utime(interrupted, (0, 0))
+    # a run of this process, writing to the cache while the data loads
+    running = data_dir / "masks" / "key.tmp-running"
+    running.mkdir()
+    monkeypatch.setattr(server, "process_started_at", time.time() - 60)
+
+    loaded = threading.Event()
+    load_data = server.load_data
+
+    def slow_load_data():
+        loaded.wait(10)
+        load_data()
+
+    monkeypatch.setattr(server, "load_data", slow_load_data)
+    monkeypatch.setattr(server, "data_status", {"state": "loading", "error": None, "load_seconds": None})
+
+    async def run():
+        async with TestClient(TestServer(app)) as client:
+            # the listener is up while the data loads
+            health = await client.get("/healthz")
+            assert health.status == 200 and (await health.json())["data"]["state"] == "loading"
+            ready = await client.get("/readyz")
+            assert ready.status == 503
+            loaded.set()
+            while server.data_status["state"] == "loading":
+                await asyncio.sleep(0.01)
+            assert (await (await client.get("/healthz")).json())["data"]["state"] == "ready"
+
+    asyncio.run(run())
+    assert server.jobs.get("previous").status == "interrupted"
+    assert not interrupted.exists() and running.exists()
+
+
+def test_only_exports_of_processes_that_are_gone_are_removed(data_dir, monkeypatch):
+    exports_dir = data_dir / "exports"
+    monkeypatch.setattr(server, "process_started_at", time.time())
+    monkeypatch.setattr(server, "process_exports_lock", None)
+    own = server.get_process_exports_dir()
+    (own / "export.h5").touch()
+
+    def previous_process(name: str):
+        directory = exports_dir / name
+        directory.mkdir()
+        (directory / "export.h5").touch()
+        lock_file = open(directory / ".lock", "a")
+        os.utime(directory, (0, 0))
+        return directory, lock_file
+
+    live, live_lock = previous_process("live")
+    server.fcntl.flock(live_lock, server.fcntl.LOCK_EX | server.fcntl.LOCK_NB)
+    gone, gone_lock = previous_process("gone")
+    gone_lock.close()
+    legacy = exports_dir / "legacy.h5"
+    legacy.touch()
+    os.utime(legacy, (0, 0))
+
+    server.remove_stale_exports()
+    live_lock.close()
+    assert (own / "export.h5").exists() and (live / "export.h5").exists()
+    assert not gone.exists() and not legacy.exists()
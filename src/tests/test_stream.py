@@ -0,0 +1,47 @@
+import asyncio
+import json
+
+import numpy as np
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import server
+from serialization import BINARY_CONTENT_TYPE, decode_stream
+
+
+async def failing_results():
+    yield 0, np.ones((1, 4, 4), dtype=np.uint8), None
+    raise RuntimeError("out of memory")
+
+
+def stream_app():
+    async def handle(request):
+        return await server.stream_process_video(request, [0], 3, np.arange(3), failing_results())
+
+    app = web.Application()
+    app.router.add_get("/stream", handle)
+    return app
+
+
+def test_binary_stream_ends_with_an_error_record():
+    async def run():
+        async with TestClient(TestServer(stream_app())) as client:
+            response = await client.get("/stream", headers={"Accept": BINARY_CONTENT_TYPE})
+            return await response.read()
+
+    metadata, records = decode_stream(asyncio.run(run()))
+    records = list(records)
+    assert metadata["num_frames"] == 3
+    assert records[0]["frame_idx"] == 0 and records[0]["masks"].sum() == 16
+    assert records[1] == {"status": "error", "message": "Error processing video: out of memory"}
+
+
+def test_json_stream_ends_with_an_error_line():
+    async def run():
+        async with TestClient(TestServer(stream_app())) as client:
+            response = await client.get("/stream")
+            return await response.text()
+
+    lines = [json.loads(line) for line in asyncio.run(run()).splitlines()]
+    assert lines[1]["frame_idx"] == 0
+    assert lines[2] == {"status": "error", "message": "Error processing video: out of memory"}
@@ -0,0 +1,83 @@
+import asyncio
+
+import aiohttp
+import numpy as np
+from aiohttp.test_utils import TestClient, TestServer
+
+import server
+
+
+async def upload(client: TestClient, filename: str, content: bytes, **query) -> dict:
+    form = aiohttp.FormData()
+    form.add_field("file", content, filename=filename)
+    response = await client.post("/upload", data=form, params=query)
+    assert response.status == 200, await response.text()
+    return await response.json()
+
+
+def test_reuploads_get_their_own_session_and_share_the_frame_store(app, data_dir):
+    stack = np.arange(4 * 16 * 24, dtype=np.uint16).reshape(4, 16, 24).tobytes()
+
+    async def run():
+        async with TestClient(TestServer(app)) as client:
+            first = await upload(client, "stack.raw", stack, width=24, height=16)
+            second = await upload(client, "stack.raw", stack, width=24, height=16)
+            # the same bytes read with another layout are another recording
+            relaid = await upload(client, "stack.raw", stack, width=16, height=24)
+            return first, second, relaid
+
+    first, second, relaid = asyncio.run(run())
+    assert not first["deduplicated"] and second["deduplicated"] and not relaid["deduplicated"]
+    assert len({first["filename"], second["filename"], relaid["filename"]}) == 3
+    assert (second["width"], second["height"]) == (24, 16)
+    assert (relaid["width"], relaid["height"]) == (16, 24)
+
+    first_session, second_session = server.sessions.get(first["filename"]), server.sessions.get(second["filename"])
+    assert first_session is not second_session
+    assert first_session.lock is not second_session.lock
+    assert second_session.frame_store is first_session.frame_store
+    assert (data_dir / "frames" / second["filename"] / "meta.json").is_file()
+    assert (data_dir / "videos" / second["filename"]).is_file()
+
+
+def test_frame_stores_of_idle_recordings_are_evicted_beyond_the_size_limit(app, data_dir, monkeypatch):
+    stacks = [np.full((3, 16, 24), value, dtype=np.uint16).tobytes() for value in (100, 200, 300)]
+    store_bytes = 3 * (16 * 24 * 3 + 96 * 64 * 3) + 4096  # frames and thumbnails, and metadata
+    monkeypatch.setattr(server, "FRAME_STORE_SIZE", int(2.5 * store_bytes))
+
+    async def run():
+        async with TestClient(TestServer(app)) as client:
+            uploads = [await upload(client, f"stack{i}.raw", stack, width=24, height=16) for i, stack in enumerate(stacks)]
+            first = server.sessions.get(uploads[0]["filename"])
+            assert first.frame_store is None
+            assert not (data_dir / "frames" / uploads[0]["filename"] / "meta.json").exists()
+            assert first.video_info["radiometric"]["value_min"] == 100
+            # the evicted recording is decoded again when it is used
+            response = await client.get(f"/frames/{uploads[0]['filename']}/2")
+            assert response.status == 200
+            assert first.frame_store is not None and first.frame_store.read_radiometric(2).min() == 100
+            return uploads
+
+    uploads = asyncio.run(run())
+    assert (data_dir / "frames" / uploads[0]["filename"] / "meta.json").is_file()
+    assert all((data_dir / "frames" / upload["filename"] / "meta.json").is_file() for upload in uploads[1:])
+
+
+def test_frame_stores_are_closed_once_no_session_uses_them(app, data_dir):
+    stack = np.arange(4 * 16 * 24, dtype=np.uint16).reshape(4, 16, 24).tobytes()
+
+    async def run():
+        async with TestClient(TestServer(app)) as client:
+            return [await upload(client, "stack.raw", stack, width=24, height=16) for _ in range(2)]
+
+    first, second = (server.sessions.get(response["filename"]) for response in asyncio.run(run()))
+    store = first.frame_store
+    first.inference_state = {}  # as if a state was built from the store
+    server.sessions.evict(first)
+    # the re-upload still reads the store
+    assert first.frame_store is None and store.is_opened() and second.frame_store.read_sam_frame(1).shape[2] == 3
+
+    server.sessions.remove(second.session_id)
+    assert not store.is_opened() and store.frames_file is None
+    # the evicted session opens its store again
+    assert server.ensure_frame_store(first).read_radiometric(3).max() == 4 * 16 * 24 - 1